@@ -819,7 +819,17 @@ export default function RoomPage() {
       });
       
       // Handle typing indicators
-      socketManager.onTyping((data: { type?: string; user_id?: string; username?: string }) => {
+      socketManager.onTyping((data: { type?: string; user_id?: string; username?: string; users?: Array<{ user_id: string; username: string }> }) => {
+        // Batched snapshot of everyone typing in the room
+        if (data.type === 'typing') {
+          setTypingUsers(new Set(
+            (data.users || [])
+              .filter(u => !user || u.user_id !== user.id)
+              .map(u => u.username || 'Someone')
+          ));
+          return;
+        }
+
         const typingUserId = data.user_id;
         const typingUsername = data.username || 'Someone';
         
@@ -0,0 +1,275 @@
+import os
+import re
+import shutil
+import uuid
+import asyncio
+import hashlib
+import mimetypes
+import urllib.request
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+try:
+    import boto3  # type: ignore
+except Exception:
+    boto3 = None  # Optional; only required for BLOB_BACKEND=s3
+
+# local (files under BLOB_DIR, served by GET /media/{key}) | s3 | bunny
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "local")
+# Root of the local blob store; in-flight uploads are staged in BLOB_DIR/.tmp for every backend
+BLOB_DIR = os.getenv("BLOB_DIR", "media")
+# Public base URL blobs are linked from (CDN pull zone, bucket website); empty links to this app's /media/
+BLOB_PUBLIC_URL = os.getenv("BLOB_PUBLIC_URL", "").rstrip("/")
+# Largest accepted upload in bytes
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", str(50 * 1024 * 1024)))
+# Bytes hashed and written per step while streaming an upload to disk
+BLOB_CHUNK_SIZE = int(os.getenv("BLOB_CHUNK_SIZE", str(1024 * 1024)))
+# S3 or S3-compatible (R2, MinIO, Bunny S3) target; credentials come from the usual AWS_* settings
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET", "")
+BLOB_S3_ENDPOINT = os.getenv("BLOB_S3_ENDPOINT") or None
+BLOB_S3_PREFIX = os.getenv("BLOB_S3_PREFIX", "media/")
+# Bunny Storage zone name and its password (the storage zone's AccessKey)
+BUNNY_STORAGE_ZONE = os.getenv("BUNNY_STORAGE_ZONE", "")
+BUNNY_STORAGE_KEY = os.getenv("BUNNY_STORAGE_KEY", "")
+BUNNY_STORAGE_HOST = os.getenv("BUNNY_STORAGE_HOST", "storage.bunnycdn.com")
+
+# Blobs are immutable, so clients and CDNs may cache them forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# sha256 hex plus an optional extension; nothing else can name a blob
+_KEY_RE = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,8})?$")
+
+
+class BlobTooLarge(Exception):
+    """Raised when an upload exceeds BLOB_MAX_BYTES."""
+
+
+class UnsupportedMediaType(Exception):
+    """Raised for content types the gallery does not store (anything but image/video/audio, or SVG)."""
+
+
+def media_type_allowed(content_type: str) -> bool:
+    # SVG can carry script and would run with this API's origin when opened directly
+    return content_type.split("/")[0] in ("image", "video", "audio") and content_type != "image/svg+xml"
+
+
+def valid_key(key: str) -> bool:
+    return bool(_KEY_RE.match(key))
+
+
+def blob_key(sha256: str, content_type: str) -> str:
+    """Content address: identical bytes of the same type always map to one blob."""
+    ext = mimetypes.guess_extension(content_type) or ""
+    return f"{sha256}{ext}"
+
+
+def _write_chunk(f: Any, hasher: Any, chunk: bytes) -> None:
+    hasher.update(chunk)
+    f.write(chunk)
+
+
+def _file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class BlobStore:
+    """Content-addressed blob storage.
+
+    `put_stream` consumes an async iterator of byte chunks, hashing and
+    writing them to a staging file off the event loop, so no upload is
+    ever held in memory whole. The finished file is named by its
+    SHA-256; a blob that already exists is not stored twice.
+    """
+
+    def __init__(self, root: str = BLOB_DIR, max_bytes: int = BLOB_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._tmp = os.path.join(root, ".tmp")
+        self.stats = {"uploads": 0, "deduplicated": 0, "bytes": 0, "rejected": 0}
+
+    async def put_stream(self, chunks: AsyncIterator[bytes], content_type: str) -> Dict[str, Any]:
+        content_type = (content_type or "").split(";")[0].strip().lower()
+        if not media_type_allowed(content_type):
+            self.stats["rejected"] += 1
+            raise UnsupportedMediaType(content_type or "unknown")
+        staging = os.path.join(self.staging_dir(), uuid.uuid4().hex)
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(staging, "wb") as f:
+                # Regroup the server's small body chunks so each thread hop writes BLOB_CHUNK_SIZE
+                pending = bytearray()
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        self.stats["rejected"] += 1
+                        raise BlobTooLarge(size)
+                    pending += chunk
+                    if len(pending) >= BLOB_CHUNK_SIZE:
+                        await asyncio.to_thread(_write_chunk, f, hasher, pending)
+                        pending.clear()
+                if pending:
+                    await asyncio.to_thread(_write_chunk, f, hasher, pending)
+            return await self._store(staging, hasher.hexdigest(), size, content_type)
+        finally:
+            if os.path.exists(staging):
+                os.remove(staging)
+
+    async def put_file(self, path: str, content_type: str, sha256: Optional[str] = None) -> Dict[str, Any]:
+        """Store a finished file (e.g. a derived thumbnail); it is moved when it lives in staging_dir()."""
+        if sha256 is None:
+            sha256 = await asyncio.to_thread(_file_sha256, path)
+        return await self._store(path, sha256, os.path.getsize(path), content_type)
+
+    async def _store(self, staging: str, sha256: str, size: int, content_type: str) -> Dict[str, Any]:
+        key = blob_key(sha256, content_type)
+        if await self._commit(staging, key, content_type):
+            self.stats["uploads"] += 1
+            self.stats["bytes"] += size
+        else:
+            self.stats["deduplicated"] += 1
+        return {"key": key, "sha256": sha256, "size": size, "content_type": content_type}
+
+    def staging_dir(self) -> str:
+        os.makedirs(self._tmp, exist_ok=True)
+        return self._tmp
+
+    async def local_copy(self, key: str) -> Tuple[str, bool]:
+        """A local file with the blob's bytes, and whether the caller must delete it."""
+        dest = os.path.join(self.staging_dir(), uuid.uuid4().hex)
+        try:
+            await asyncio.to_thread(self._download, key, dest)
+        except Exception:
+            if os.path.exists(dest):
+                os.remove(dest)
+            raise
+        return dest, True
+
+    def _download(self, key: str, dest: str) -> None:
+        raise NotImplementedError
+
+    async def _commit(self, staging: str, key: str, content_type: str) -> bool:
+        """Move a finished staging file to `key`; False if the blob already existed."""
+        raise NotImplementedError
+
+    def path(self, key: str) -> Optional[str]:
+        """Local file holding `key`, or None when blobs live elsewhere."""
+        return None
+
+    def url(self, key: str, base_url: str = "") -> str:
+        if BLOB_PUBLIC_URL:
+            return f"{BLOB_PUBLIC_URL}/{key}"
+        return f"{base_url.rstrip('/')}/media/{key}"
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files under BLOB_DIR/<first two hex digits>/<key>."""
+
+    def path(self, key: str) -> Optional[str]:
+        return os.path.join(self.root, key[:2], key)
+
+    async def local_copy(self, key: str) -> Tuple[str, bool]:
+        return self.path(key), False
+
+    async def _commit(self, staging: str, key: str, content_type: str) -> bool:
+        dest = self.path(key)
+        if os.path.exists(dest):
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Atomic; two concurrent uploads of the same bytes both end with one file
+        os.replace(staging, dest)
+        return True
+
+
+class S3BlobStore(BlobStore):
+    """Blobs in an S3 or S3-compatible bucket, linked via BLOB_PUBLIC_URL or the bucket URL."""
+
+    def __init__(self, bucket: str = BLOB_S3_BUCKET, endpoint: Optional[str] = BLOB_S3_ENDPOINT, prefix: str = BLOB_S3_PREFIX):
+        if boto3 is None:
+            raise RuntimeError("boto3 is not installed; cannot use BLOB_BACKEND=s3")
+        if not bucket:
+            raise RuntimeError("BLOB_S3_BUCKET is required for BLOB_BACKEND=s3")
+        super().__init__()
+        self.bucket = bucket
+        self.endpoint = endpoint
+        self.prefix = prefix
+        self._client = boto3.client("s3", endpoint_url=endpoint)
+
+    def _exists(self, name: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=name)
+            return True
+        except Exception:
+            return False
+
+    def _upload(self, staging: str, key: str, content_type: str) -> bool:
+        name = self.prefix + key
+        if self._exists(name):
+            return False
+        self._client.upload_file(
+            staging, self.bucket, name,
+            ExtraArgs={"ContentType": content_type, "CacheControl": CACHE_CONTROL},
+        )
+        return True
+
+    async def _commit(self, staging: str, key: str, content_type: str) -> bool:
+        return await asyncio.to_thread(self._upload, staging, key, content_type)
+
+    def _download(self, key: str, dest: str) -> None:
+        self._client.download_file(self.bucket, self.prefix + key, dest)
+
+    def url(self, key: str, base_url: str = "") -> str:
+        if BLOB_PUBLIC_URL:
+            return f"{BLOB_PUBLIC_URL}/{key}"
+        if self.endpoint:
+            return f"{self.endpoint.rstrip('/')}/{self.bucket}/{self.prefix}{key}"
+        return f"https://{self.bucket}.s3.amazonaws.com/{self.prefix}{key}"
+
+
+class BunnyBlobStore(BlobStore):
+    """Blobs in a Bunny Storage zone via its HTTP API, linked through the pull zone in BLOB_PUBLIC_URL."""
+
+    def __init__(self, zone: str = BUNNY_STORAGE_ZONE, access_key: str = BUNNY_STORAGE_KEY, host: str = BUNNY_STORAGE_HOST):
+        if not (zone and access_key and BLOB_PUBLIC_URL):
+            raise RuntimeError("BUNNY_STORAGE_ZONE, BUNNY_STORAGE_KEY and BLOB_PUBLIC_URL are required for BLOB_BACKEND=bunny")
+        super().__init__()
+        self.endpoint = f"https://{host}/{zone}"
+        self.access_key = access_key
+
+    def _upload(self, staging: str, key: str, content_type: str) -> bool:
+        # Same key means same bytes, so re-uploading an existing blob is harmless
+        with open(staging, "rb") as f:
+            req = urllib.request.Request(
+                f"{self.endpoint}/{key}",
+                data=f,
+                method="PUT",
+                headers={
+                    "AccessKey": self.access_key,
+                    "Content-Type": "application/octet-stream",
+                    "Content-Length": str(os.fstat(f.fileno()).st_size),
+                },
+            )
+            with urllib.request.urlopen(req, timeout=60) as resp:
+                resp.read()
+        return True
+
+    async def _commit(self, staging: str, key: str, content_type: str) -> bool:
+        return await asyncio.to_thread(self._upload, staging, key, content_type)
+
+    def _download(self, key: str, dest: str) -> None:
+        req = urllib.request.Request(f"{self.endpoint}/{key}", headers={"AccessKey": self.access_key})
+        with urllib.request.urlopen(req, timeout=60) as resp, open(dest, "wb") as f:
+            shutil.copyfileobj(resp, f, BLOB_CHUNK_SIZE)
+
+
+async def create_blob_store() -> BlobStore:
+    if BLOB_BACKEND == "s3":
+        return S3BlobStore()
+    if BLOB_BACKEND == "bunny":
+        return BunnyBlobStore()
+    if BLOB_BACKEND != "local":
+        raise ValueError(f"Unknown BLOB_BACKEND {BLOB_BACKEND!r} (expected local, s3 or bunny)")
+    return LocalBlobStore()
@@ -0,0 +1,230 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from starlette.websockets import WebSocket
+
+from backend import encoding
+
+logger = logging.getLogger("main")
+
+# Seconds a single recipient may take to accept a frame before it is evicted
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# Frames buffered per connection before the overflow policy kicks in
+QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+# What to do when a connection's queue is full: drop_oldest | coalesce | disconnect
+QUEUE_POLICY = os.getenv("WS_QUEUE_POLICY", "coalesce")
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Close code sent to evicted slow consumers (RFC 6455 "Try Again Later")
+EVICT_CLOSE_CODE = 1013
+
+# Process-wide counters for outbound queues
+queue_stats: Dict[str, int] = {
+    "enqueued": 0,
+    "dropped": 0,
+    "coalesced": 0,
+    "evictions": 0,
+    "send_failures": 0,
+}
+
+# Socket closes started by evict(); referenced until done so they are not garbage-collected
+_closing: Set[asyncio.Task] = set()
+
+
+class Connection:
+    """A WebSocket with a bounded outbound queue drained by its own writer task.
+
+    Producers never await the network: `send_text` only enqueues. When the
+    queue is full the configured policy decides whether to drop the oldest
+    frame, merge superseded typing frames, or disconnect the slow consumer.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        max_queue: int = QUEUE_SIZE,
+        policy: str = QUEUE_POLICY,
+        timeout: float = SEND_TIMEOUT,
+        on_close: Optional[Callable[["Connection"], None]] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}; expected one of {POLICIES}")
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.timeout = timeout
+        self.on_close = on_close
+        self.closed = False
+        # (coalesce_key, text) pairs; key is None for frames that must not be merged
+        self._queue: Deque[Tuple[Optional[str], str]] = deque()
+        self._wakeup = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self) -> None:
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer())
+
+    def send_text(self, text: str, coalesce_key: Optional[str] = None) -> bool:
+        """Queue a pre-encoded frame. Returns False if the connection is gone."""
+        if self.closed:
+            return False
+        if coalesce_key is not None and self._replace_pending(coalesce_key, text):
+            return True
+        if len(self._queue) >= self.max_queue and not self._make_room():
+            return False
+        self._queue.append((coalesce_key, text))
+        queue_stats["enqueued"] += 1
+        self._wakeup.set()
+        return True
+
+    def send_json(self, payload: Dict[str, Any], coalesce_key: Optional[str] = None) -> bool:
+        return self.send_text(encoding.encode_frame(payload), coalesce_key)
+
+    def _replace_pending(self, key: str, text: str) -> bool:
+        for i, (pending_key, _) in enumerate(self._queue):
+            if pending_key == key:
+                self._queue[i] = (key, text)
+                queue_stats["coalesced"] += 1
+                return True
+        return False
+
+    def _make_room(self) -> bool:
+        if self.policy == "disconnect":
+            self.evict()
+            return False
+        if self.policy == "coalesce":
+            # Typing frames are ephemeral; shed those before real messages
+            for i, (pending_key, _) in enumerate(self._queue):
+                if pending_key is not None:
+                    del self._queue[i]
+                    queue_stats["dropped"] += 1
+                    return True
+        self._queue.popleft()
+        queue_stats["dropped"] += 1
+        return True
+
+    def evict(self) -> None:
+        """Disconnect a consumer that cannot keep up."""
+        if self.closed:
+            return
+        queue_stats["evictions"] += 1
+        logger.warning(f"🐢 Evicting slow WebSocket consumer {self.user_id} (queue depth {self.depth})")
+        self._shutdown()
+        task = asyncio.create_task(self._close_socket(EVICT_CLOSE_CODE))
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+
+    async def close(self) -> None:
+        """Stop the writer after the peer has gone away."""
+        self._shutdown()
+        if self._writer_task is not None and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def _shutdown(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        if self.on_close is not None:
+            try:
+                self.on_close(self)
+            except Exception:
+                pass
+
+    async def _close_socket(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _writer(self) -> None:
+        while not self.closed:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, text = self._queue.popleft()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(text), self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                queue_stats["send_failures"] += 1
+                self.evict()
+                return
+
+
+def fan_out(
+    connections: Dict[str, Connection],
+    payload: Dict[str, Any],
+    exclude: Optional[str] = None,
+    coalesce_key: Optional[str] = None,
+) -> List[Tuple[str, Connection]]:
+    """Queue one payload on every connection in a room.
+
+    The payload is serialized once and handed to each connection's writer,
+    so a stalled client cannot delay delivery to the rest of the room.
+    Returns the (user_id, connection) pairs that are closed or were evicted.
+    """
+    targets = [(uid, conn) for uid, conn in list(connections.items()) if uid != exclude]
+    if not targets:
+        return []
+    text = encoding.encode_frame(payload)
+    return [(uid, conn) for uid, conn in targets if not conn.send_text(text, coalesce_key)]
+
+
+def deliver(
+    connections: Iterable[Connection],
+    payload: Dict[str, Any],
+    coalesce_key: Optional[str] = None,
+) -> int:
+    """Queue one payload on a set of connections (e.g. all of a user's tabs).
+
+    Returns how many connections accepted the frame.
+    """
+    targets = list(connections)
+    if not targets:
+        return 0
+    text = encoding.encode_frame(payload)
+    return sum(1 for conn in targets if conn.send_text(text, coalesce_key))
+
+
+def drop_failed(connections: Dict[str, Connection], failed: List[Tuple[str, Connection]]) -> None:
+    """Remove broken sockets, leaving any newer socket for the same user alone."""
+    for uid, conn in failed:
+        if connections.get(uid) is conn:
+            del connections[uid]
+
+
+def queue_snapshot(room_connections: Dict[str, Dict[str, Connection]]) -> Dict[str, Any]:
+    """Counters plus current queue depths, for the stats endpoint."""
+    depths = {
+        room_id: {uid: conn.depth for uid, conn in list(conns.items())}
+        for room_id, conns in list(room_connections.items())
+        if conns
+    }
+    all_depths = [d for room in depths.values() for d in room.values()]
+    return {
+        **queue_stats,
+        "policy": QUEUE_POLICY,
+        "max_queue": QUEUE_SIZE,
+        "connections": len(all_depths),
+        "queued_frames": sum(all_depths),
+        "max_depth": max(all_depths, default=0),
+        "rooms": depths,
+    }
@@ -0,0 +1,477 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+import itertools
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from backend import encoding
+
+try:
+    import redis.asyncio as aioredis  # type: ignore
+except Exception:
+    aioredis = None  # Optional; only required for EVENT_BUS=redis
+
+try:
+    import asyncpg  # type: ignore
+except Exception:
+    asyncpg = None  # Optional; only required for EVENT_BUS=postgres
+
+logger = logging.getLogger("main")
+
+# inprocess | local | redis | postgres
+EVENT_BUS = os.getenv("EVENT_BUS", "inprocess")
+# Channel name used by the Redis and Postgres transports
+EVENT_BUS_CHANNEL = os.getenv("EVENT_BUS_CHANNEL", "chat_events")
+# Identifies this worker on the bus; events a node published are not delivered back to it
+NODE_ID = os.getenv("NODE_ID") or uuid.uuid4().hex[:12]
+# Events buffered for publishing before new ones are dropped
+BUS_OUTBOX_LIMIT = int(os.getenv("EVENT_BUS_OUTBOX_LIMIT", "10000"))
+# Seconds between node heartbeats; a node silent for 3 heartbeats is considered gone
+BUS_HEARTBEAT = float(os.getenv("EVENT_BUS_HEARTBEAT", "5"))
+
+# Seconds to wait for the bus to hand out a message seq before numbering locally
+BUS_SEQ_TIMEOUT = float(os.getenv("EVENT_BUS_SEQ_TIMEOUT", "2"))
+
+# Longest event line the local broker transport accepts
+LOCAL_BUS_LINE_LIMIT = 16 * 1024 * 1024
+# Prefix of the local broker's seq request/reply lines, which are answered by the broker, not relayed
+LOCAL_BUS_SEQ_PREFIX = b"#seq "
+
+# Postgres NOTIFY payloads must stay under 8000 bytes; larger events are spilled to a table
+PG_NOTIFY_LIMIT = 7900
+
+# Bus bookkeeping that must reach nodes not yet known, so new peers can discover this one
+_CONTROL_KINDS = frozenset(("heartbeat", "presence_sync", "presence_snapshot", "node_down"))
+
+EventHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class EventBus:
+    """Cross-node fan-out of room, DM, typing and presence events.
+
+    `publish` never blocks: events go to an outbox drained by a sender task,
+    so a slow broker cannot stall the chat hot path. Events a node publishes
+    are not echoed back to it; callers deliver to local sockets themselves
+    and the bus only carries the event to the other nodes.
+
+    Presence (which users have live sockets on which node) is maintained by
+    the bus itself so DM routing can tell "offline" from "on another node".
+    Subclasses provide the transport via `_connect`, `_send` and `_disconnect`,
+    and a per-room message counter shared by the nodes via `next_seq`.
+    """
+
+    def __init__(self, node_id: Optional[str] = None):
+        self.node_id = node_id or NODE_ID
+        self._handler: Optional[EventHandler] = None
+        self._outbox: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._local_users: Set[str] = set()
+        # node_id -> users with live sockets on that node
+        self._node_users: Dict[str, Set[str]] = {}
+        self._node_seen: Dict[str, float] = {}
+        self.stats: Dict[str, int] = {"published": 0, "received": 0, "dropped": 0, "send_failures": 0}
+
+    async def start(self, handler: EventHandler) -> None:
+        self._handler = handler
+        self._outbox = asyncio.Queue(maxsize=BUS_OUTBOX_LIMIT)
+        await self._connect()
+        # Added to any tasks _connect started (listeners), so close() cancels them all
+        self._tasks += [asyncio.create_task(self._sender()), asyncio.create_task(self._heartbeat())]
+        # Ask peers for their presence so this node starts with a full picture
+        self.publish({"kind": "presence_sync"})
+
+    async def close(self) -> None:
+        if self._outbox is not None:
+            # Tell peers right away rather than letting them wait out the heartbeat
+            try:
+                await self._send(encoding.dumps({"kind": "node_down", "node": self.node_id}))
+            except Exception:
+                pass
+            self._outbox = None
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+        await self._disconnect()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        """Queue an event for the other nodes (dropped right away when there are none)."""
+        if self._outbox is None:
+            return
+        if event.get("kind") not in _CONTROL_KINDS and not self.has_peers():
+            return
+        try:
+            self._outbox.put_nowait({**event, "node": self.node_id})
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    # ─── Presence ───────────────────────────────────────────────────
+
+    def set_presence(self, user_id: str, online: bool) -> None:
+        if online:
+            self._local_users.add(user_id)
+        else:
+            self._local_users.discard(user_id)
+        self.publish({"kind": "presence", "user_id": user_id, "online": online})
+
+    def is_online_elsewhere(self, user_id: str) -> bool:
+        cutoff = time.monotonic() - 3 * BUS_HEARTBEAT
+        return any(
+            user_id in users and self._node_seen.get(node, 0) >= cutoff
+            for node, users in self._node_users.items()
+        )
+
+    def online_users(self) -> Set[str]:
+        """Users with a live socket anywhere in the cluster."""
+        cutoff = time.monotonic() - 3 * BUS_HEARTBEAT
+        remote = set()
+        for node, users in self._node_users.items():
+            if self._node_seen.get(node, 0) >= cutoff:
+                remote |= users
+        return remote | self._local_users
+
+    async def next_seq(self, room_id: str, floor: int = 0) -> Optional[int]:
+        """Next message seq above `floor` for the room, shared by every node, or None to number locally."""
+        return None
+
+    # ─── Transport plumbing ─────────────────────────────────────────
+
+    def has_peers(self) -> bool:
+        """Whether any other node has been heard from recently."""
+        return bool(self._node_seen)
+
+    async def _receive(self, raw: Any) -> None:
+        try:
+            event = encoding.loads(raw)
+        except Exception:
+            return
+        node = event.get("node")
+        if not node or node == self.node_id:
+            return
+        self._node_seen[node] = time.monotonic()
+        self.stats["received"] += 1
+        kind = event.get("kind")
+        if kind == "heartbeat":
+            return
+        if kind == "presence":
+            users = self._node_users.setdefault(node, set())
+            if event.get("online"):
+                users.add(event["user_id"])
+            else:
+                users.discard(event["user_id"])
+            return
+        if kind == "presence_sync":
+            self.publish({"kind": "presence_snapshot", "users": sorted(self._local_users)})
+            return
+        if kind == "presence_snapshot":
+            self._node_users[node] = set(event.get("users") or ())
+            return
+        if kind == "node_down":
+            self._node_users.pop(node, None)
+            return
+        if self._handler is not None:
+            try:
+                await self._handler(event)
+            except Exception as e:
+                logger.warning(f"Event bus handler failed for {kind}: {e}")
+
+    async def _sender(self) -> None:
+        assert self._outbox is not None
+        while True:
+            event = await self._outbox.get()
+            try:
+                await self._send(encoding.dumps(event))
+                self.stats["published"] += 1
+            except Exception as e:
+                self.stats["send_failures"] += 1
+                logger.warning(f"Event bus publish failed: {e}")
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(BUS_HEARTBEAT)
+            self.publish({"kind": "heartbeat"})
+            cutoff = time.monotonic() - 3 * BUS_HEARTBEAT
+            for node, seen in list(self._node_seen.items()):
+                if seen < cutoff:
+                    self._node_seen.pop(node, None)
+                    self._node_users.pop(node, None)
+
+    async def _connect(self) -> None:
+        pass
+
+    async def _send(self, data: str) -> None:
+        raise NotImplementedError
+
+    async def _disconnect(self) -> None:
+        pass
+
+
+class LocalHub:
+    """Connects InProcessBus instances living in the same process.
+
+    One hub per process is a single node (nothing to forward to). Sharing a
+    hub between several app instances stands in for Redis/Postgres in tests.
+    """
+
+    def __init__(self):
+        self.buses: List["InProcessBus"] = []
+
+    async def deliver(self, sender: "InProcessBus", data: str) -> None:
+        for bus in list(self.buses):
+            if bus is not sender:
+                await bus._receive(data)
+
+
+class InProcessBus(EventBus):
+    def __init__(self, hub: Optional[LocalHub] = None, node_id: Optional[str] = None):
+        # Buses sharing a hub share a process, so NODE_ID alone cannot tell them apart
+        if node_id is None and hub is not None:
+            node_id = uuid.uuid4().hex[:12]
+        super().__init__(node_id)
+        self.hub = hub or LocalHub()
+
+    def has_peers(self) -> bool:
+        return len(self.hub.buses) > 1
+
+    async def _connect(self) -> None:
+        self.hub.buses.append(self)
+
+    async def _send(self, data: str) -> None:
+        await self.hub.deliver(self, data)
+
+    async def _disconnect(self) -> None:
+        if self in self.hub.buses:
+            self.hub.buses.remove(self)
+
+
+async def open_local_stream(url: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Connect to a local broker at unix:///path or tcp://127.0.0.1:port."""
+    if url.startswith("unix://"):
+        return await asyncio.open_unix_connection(url[len("unix://"):], limit=LOCAL_BUS_LINE_LIMIT)
+    host, _, port = url[len("tcp://"):].rpartition(":")
+    return await asyncio.open_connection(host, int(port), limit=LOCAL_BUS_LINE_LIMIT)
+
+
+class LocalBrokerBus(EventBus):
+    """Newline-delimited events through the broker run by backend/cluster.py.
+
+    Used when several worker processes share one machine and there is no
+    Redis/Postgres broker; the first line sent is `<secret> <node_id>`.
+    Message seqs come from the broker's per-room counters: a
+    `#seq <request> <floor> <room_id as JSON>` line is answered to the
+    sender only with `#seq <request> <seq>`.
+    """
+
+    def __init__(self, url: str, secret: str = ""):
+        super().__init__()
+        self._url = url
+        self._secret = secret
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._seq_requests = itertools.count(1)
+        self._pending_seqs: Dict[int, asyncio.Future] = {}
+
+    async def _connect(self) -> None:
+        reader, self._writer = await open_local_stream(self._url)
+        self._writer.write(f"{self._secret} {self.node_id}\n".encode("utf-8"))
+        await self._writer.drain()
+        self._tasks.append(asyncio.create_task(self._listen(reader)))
+
+    async def _listen(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                logger.warning("Lost connection to the local event broker")
+                return
+            if line.startswith(LOCAL_BUS_SEQ_PREFIX):
+                _, request, seq = line.split()
+                future = self._pending_seqs.get(int(request))
+                if future is not None and not future.done():
+                    future.set_result(int(seq))
+                continue
+            await self._receive(line)
+
+    async def next_seq(self, room_id: str, floor: int = 0) -> Optional[int]:
+        if self._writer is None:
+            return None
+        request = next(self._seq_requests)
+        future = self._pending_seqs[request] = asyncio.get_running_loop().create_future()
+        try:
+            self._writer.write(LOCAL_BUS_SEQ_PREFIX + f"{request} {floor} {encoding.dumps(room_id)}\n".encode("utf-8"))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, BUS_SEQ_TIMEOUT)
+        finally:
+            self._pending_seqs.pop(request, None)
+
+    async def _send(self, data: str) -> None:
+        assert self._writer is not None
+        self._writer.write(data.encode("utf-8") + b"\n")
+        await self._writer.drain()
+
+    async def _disconnect(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# INCR that first raises the counter to the caller's floor, atomically
+_REDIS_NEXT_SEQ = """
+local floor = tonumber(ARGV[1])
+local seq = tonumber(redis.call('GET', KEYS[1]) or '0')
+if seq < floor then seq = floor end
+redis.call('SET', KEYS[1], seq + 1)
+return seq + 1
+"""
+
+
+class RedisBus(EventBus):
+    def __init__(self, url: str, channel: str = EVENT_BUS_CHANNEL):
+        if aioredis is None:
+            raise RuntimeError("redis is not installed; cannot use EVENT_BUS=redis")
+        super().__init__()
+        self._url = url
+        self._channel = channel
+        self._redis: Any = None
+        self._pubsub: Any = None
+
+    async def _connect(self) -> None:
+        self._redis = aioredis.from_url(self._url)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self._channel)
+        self._tasks.append(asyncio.create_task(self._listen()))
+
+    async def _listen(self) -> None:
+        async for message in self._pubsub.listen():
+            if message.get("type") == "message":
+                await self._receive(message["data"])
+
+    async def _send(self, data: str) -> None:
+        await self._redis.publish(self._channel, data)
+
+    async def next_seq(self, room_id: str, floor: int = 0) -> Optional[int]:
+        return int(await self._redis.eval(_REDIS_NEXT_SEQ, 1, f"{self._channel}:seq:{room_id}", floor))
+
+    async def _disconnect(self) -> None:
+        try:
+            if self._pubsub is not None:
+                await self._pubsub.unsubscribe(self._channel)
+                await self._pubsub.close()
+            if self._redis is not None:
+                await self._redis.close()
+        except Exception:
+            pass
+
+
+class PostgresBus(EventBus):
+    """LISTEN/NOTIFY transport; events over PG_NOTIFY_LIMIT are spilled to `bus_spill`.
+
+    Sending, spill lookups and spill cleanup run concurrently, so they draw
+    from a small pool; only LISTEN holds a dedicated connection. Notifications
+    are queued and handled by one task, in the order they arrived.
+    """
+
+    def __init__(self, dsn: str, channel: str = EVENT_BUS_CHANNEL):
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is not installed; cannot use EVENT_BUS=postgres")
+        super().__init__()
+        self._dsn = dsn
+        self._channel = channel
+        self._listen_conn: Any = None
+        self._pool: Any = None
+        self._inbox: Optional[asyncio.Queue] = None
+
+    async def _connect(self) -> None:
+        self._pool = await asyncpg.create_pool(self._dsn, min_size=1, max_size=3)
+        await self._pool.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bus_spill (
+                id BIGSERIAL PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+            """
+        )
+        self._inbox = asyncio.Queue(maxsize=BUS_OUTBOX_LIMIT)
+        self._tasks += [asyncio.create_task(self._drain_notifications()), asyncio.create_task(self._sweep_spill())]
+        self._listen_conn = await asyncpg.connect(self._dsn)
+        await self._listen_conn.add_listener(self._channel, self._on_notify)
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        if self._inbox is None:
+            return
+        try:
+            self._inbox.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    async def _drain_notifications(self) -> None:
+        assert self._inbox is not None
+        while True:
+            payload = await self._inbox.get()
+            try:
+                await self._receive_notify(payload)
+            except Exception as e:
+                logger.warning(f"Event bus notification failed: {e}")
+
+    async def _receive_notify(self, payload: str) -> None:
+        try:
+            marker = encoding.loads(payload)
+        except Exception:
+            return
+        if "spill" in marker:
+            if marker.get("node") == self.node_id:
+                return
+            payload = await self._pool.fetchval("SELECT payload FROM bus_spill WHERE id = $1", marker["spill"])
+            if payload is None:
+                return
+        await self._receive(payload)
+
+    async def _send(self, data: str) -> None:
+        async with self._pool.acquire() as conn:
+            if len(data.encode("utf-8")) > PG_NOTIFY_LIMIT:
+                spill_id = await conn.fetchval(
+                    "INSERT INTO bus_spill (payload) VALUES ($1) RETURNING id", data
+                )
+                data = encoding.dumps({"node": self.node_id, "spill": spill_id})
+            await conn.execute("SELECT pg_notify($1, $2)", self._channel, data)
+
+    async def _sweep_spill(self) -> None:
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self._pool.execute(
+                    "DELETE FROM bus_spill WHERE created_at < NOW() - INTERVAL '5 minutes'"
+                )
+            except Exception as e:
+                logger.warning(f"Event bus spill cleanup failed: {e}")
+
+    async def _disconnect(self) -> None:
+        try:
+            if self._listen_conn is not None:
+                await self._listen_conn.close()
+            if self._pool is not None:
+                await self._pool.close()
+        except Exception:
+            pass
+
+
+async def create_event_bus() -> EventBus:
+    kind = EVENT_BUS
+    if kind == "local":
+        url = os.getenv("EVENT_BUS_URL")
+        if not url:
+            raise RuntimeError("EVENT_BUS=local requires EVENT_BUS_URL (set by python -m backend.cluster)")
+        return LocalBrokerBus(url, os.getenv("EVENT_BUS_SECRET", ""))
+    if kind == "redis":
+        return RedisBus(os.getenv("EVENT_BUS_URL") or os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if kind == "postgres":
+        dsn = os.getenv("EVENT_BUS_URL") or os.getenv("DATABASE_URL")
+        if not dsn:
+            raise RuntimeError("EVENT_BUS=postgres requires EVENT_BUS_URL or DATABASE_URL")
+        return PostgresBus(dsn)
+    return InProcessBus()
@@ -0,0 +1,156 @@
+"""Run several server worker processes on one machine, with no external broker.
+
+    SERVER_WORKERS=4 python -m backend.cluster
+
+The supervisor process hosts a small event broker (a Unix socket, or
+loopback TCP where Unix sockets are unavailable) and starts uvicorn with
+SERVER_WORKERS processes sharing the listening port. Each worker connects
+to the broker with EVENT_BUS=local, so room broadcasts, typing, DMs,
+WebRTC signals and presence reach sockets on every worker no matter which
+process accepted the connection. The broker also numbers room messages, so
+every worker holds the same history whichever worker accepted a message.
+"""
+import os
+import sys
+import socket
+import asyncio
+import logging
+import secrets
+import tempfile
+import threading
+from typing import Dict, Optional
+
+from backend.bus import LOCAL_BUS_LINE_LIMIT, LOCAL_BUS_SEQ_PREFIX
+from backend import compression, encoding
+
+logger = logging.getLogger("main")
+
+# Worker processes to run; 1 runs a plain single-process server
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(os.cpu_count() or 1)))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+
+
+class LocalBroker:
+    """Relays each event line from one worker to every other worker.
+
+    Workers authenticate with `<secret> <node_id>` as their first line. When
+    a worker's connection drops (crash or restart), the broker announces
+    `node_down` for it so peers clear its presence immediately. `#seq` lines
+    are not relayed: the broker answers them from its per-room message
+    counters, so workers never hand out the same seq twice.
+    """
+
+    def __init__(self, secret: str):
+        self.secret = secret
+        self.url = ""
+        self._clients: Dict[asyncio.StreamWriter, str] = {}
+        self._seqs: Dict[str, int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, path: Optional[str] = None) -> str:
+        if path is not None and hasattr(socket, "AF_UNIX"):
+            if os.path.exists(path):
+                os.unlink(path)
+            self._server = await asyncio.start_unix_server(self._serve, path=path, limit=LOCAL_BUS_LINE_LIMIT)
+            os.chmod(path, 0o600)
+            self.url = f"unix://{path}"
+        else:
+            self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0, limit=LOCAL_BUS_LINE_LIMIT)
+            self.url = f"tcp://127.0.0.1:{self._server.sockets[0].getsockname()[1]}"
+        return self.url
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.url.startswith("unix://"):
+            try:
+                os.unlink(self.url[len("unix://"):])
+            except OSError:
+                pass
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        hello = (await reader.readline()).decode("utf-8", "replace").split()
+        if len(hello) != 2 or not secrets.compare_digest(hello[0], self.secret):
+            writer.close()
+            return
+        node = hello[1]
+        self._clients[writer] = node
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.startswith(LOCAL_BUS_SEQ_PREFIX):
+                    await self._next_seq(writer, line)
+                    continue
+                await self._relay(writer, line)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+            await self._relay(None, (encoding.dumps({"kind": "node_down", "node": node}) + "\n").encode("utf-8"))
+
+    async def _next_seq(self, writer: asyncio.StreamWriter, line: bytes) -> None:
+        request, floor, room = line[len(LOCAL_BUS_SEQ_PREFIX):].split(b" ", 2)
+        room_id = encoding.loads(room)
+        seq = self._seqs[room_id] = max(self._seqs.get(room_id, 0), int(floor)) + 1
+        writer.write(LOCAL_BUS_SEQ_PREFIX + request + b" " + str(seq).encode("ascii") + b"\n")
+        await writer.drain()
+
+    async def _relay(self, sender: Optional[asyncio.StreamWriter], line: bytes) -> None:
+        for writer in list(self._clients):
+            if writer is sender:
+                continue
+            try:
+                writer.write(line)
+                await writer.drain()
+            except Exception:
+                self._clients.pop(writer, None)
+
+
+def _run_broker(broker: LocalBroker, path: Optional[str], ready: threading.Event) -> None:
+    async def serve():
+        await broker.start(path)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def main() -> None:
+    import uvicorn  # type: ignore
+
+    workers = max(1, SERVER_WORKERS)
+    if workers == 1:
+        uvicorn.run("backend.server:app", host=HOST, port=PORT, ws=compression.websocket_protocol())
+        return
+    if not os.getenv("DATABASE_URL"):
+        print(
+            "⚠️ DATABASE_URL is not set: accounts, auth tokens, room lists and message archives are per worker; "
+            "events and recent history are shared, but set DATABASE_URL so every worker sees the same users"
+        )
+    secret = secrets.token_hex(16)
+    path = os.path.join(tempfile.gettempdir(), f"chat-bus-{os.getpid()}.sock") if hasattr(socket, "AF_UNIX") else None
+    broker = LocalBroker(secret)
+    ready = threading.Event()
+    threading.Thread(target=_run_broker, args=(broker, path, ready), daemon=True).start()
+    if not ready.wait(10):
+        sys.exit("Local event broker did not start")
+    # Inherited by the worker processes uvicorn spawns
+    os.environ["EVENT_BUS"] = "local"
+    os.environ["EVENT_BUS_URL"] = broker.url
+    os.environ["EVENT_BUS_SECRET"] = secret
+    os.environ.pop("NODE_ID", None)
+    print(f"🧩 Starting {workers} workers on {HOST}:{PORT}, event broker at {broker.url}")
+    try:
+        uvicorn.run("backend.server:app", host=HOST, port=PORT, workers=workers, ws=compression.websocket_protocol())
+    finally:
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
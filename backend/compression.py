@@ -0,0 +1,225 @@
+import os
+import gzip
+import zlib
+import asyncio
+from typing import Any, Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli  # type: ignore
+except Exception:
+    brotli = None  # Optional; responses are gzip-compressed only when missing
+
+try:
+    from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol as _UvicornWebSocketProtocol
+    from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+except Exception:
+    _UvicornWebSocketProtocol = None  # Optional; without it uvicorn keeps its own WebSocket settings
+
+# Smallest response body worth compressing; below this the saving is lost in headers and CPU
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+# gzip level (1-9) and brotli quality (0-11) for HTTP responses
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+# Bodies at least this large are compressed in a worker thread so the event loop keeps serving sockets
+COMPRESS_OFFLOAD_BYTES = int(os.getenv("COMPRESS_OFFLOAD_BYTES", str(256 * 1024)))
+# Offer permessage-deflate on WebSockets (applies when served through websocket_protocol())
+WS_DEFLATE = os.getenv("WS_DEFLATE", "1").lower() not in ("0", "false", "no")
+# LZ77 window (9-15) for both directions; each socket holds about 2**(bits+2) + 2**(mem_level+9)
+# bytes for its compressor and 2**bits for its decompressor
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", "12"))
+WS_DEFLATE_LEVEL = int(os.getenv("WS_DEFLATE_LEVEL", "6"))
+WS_DEFLATE_MEM_LEVEL = int(os.getenv("WS_DEFLATE_MEM_LEVEL", "5"))
+
+# Media types worth compressing; images, video and audio are compressed already
+_COMPRESSIBLE = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+stats = {"responses": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """"br" (when brotli is installed) or "gzip" if the client accepts it, else None."""
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.partition(";")
+        params = params.strip()
+        try:
+            weight = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            weight = 0.0
+        weights[token.strip().lower()] = weight
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if weights.get(coding, weights.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body: bytes, coding: str, gzip_level: int = GZIP_LEVEL, brotli_quality: int = BROTLI_QUALITY) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, mode=brotli.MODE_TEXT, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+class _StreamEncoder:
+    """Incremental gzip/brotli for responses sent in several body messages."""
+
+    def __init__(self, coding: str, gzip_level: int, brotli_quality: int):
+        self.brotli = coding == "br"
+        if self.brotli:
+            self._encoder = brotli.Compressor(mode=brotli.MODE_TEXT, quality=brotli_quality)
+        else:
+            self._encoder = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._encoder.process(data) if self.brotli else self._encoder.compress(data)
+
+    def finish(self) -> bytes:
+        return self._encoder.finish() if self.brotli else self._encoder.flush()
+
+
+def _compressible(status: int, headers: MutableHeaders, minimum_size: int) -> bool:
+    if status < 200 or status in (204, 206, 304):
+        return False
+    if "content-encoding" in headers or "content-range" in headers:
+        return False
+    if "no-transform" in headers.get("cache-control", ""):
+        return False
+    length = headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) < minimum_size:
+        return False
+    return headers.get("content-type", "").startswith(_COMPRESSIBLE)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing text and JSON responses with brotli or gzip.
+
+    Bodies under `minimum_size`, responses that are already encoded or
+    partial (206), and media types that are compressed already pass through
+    untouched. A response sent in one body message is compressed in one go
+    (in a worker thread from COMPRESS_OFFLOAD_BYTES up); a streamed one is
+    compressed chunk by chunk. Strong ETags become weak, since the encoded
+    bytes are a different representation.
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        minimum_size: int = COMPRESS_MIN_BYTES,
+        gzip_level: int = GZIP_LEVEL,
+        brotli_quality: int = BROTLI_QUALITY,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        coding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict[str, Any]] = None
+        encoder: Optional[_StreamEncoder] = None
+        passthrough = False
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal start, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                if start is not None:
+                    passthrough = True
+                    await send(start)
+                    start = None
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                # The first body message decides how the whole response is sent
+                first, start = start, None
+                headers = MutableHeaders(raw=first["headers"])
+                if not _compressible(first["status"], headers, self.minimum_size) or (
+                    not more_body and len(body) < self.minimum_size
+                ):
+                    passthrough = True
+                    await send(first)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = coding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    headers["ETag"] = f"W/{etag}"
+                if not more_body:
+                    compressed = await self._compress(body, coding)
+                    headers["Content-Length"] = str(len(compressed))
+                    self._count(len(body), len(compressed))
+                    await send(first)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                del headers["Content-Length"]
+                encoder = _StreamEncoder(coding, self.gzip_level, self.brotli_quality)
+                await send(first)
+                stats["responses"] += 1
+            chunk = encoder.compress(body)
+            if not more_body:
+                chunk += encoder.finish()
+            stats["bytes_in"] += len(body)
+            stats["bytes_out"] += len(chunk)
+            if chunk or not more_body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _compress(self, body: bytes, coding: str) -> bytes:
+        if len(body) >= COMPRESS_OFFLOAD_BYTES:
+            # zlib and brotli release the GIL, so sockets keep being served meanwhile
+            return await asyncio.to_thread(compress, body, coding, self.gzip_level, self.brotli_quality)
+        return compress(body, coding, self.gzip_level, self.brotli_quality)
+
+    @staticmethod
+    def _count(size_in: int, size_out: int) -> None:
+        stats["responses"] += 1
+        stats["bytes_in"] += size_in
+        stats["bytes_out"] += size_out
+
+
+def deflate_factory() -> Any:
+    """permessage-deflate offer with the WS_DEFLATE_* window, level and memory settings."""
+    return ServerPerMessageDeflateFactory(
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={"level": WS_DEFLATE_LEVEL, "memLevel": WS_DEFLATE_MEM_LEVEL},
+    )
+
+
+if _UvicornWebSocketProtocol is not None:
+
+    class DeflateWebSocketProtocol(_UvicornWebSocketProtocol):
+        """uvicorn's websockets protocol negotiating permessage-deflate with WS_DEFLATE_* settings.
+
+        uvicorn itself always offers a 15-bit window at the default memory
+        level, about 300 KiB of zlib state per socket.
+        """
+
+        def __init__(self, *args: Any, **kwargs: Any):
+            super().__init__(*args, **kwargs)
+            enabled = WS_DEFLATE and self.config.ws_per_message_deflate
+            self.available_extensions = [deflate_factory()] if enabled else []
+
+else:
+    DeflateWebSocketProtocol = None
+
+
+def websocket_protocol() -> Any:
+    """The `ws` argument for uvicorn.run: DeflateWebSocketProtocol, or uvicorn's default without websockets."""
+    return DeflateWebSocketProtocol if DeflateWebSocketProtocol is not None else "auto"
@@ -0,0 +1,65 @@
+import os
+import json
+from typing import Any, Callable
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # Optional; stdlib json is used when missing
+
+# Which JSON codec to use: auto (orjson when installed) | orjson | stdlib
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto")
+
+
+def _stdlib_dumps(obj: Any) -> str:
+    # Same settings as Starlette's send_json so frames are byte-identical
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def _orjson_dumps(obj: Any) -> str:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+
+def _stdlib_dumps_bytes(obj: Any) -> bytes:
+    return _stdlib_dumps(obj).encode("utf-8")
+
+
+def _orjson_dumps_bytes(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+dumps: Callable[[Any], str] = _stdlib_dumps
+dumps_bytes: Callable[[Any], bytes] = _stdlib_dumps_bytes
+loads: Callable[[Any], Any] = json.loads
+encoder_name = "stdlib"
+
+
+def set_encoder(name: str) -> str:
+    """Switch the process-wide JSON codec. Returns the codec actually in use."""
+    global dumps, dumps_bytes, loads, encoder_name
+    if name not in ("auto", "orjson", "stdlib"):
+        raise ValueError(f"Unknown JSON encoder {name!r}; expected auto, orjson or stdlib")
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("orjson is not installed; cannot use JSON_ENCODER=orjson")
+    if name != "stdlib" and orjson is not None:
+        dumps, dumps_bytes, loads, encoder_name = _orjson_dumps, _orjson_dumps_bytes, orjson.loads, "orjson"
+    else:
+        dumps, dumps_bytes, loads, encoder_name = _stdlib_dumps, _stdlib_dumps_bytes, json.loads, "stdlib"
+    return encoder_name
+
+
+set_encoder(JSON_ENCODER)
+
+
+def encode_frame(payload: Any) -> str:
+    """Encode a WebSocket frame once so it can be pushed to many sockets."""
+    return dumps(payload)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the configured codec."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
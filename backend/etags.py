@@ -0,0 +1,63 @@
+import os
+import time
+import uuid
+import itertools
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+# Entity versions remembered per table; an evicted entity gets a fresh version (one extra full response)
+ETAG_TABLE_SIZE = int(os.getenv("ETAG_TABLE_SIZE", "100000"))
+
+# Validators must never repeat across restarts or between workers, so each process stamps its own
+_PROCESS = uuid.uuid4().hex[:8]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against one ETag (RFC 9110 13.1.2)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+class VersionTable:
+    """Update counters per entity, used as weak ETags instead of hashing bodies.
+
+    Writers call `bump(*key)` after a change is visible to readers; readers
+    call `etag(*key)` before loading the entity, so a write racing a read
+    costs at most one extra full response, never a wrong 304. Versions come
+    from one counter shared by every key, so an entity that was evicted (or
+    never seen) can never get back a version a client already holds. With
+    `ttl`, a version is retired after that many seconds without a bump,
+    bounding how long a lost cross-worker notification can go unnoticed.
+    """
+
+    def __init__(self, size: int = ETAG_TABLE_SIZE, ttl: Optional[float] = None):
+        self.size = max(1, size)
+        self.ttl = ttl
+        self._clock = itertools.count(1)
+        # key -> (version, minted_at)
+        self._versions: "OrderedDict[Tuple[Hashable, ...], Tuple[int, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    def bump(self, *key: Hashable) -> int:
+        version = next(self._clock)
+        self._versions[key] = (version, time.monotonic())
+        self._versions.move_to_end(key)
+        if len(self._versions) > self.size:
+            self._versions.popitem(last=False)
+        return version
+
+    def version(self, *key: Hashable) -> int:
+        entry = self._versions.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[1] >= self.ttl):
+            return self.bump(*key)
+        self._versions.move_to_end(key)
+        return entry[0]
+
+    def etag(self, *key: Hashable) -> str:
+        return f'W/"{_PROCESS}-{self.version(*key)}"'
@@ -0,0 +1,115 @@
+import os
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+# Messages kept in memory per room; older ones fall off the ring buffer
+HISTORY_LIMIT = int(os.getenv("ROOM_HISTORY_LIMIT", "1000"))
+
+# Different messages offered under a seq already in use (numbered while nodes could not agree)
+stats = {"seq_collisions": 0}
+
+
+class RoomHistory:
+    """Bounded message log for one room, ordered by `seq`.
+
+    Every message carries a `seq` unique within the room, so clients can
+    page backwards with `before` or resume after a reconnect with `after`
+    instead of re-downloading the whole history. A single node numbers
+    messages itself; in a cluster they arrive numbered by the shared
+    allocator, and other nodes' messages are inserted in order, so seqs
+    always ascend but may have gaps.
+    """
+
+    def __init__(self, maxlen: int = HISTORY_LIMIT):
+        self._messages: Deque[Dict[str, Any]] = deque(maxlen=max(1, maxlen))
+        # Parallel to _messages, for bisecting by seq
+        self._seqs: Deque[int] = deque(maxlen=max(1, maxlen))
+        self.last_seq = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._messages)
+
+    @property
+    def maxlen(self) -> int:
+        return self._messages.maxlen or 0
+
+    @property
+    def first_seq(self) -> int:
+        """Sequence number of the oldest message still buffered (0 when empty)."""
+        return self._seqs[0] if self._seqs else 0
+
+    def append(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Add a new message, numbering it `last_seq + 1` unless it already has a seq.
+
+        A new message whose seq cannot be buffered (taken, or older than a
+        full buffer) is renumbered `last_seq + 1` rather than left out.
+        """
+        seq = message.get("seq")
+        if seq is not None and self.insert(message):
+            return message
+        message["seq"] = self.last_seq + 1
+        if seq is not None:
+            print(f"⚠️ Message {message.get('id')} could not take seq {seq}; renumbered {message['seq']}")
+        self.insert(message)
+        return message
+
+    def insert(self, message: Dict[str, Any]) -> bool:
+        """Add a numbered message in seq order.
+
+        Returns False when that seq is already buffered or the message is
+        older than everything a full buffer holds.
+        """
+        seq = message["seq"]
+        seqs = self._seqs
+        if not seqs or seq > seqs[-1]:
+            # The common case: the newest message; a full deque drops its oldest
+            seqs.append(seq)
+            self._messages.append(message)
+        else:
+            i = bisect_left(seqs, seq)
+            if seqs[i] == seq:
+                if self._messages[i].get("id") != message.get("id"):
+                    stats["seq_collisions"] += 1
+                return False
+            if len(seqs) == self.maxlen:
+                if i == 0:
+                    return False
+                seqs.popleft()
+                self._messages.popleft()
+                i -= 1
+            seqs.insert(i, seq)
+            self._messages.insert(i, message)
+        self.last_seq = max(self.last_seq, seq)
+        return True
+
+    def load(self, messages: List[Dict[str, Any]]) -> None:
+        """Seed the buffer from persisted messages after a restart."""
+        for message in messages:
+            self.insert(message)
+
+    def page(
+        self,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Return buffered messages with after < seq < before, oldest first.
+
+        With `after` the oldest matching messages are returned (resume);
+        otherwise the newest ones are (initial load / scroll back).
+        """
+        lo = bisect_right(self._seqs, after) if after is not None else 0
+        hi = bisect_left(self._seqs, before) if before is not None else len(self._seqs)
+        if lo >= hi:
+            return []
+        if limit is not None and hi - lo > limit:
+            if after is not None:
+                hi = lo + limit
+            else:
+                lo = hi - limit
+        return list(islice(self._messages, lo, hi))
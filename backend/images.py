@@ -0,0 +1,184 @@
+import os
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend import tracing
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except Exception:
+    Image = None  # Optional; without Pillow uploads are only kept at their original size
+
+# Processes resizing images; a separate process keeps Pillow's CPU time off the event loop's GIL
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Derivation jobs allowed in flight (running + waiting); beyond this uploads keep only the original
+IMAGE_QUEUE_LIMIT = int(os.getenv("IMAGE_QUEUE_LIMIT", "32"))
+# Encoder quality for the WebP and JPEG variants
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+# Largest source image in pixels; bigger ones are refused as likely decompression bombs
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+# Finished jobs remembered per source hash so re-uploading an image skips the work
+IMAGE_RESULT_CACHE = int(os.getenv("IMAGE_RESULT_CACHE", "1024"))
+
+# Square crops matching the frontend's AvatarUrls (types/backend.ts)
+AVATAR_SIZES = {"thumbnail": 40, "small": 80, "medium": 200, "large": 400}
+# Longest-edge bounds for gallery previews; aspect ratio kept, never upscaled
+GALLERY_SIZES = {"thumbnail": 320, "medium": 1280}
+# profile -> (sizes, square crop?)
+PROFILES = {"avatar": (AVATAR_SIZES, True), "gallery": (GALLERY_SIZES, False)}
+# (variant name, Pillow format, content type)
+FORMATS = (("webp", "WEBP", "image/webp"), ("jpeg", "JPEG", "image/jpeg"))
+
+# (size name, format name, file path, sha256, bytes)
+Variant = Tuple[str, str, str, str, int]
+
+
+class PipelineBusy(Exception):
+    """Raised when IMAGE_QUEUE_LIMIT jobs are already pending; the upload keeps its original only."""
+
+
+def render_variants(source: str, out_dir: str, profile: str, quality: int = IMAGE_QUALITY) -> List[Variant]:
+    """Resize one image into every size and format of `profile`. Runs in a worker process."""
+    sizes, square = PROFILES[profile]
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    variants: List[Variant] = []
+    with Image.open(source) as im:
+        # JPEG sources decode at a reduced scale that is still >= the largest output
+        largest = max(sizes.values())
+        im.draft("RGB", (largest, largest))
+        im = ImageOps.exif_transpose(im)
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+        im = im.convert("RGBA" if has_alpha else "RGB")
+        for name, edge in sizes.items():
+            if square:
+                resized = ImageOps.fit(im, (edge, edge), Image.LANCZOS)
+            else:
+                resized = im.copy()
+                resized.thumbnail((edge, edge), Image.LANCZOS)
+            for fmt, pil_format, _ in FORMATS:
+                out = resized
+                if pil_format == "JPEG" and out.mode == "RGBA":
+                    out = Image.new("RGB", out.size, (255, 255, 255))
+                    out.paste(resized, mask=resized.split()[-1])
+                path = os.path.join(out_dir, f"{name}.{fmt}")
+                if pil_format == "JPEG":
+                    out.save(path, pil_format, quality=quality, optimize=True, progressive=True)
+                else:
+                    out.save(path, pil_format, quality=quality, method=4)
+                with open(path, "rb") as f:
+                    data = f.read()
+                variants.append((name, fmt, path, hashlib.sha256(data).hexdigest(), len(data)))
+    return variants
+
+
+class ImagePipeline:
+    """Derives WebP/JPEG variants of uploaded images in a bounded process pool.
+
+    Jobs are keyed by (source SHA-256, profile): concurrent requests for the
+    same key share one run, and finished results are remembered so a
+    re-uploaded image costs nothing. Variants are written back to the blob
+    store, which is content-addressed, so a repeated run stores nothing new.
+    At most `workers` images are resized at once and `queue_limit` jobs may
+    be pending; beyond that `derive` raises PipelineBusy.
+    """
+
+    def __init__(
+        self,
+        workers: int = IMAGE_WORKERS,
+        queue_limit: int = IMAGE_QUEUE_LIMIT,
+        quality: int = IMAGE_QUALITY,
+        cache_size: int = IMAGE_RESULT_CACHE,
+    ):
+        self.workers = max(1, workers)
+        self.queue_limit = max(self.workers, queue_limit)
+        self.quality = quality
+        self.cache_size = max(1, cache_size)
+        self.pending = 0
+        self.stats = {"jobs": 0, "shared": 0, "cached": 0, "failed": 0, "rejected": 0}
+        self._jobs: Dict[Tuple[str, str], "asyncio.Task[Dict[str, Dict[str, str]]]"] = {}
+        self._results: "OrderedDict[Tuple[str, str], Dict[str, Dict[str, str]]]" = OrderedDict()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    async def derive(self, blob_store: Any, source_key: str, profile: str) -> Dict[str, Dict[str, str]]:
+        """Blob keys of every variant of a stored image: {size: {"webp": key, "jpeg": key}}."""
+        job = (source_key.split(".")[0], profile)
+        done = self._results.get(job)
+        if done is not None:
+            self._results.move_to_end(job)
+            self.stats["cached"] += 1
+            return done
+        running = self._jobs.get(job)
+        if running is not None:
+            self.stats["shared"] += 1
+            return await asyncio.shield(running)
+        if self.pending >= self.queue_limit:
+            self.stats["rejected"] += 1
+            raise PipelineBusy()
+        task = asyncio.ensure_future(self._run(blob_store, source_key, profile))
+        self._jobs[job] = task
+        task.add_done_callback(lambda t: self._finished(job, t))
+        # Shielded so one caller going away does not cancel the job for the others
+        return await asyncio.shield(task)
+
+    def _finished(self, job: Tuple[str, str], task: "asyncio.Task[Dict[str, Dict[str, str]]]") -> None:
+        self._jobs.pop(job, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._results[job] = task.result()
+        while len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: forking a process that runs an event loop and threads is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def _run(self, blob_store: Any, source_key: str, profile: str) -> Dict[str, Dict[str, str]]:
+        self.pending += 1
+        out_dir = tempfile.mkdtemp(prefix="img-", dir=blob_store.staging_dir())
+        source, temporary = None, False
+        try:
+            with tracing.span("image_derive", profile=profile, pending=self.pending):
+                source, temporary = await blob_store.local_copy(source_key)
+                try:
+                    variants = await asyncio.get_running_loop().run_in_executor(
+                        self._pool(), render_variants, source, out_dir, profile, self.quality
+                    )
+                except BrokenProcessPool:
+                    self._executor = None  # a worker died; start a fresh pool next time
+                    raise
+                content_types = {fmt: content_type for fmt, _, content_type in FORMATS}
+                keys: Dict[str, Dict[str, str]] = {}
+                for name, fmt, path, sha256, _ in variants:
+                    blob = await blob_store.put_file(path, content_types[fmt], sha256)
+                    keys.setdefault(name, {})[fmt] = blob["key"]
+            self.stats["jobs"] += 1
+            return keys
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.pending -= 1
+            shutil.rmtree(out_dir, ignore_errors=True)
+            if temporary and source:
+                os.remove(source)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+image_pipeline = ImagePipeline()
@@ -0,0 +1,251 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from backend import tracing
+
+logger = logging.getLogger("main")
+
+# Latency buckets in seconds, from sub-millisecond fan-outs to slow DB calls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Samples = Iterable[Tuple[Dict[str, str], float]]
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Counter:
+    """Monotonic counter. Label children are created once and reused."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], _CounterChild] = {}
+        self._default = self.labels() if not self.labelnames else None
+
+    def labels(self, *values: str) -> _CounterChild:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _CounterChild()
+        return child
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default.inc(amount)  # type: ignore[union-attr]
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {c.value}" for k, c in self._children.items()]
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram:
+    """Fixed-bucket histogram; `observe` is a bisect plus three increments."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.bounds = tuple(sorted(buckets))
+        self._children: Dict[Tuple[str, ...], _HistogramChild] = {}
+        self._default = self.labels() if not self.labelnames else None
+
+    def labels(self, *values: str) -> _HistogramChild:
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _HistogramChild(self.bounds)
+        return child
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)  # type: ignore[union-attr]
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {child.sum}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {child.count}")
+        return lines
+
+
+class Collected:
+    """A gauge or counter read from existing state at scrape time."""
+
+    def __init__(self, name: str, help: str, kind: str, collect: Callable[[], Samples]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._collect = collect
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, value in self._collect():
+            names = tuple(labels)
+            lines.append(f"{self.name}{_labels(names, tuple(labels[n] for n in names))} {value}")
+        return lines
+
+
+REGISTRY: List[Any] = []
+
+
+def register(metric: Any) -> Any:
+    REGISTRY.append(metric)
+    return metric
+
+
+def collected(name: str, help: str, kind: str = "gauge") -> Callable[[Callable[[], Samples]], Callable[[], Samples]]:
+    """Decorator registering a scrape-time collector function."""
+    def wrap(fn: Callable[[], Samples]) -> Callable[[], Samples]:
+        register(Collected(name, help, kind, fn))
+        return fn
+    return wrap
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        try:
+            samples = metric.render()
+        except Exception as e:
+            # Counted and logged so a broken collector cannot vanish from the scrape unnoticed
+            child = collector_errors.labels(metric.name)
+            if not child.value:
+                logger.warning(f"⚠️ Metric {metric.name} failed to render: {e!r}")
+            child.inc()
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# ─── Hot-path metrics ─────────────────────────────────────────────
+
+fanout_seconds = register(Histogram(
+    "chat_broadcast_fanout_seconds", "Time to queue one broadcast frame on every socket in a room"))
+messages_appended = register(Counter(
+    "chat_messages_appended_total", "Chat messages appended to room history"))
+lock_wait_seconds = register(Histogram(
+    "chat_lock_wait_seconds", "Time spent waiting to acquire a server lock", ("lock",)))
+user_store_seconds = register(Histogram(
+    "chat_user_store_seconds", "user_store call latency", ("operation",)))
+user_store_errors = register(Counter(
+    "chat_user_store_errors_total", "user_store calls that raised", ("operation",)))
+collector_errors = register(Counter(
+    "chat_metrics_collector_errors_total", "Scrapes in which a metric raised and was left out", ("metric",)))
+
+
+class TimedLock:
+    """asyncio.Lock that records how long each acquire waited."""
+
+    __slots__ = ("_lock", "_wait", "_span")
+
+    def __init__(self, name: str):
+        self._lock = asyncio.Lock()
+        self._wait = lock_wait_seconds.labels(name)
+        self._span = f"lock_wait:{name}"
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def acquire(self) -> bool:
+        start = time.perf_counter()
+        await self._lock.acquire()
+        waited = time.perf_counter() - start
+        self._wait.observe(waited)
+        tracing.record(self._span, waited)
+        return True
+
+    def release(self) -> None:
+        self._lock.release()
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self._lock.release()
+
+
+class TimedStore:
+    """Proxy recording latency and errors of every async call on a store."""
+
+    def __init__(self, store: Any):
+        self._store = store
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._store, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+        timer = user_store_seconds.labels(name)
+        errors = user_store_errors.labels(name)
+        span = f"user_store.{name}"
+
+        async def timed(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                timer.observe(elapsed)
+                tracing.record(span, elapsed)
+
+        # Cache the wrapper so later calls skip __getattr__ entirely
+        setattr(self, name, timed)
+        return timed
+
+
+def timed_store(store: Optional[Any]) -> Optional[Any]:
+    return None if store is None else TimedStore(store)
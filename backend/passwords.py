@@ -0,0 +1,108 @@
+import os
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from backend import tracing
+
+try:
+    from passlib.context import CryptContext  # type: ignore
+except Exception:
+    CryptContext = None  # Optional; falls back to sha256 (DO NOT USE IN PRODUCTION)
+
+# bcrypt cost factor (each +1 doubles hashing time)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Threads dedicated to hashing; kept separate from asyncio's default to_thread pool
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hash/verify calls allowed in flight (running + waiting) before new ones fail fast
+HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "64"))
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue is full; callers should answer 503."""
+
+
+def _build_context(rounds: int) -> Any:
+    if CryptContext is None:
+        return None
+    try:
+        ctx = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+        ctx.hash("warm-up")  # load the bcrypt backend once, not on the first login
+        return ctx
+    except Exception:
+        return None
+
+
+class PasswordHasher:
+    """Reusable CryptContext backed by a bounded, dedicated thread pool.
+
+    A burst of logins can only occupy `workers` threads and `queue_limit`
+    pending slots; beyond that `hash`/`verify` raise HasherBusy immediately
+    instead of starving other users of the default executor.
+    """
+
+    def __init__(
+        self,
+        workers: int = HASH_WORKERS,
+        queue_limit: int = HASH_QUEUE_LIMIT,
+        rounds: int = BCRYPT_ROUNDS,
+    ):
+        self.workers = max(1, workers)
+        self.queue_limit = max(self.workers, queue_limit)
+        self.rounds = rounds
+        self.pending = 0
+        self.rejected = 0
+        self._ctx: Any = None
+        self._ctx_ready = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def context(self) -> Any:
+        if not self._ctx_ready:
+            self._ctx = _build_context(self.rounds)
+            self._ctx_ready = True
+        return self._ctx
+
+    def hash_sync(self, password: str) -> str:
+        ctx = self.context
+        if ctx is not None:
+            return ctx.hash(password)
+        # Fallback: DO NOT USE IN PRODUCTION
+        return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+    def verify_sync(self, plain: str, hashed: str) -> bool:
+        ctx = self.context
+        if ctx is not None:
+            try:
+                return ctx.verify(plain, hashed)
+            except Exception:
+                pass  # not a bcrypt hash; may be a legacy sha256 digest
+        return hashlib.sha256(plain.encode("utf-8")).hexdigest() == hashed
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(self.hash_sync, password)
+
+    async def verify(self, plain: str, hashed: str) -> bool:
+        return await self._submit(self.verify_sync, plain, hashed)
+
+    async def _submit(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.queue_limit:
+            self.rejected += 1
+            raise HasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pwhash")
+        self.pending += 1
+        try:
+            with tracing.span("password_hash", pending=self.pending):
+                return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
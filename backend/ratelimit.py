@@ -0,0 +1,138 @@
+import os
+import time
+from typing import Any, Dict, Hashable, List, Tuple
+
+# Set to 0 to disable inbound rate limiting (e.g. for benchmarks)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+# Seconds between sweeps of idle buckets (only run when a new key arrives)
+RATE_LIMIT_SWEEP_INTERVAL = float(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "60"))
+
+
+def _budget(name: str, default: str) -> Tuple[float, float]:
+    """Read RATE_LIMIT_<NAME> as "<per second>/<burst>"; "off" disables it."""
+    raw = os.getenv(f"RATE_LIMIT_{name.upper()}", default).strip().lower()
+    if raw in ("off", "0", ""):
+        return 0.0, 0.0
+    rate, _, burst = raw.partition("/")
+    return float(rate), float(burst or rate)
+
+
+class RateLimiter:
+    """Token buckets for one category of inbound frames, keyed by user/room.
+
+    Each key costs two floats updated in place, so `allow` is O(1) with no
+    allocation once a key exists. A bucket idle for burst/rate seconds has
+    refilled completely and is indistinguishable from a new one, so such
+    buckets are evicted in a periodic sweep without changing any decision.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        # key -> [tokens, last_refill]
+        self._buckets: Dict[Hashable, List[float]] = {}
+        self._next_sweep = 0.0
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return RATE_LIMIT_ENABLED and self.rate > 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key: Hashable) -> bool:
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            self._buckets[key] = [self.burst - 1, now]
+            self.allowed += 1
+            return True
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            self.allowed += 1
+            return True
+        bucket[0] = tokens
+        self.rejected += 1
+        return False
+
+    def refund(self, key: Hashable) -> None:
+        """Return the token the last `allow(key)` took, when the request was refused elsewhere."""
+        bucket = self._buckets.get(key)
+        if bucket is None or not self.enabled:
+            return
+        bucket[0] = min(self.burst, bucket[0] + 1)
+        self.allowed -= 1
+
+    def retry_after(self, key: Hashable) -> float:
+        """Seconds until `key` has a token again."""
+        bucket = self._buckets.get(key)
+        if bucket is None or not self.enabled:
+            return 0.0
+        return max(0.0, (1 - bucket[0]) / self.rate)
+
+    def _sweep(self, now: float) -> None:
+        self._next_sweep = now + RATE_LIMIT_SWEEP_INTERVAL
+        refill = self.burst / self.rate
+        idle = [key for key, (_, last) in self._buckets.items() if now - last >= refill]
+        for key in idle:
+            del self._buckets[key]
+        self.evicted += len(idle)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "enabled": self.enabled,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+            "buckets": len(self._buckets),
+        }
+
+
+# Chat messages per user in a room, and per room across all senders
+chat_user_limiter = RateLimiter("chat_user", *_budget("chat_user", "5/10"))
+chat_room_limiter = RateLimiter("chat_room", *_budget("chat_room", "50/100"))
+# profile_updated / avatar_updated rebroadcasts per user
+profile_limiter = RateLimiter("profile", *_budget("profile", "1/3"))
+# WebRTC signals per user in a room (ICE candidates arrive in bursts)
+webrtc_limiter = RateLimiter("webrtc", *_budget("webrtc", "50/200"))
+# dm_message / dm_read frames per user
+dm_limiter = RateLimiter("dm", *_budget("dm", "5/20"))
+# typing_start / typing_stop / dm_typing frames per user
+typing_limiter = RateLimiter("typing", *_budget("typing", "10/20"))
+
+LIMITERS = (chat_user_limiter, chat_room_limiter, profile_limiter, webrtc_limiter, dm_limiter, typing_limiter)
+
+
+def allow_chat(room_id: str, user_id: str) -> bool:
+    """A chat message must fit both the sender's and the room's budget.
+
+    Only an accepted message is charged: when the room is over budget the
+    sender's token is refunded, so a busy room does not drain their own.
+    """
+    key = (room_id, user_id)
+    if not chat_user_limiter.allow(key):
+        return False
+    if not chat_room_limiter.allow(room_id):
+        chat_user_limiter.refund(key)
+        return False
+    return True
+
+
+def chat_retry_after(room_id: str, user_id: str) -> float:
+    return max(chat_user_limiter.retry_after((room_id, user_id)), chat_room_limiter.retry_after(room_id))
+
+
+def rate_limit_snapshot() -> Dict[str, Any]:
+    return {limiter.name: limiter.snapshot() for limiter in LIMITERS}
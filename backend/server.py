@@ -1,16 +1,18 @@
 import os
+import time
 import asyncio
 import uuid
 import logging
+import mimetypes
 from datetime import datetime
-from typing import Dict, Any, Set, Optional
+from typing import AsyncIterator, Dict, Any, Set, Optional, Tuple
 
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Query, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect, Query, UploadFile, File, Form, Header
 
 logger = logging.getLogger("main")
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, RedirectResponse, Response
 from pydantic import BaseModel
-import json as _json
 
 try:
     # Prefer dynamic CORS when available in repo
@@ -19,6 +21,37 @@ try:
 except Exception:
     USE_DYNAMIC_CORS = False
 
+from backend import compression, encoding, metrics, tracing
+from backend.blobs import (
+    BLOB_CHUNK_SIZE,
+    CACHE_CONTROL,
+    BlobStore,
+    BlobTooLarge,
+    LocalBlobStore,
+    UnsupportedMediaType,
+    create_blob_store,
+    valid_key,
+)
+from backend.broadcast import Connection, fan_out, deliver, drop_failed, queue_snapshot, queue_stats as outbound_queue_stats
+from backend.bus import EventBus, InProcessBus, create_event_bus
+from backend.etags import VersionTable, etag_matches
+from backend.history import HISTORY_LIMIT, RoomHistory, stats as history_stats
+from backend.images import AVATAR_SIZES, PipelineBusy, image_pipeline
+from backend.metrics import TimedLock, fanout_seconds, messages_appended, timed_store
+from backend.passwords import HasherBusy, password_hasher
+from backend.ratelimit import (
+    LIMITERS,
+    allow_chat,
+    chat_retry_after,
+    dm_limiter,
+    profile_limiter,
+    rate_limit_snapshot,
+    typing_limiter,
+    webrtc_limiter,
+)
+from backend.tokens import TokenStore
+from backend.typing_indicators import TypingAggregator
+
 
 class JoinRoomRequest(BaseModel):
     user_id: str
@@ -49,40 +82,510 @@ class CreateUserRequest(BaseModel):
 
 
 # In-memory store (replace with Redis/DB for production)
+# room_id -> {name, users, messages: RoomHistory, lock, ...}
 rooms: Dict[str, Dict[str, Any]] = {}
-# room_id -> { user_id -> WebSocket }
-room_connections: Dict[str, Dict[str, WebSocket]] = {}
+# room_id -> { user_id -> Connection } (WebSocket + bounded outbound queue)
+room_connections: Dict[str, Dict[str, Connection]] = {}
 # room_id -> { user_id -> {username, started_at} } - track active broadcasters
 active_broadcasters: Dict[str, Dict[str, Dict[str, Any]]] = {}
-rooms_lock = asyncio.Lock()
+# Guards adding/removing entries in `rooms`; per-room state is guarded by room["lock"]
+rooms_registry_lock = TimedLock("rooms_registry")
 
-# DM user connections: user_id -> WebSocket (for delivering DMs to the right user)
-dm_connections: Dict[str, WebSocket] = {}
-dm_connections_lock = asyncio.Lock()
+# user_id -> every live Connection of that user across rooms, the DM socket and
+# extra tabs; lets DMs, read receipts and DM typing reach a user in O(1)
+user_connections: Dict[str, Set[Connection]] = {}
 
 # Minimal in-memory user directory for profile/password updates
 users: Dict[str, Dict[str, Any]] = {}
-users_lock = asyncio.Lock()
+# lower(username) -> user_id, kept in step with `users` under users_lock
+usernames: Dict[str, str] = {}
+users_lock = TimedLock("users")
 
-# Pluggable user storage (in-memory or Postgres)
+# Pluggable user and message storage (in-memory or Postgres)
 try:
-    from backend.storage import create_user_store  # type: ignore
+    from backend.storage import (  # type: ignore
+        create_user_store,
+        cached_user_store,
+        InMemoryUserStore,
+        create_message_store,
+        create_token_backend,
+        create_dm_store,
+        conversation_key,
+        UsernameTakenError,
+        USER_CACHE_TTL,
+    )
 except Exception:
     create_user_store = None
+    USER_CACHE_TTL = None
+    InMemoryUserStore = None
+    create_message_store = None
+    create_token_backend = None
+    create_dm_store = None
+
+    def conversation_key(user_a: str, user_b: str) -> str:
+        return "-".join(sorted((user_a, user_b)))
+
+    class UsernameTakenError(Exception):
+        pass
 user_store = None
+message_store = None
+dm_store = None
+
+# Weak ETags for polled reads, from per-entity update counters bumped after every write.
+# Users can change on another worker, so their versions expire like the user cache does
+user_versions = VersionTable(ttl=USER_CACHE_TTL)
+# ("rooms",) for the room list, ("messages", room_id) for a room's history and member avatars
+room_versions = VersionTable()
+
+
+def _index_username(user_id: str, new_username: Optional[str], old_username: Optional[str] = None) -> None:
+    """Point lower(new_username) at user_id. Caller holds users_lock."""
+    if old_username and usernames.get(old_username.lower()) == user_id:
+        del usernames[old_username.lower()]
+    if new_username:
+        usernames[new_username.lower()] = user_id
+
+
+async def _release_username(username: str, user_id: str) -> None:
+    async with users_lock:
+        if usernames.get(username.lower()) == user_id:
+            del usernames[username.lower()]
+
+
+async def _find_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    """Case-insensitive O(1) lookup via the username index.
+
+    Users created by another process (or before a restart) are fetched from
+    user_store by its lower(username) index and cached locally.
+    """
+    async with users_lock:
+        user_id = usernames.get(username.lower())
+        if user_id is not None and user_id in users:
+            return users[user_id]
+    if user_store is None or not hasattr(user_store, "get_user_by_username"):
+        return None
+    try:
+        stored = await user_store.get_user_by_username(username)
+    except Exception as e:
+        print(f"⚠️ DB get_user_by_username failed: {e}")
+        return None
+    if not stored or not stored.get("id"):
+        return None
+    async with users_lock:
+        cached = users.setdefault(stored["id"], stored)
+        _index_username(stored["id"], cached.get("username"))
+        return cached
+
+
+# Bearer tokens with expiry; swapped for a DB-backed store on startup when configured
+token_store = TokenStore()
+
+# Uploaded media, content-addressed (see BLOB_BACKEND); replaced on startup
+blob_store: BlobStore = LocalBlobStore()
+
+# Carries room/DM/typing/presence events to other server nodes (see EVENT_BUS);
+# replaced on startup, a lone in-process bus until then
+event_bus: EventBus = InProcessBus()
+
+
+def _deliver_room_local(
+    room_id: str,
+    payload: Dict[str, Any],
+    exclude: Optional[str] = None,
+    coalesce_key: Optional[str] = None,
+) -> None:
+    conns = room_connections.get(room_id)
+    if not conns:
+        return
+    start = time.perf_counter()
+    failed = fan_out(conns, payload, exclude=exclude, coalesce_key=coalesce_key)
+    drop_failed(conns, failed)
+    elapsed = time.perf_counter() - start
+    fanout_seconds.observe(elapsed)
+    tracing.record("fanout", elapsed)
+
+
+async def _broadcast_room(
+    room_id: str,
+    payload: Dict[str, Any],
+    exclude: Optional[str] = None,
+    coalesce_key: Optional[str] = None,
+    history: bool = False,
+) -> None:
+    """Queue a payload on every socket in a room, on this node and the others.
+
+    With `history`, the payload is a new chat message that the other nodes
+    also add to their copy of the room's history.
+    """
+    _deliver_room_local(room_id, payload, exclude, coalesce_key)
+    event_bus.publish({
+        "kind": "room",
+        "room_id": room_id,
+        "payload": payload,
+        "exclude": exclude,
+        "coalesce_key": coalesce_key,
+        "history": history,
+    })
+
+
+def _new_room(**fields: Any) -> Dict[str, Any]:
+    return {"users": {}, "messages": RoomHistory(), "lock": TimedLock("room"), **fields}
+
+
+async def _ensure_room(room_id: str) -> Dict[str, Any]:
+    """Return a room's state, creating it on first use.
+
+    Only creation takes the registry lock. A room created after a restart
+    is seeded with its recent history from the message store (while its
+    own lock is held) so sequence numbers continue where they left off.
+    """
+    room = rooms.get(room_id)
+    if room is not None:
+        return room
+    async with rooms_registry_lock:
+        room = rooms.get(room_id)
+        if room is not None:
+            return room
+        room = _new_room()
+        # Uncontended, so this never yields while the registry lock is held
+        await room["lock"].acquire()
+        rooms[room_id] = room
+    try:
+        if message_store is not None:
+            try:
+                room["messages"].load(await message_store.load_recent(room_id, HISTORY_LIMIT))
+            except Exception as e:
+                print(f"⚠️ Loading history for room {room_id} failed: {e}")
+    finally:
+        room["lock"].release()
+    room_versions.bump("rooms")
+    room_versions.bump("messages", room_id)
+    return room
+
+
+async def _next_seq(room_id: str, floor: int) -> Optional[int]:
+    """Allocate a new message's seq from the counter the live nodes share.
+
+    None means RoomHistory numbers the message: a node without live peers
+    never waits on the shared counter, and `floor` (the room's newest local
+    seq) keeps the counter ahead of what it numbered alone. The message
+    store's counter wins when it has one (Postgres), then the event bus's.
+    If the shared counter is unreachable the message is numbered locally
+    rather than refused.
+    """
+    if not event_bus.has_peers():
+        return None
+    try:
+        seq = await message_store.next_seq(room_id, floor) if message_store is not None else None
+        if seq is None:
+            seq = await event_bus.next_seq(room_id, floor)
+        return seq
+    except Exception as e:
+        print(f"⚠️ Seq allocation for room {room_id} failed, numbering locally: {e!r}")
+        return None
+
+
+async def _insert_remote_message(room_id: str, message: Dict[str, Any]) -> None:
+    """Add a message another node accepted to this node's copy of the room history."""
+    room = await _ensure_room(room_id)
+    async with room["lock"]:
+        inserted = room["messages"].insert(message)
+        if inserted:
+            room_versions.bump("messages", room_id)
+    # A per-process archive would otherwise miss every other node's messages
+    if inserted and message_store is not None and not message_store.shared:
+        await message_store.append(message)
+
+
+async def _persist_message(message: Dict[str, Any]) -> None:
+    """Hand a message to the write-behind store (buffered, never blocks on I/O)."""
+    messages_appended.inc()
+    if message_store is not None:
+        await message_store.append(message)
+
+
+def _register_connection(room_id: str, conn: Connection) -> None:
+    room_connections.setdefault(room_id, {})[conn.user_id] = conn
+    mine = user_connections.setdefault(conn.user_id, set())
+    mine.add(conn)
+    if len(mine) == 1:
+        event_bus.set_presence(conn.user_id, True)
+
+
+def _forget_connection(room_id: str, conn: Connection) -> None:
+    """Unregister a connection once its writer has shut down."""
+    conns = room_connections.get(room_id, {})
+    if conns.get(conn.user_id) is conn:
+        del conns[conn.user_id]
+    mine = user_connections.get(conn.user_id)
+    if mine is not None:
+        mine.discard(conn)
+        if not mine:
+            del user_connections[conn.user_id]
+            event_bus.set_presence(conn.user_id, False)
+
+
+def _send_to_user(user_id: str, payload: Dict[str, Any], coalesce_key: Optional[str] = None) -> bool:
+    """Queue a payload on every live socket of a user, on any node.
+
+    Returns False only when the user has no live socket anywhere.
+    """
+    local = deliver(user_connections.get(user_id, ()), payload, coalesce_key)
+    if event_bus.is_online_elsewhere(user_id):
+        event_bus.publish({"kind": "user", "user_id": user_id, "payload": payload, "coalesce_key": coalesce_key})
+        return True
+    return local > 0
+
+
+def _send_in_room(room_id: str, user_id: str, payload: Dict[str, Any]) -> None:
+    """Queue a payload on one user's socket in a room, wherever it is connected."""
+    target_conn = room_connections.get(room_id, {}).get(user_id)
+    if target_conn is not None:
+        target_conn.send_json(payload)
+    elif event_bus.is_online_elsewhere(user_id):
+        event_bus.publish({"kind": "room_user", "room_id": room_id, "user_id": user_id, "payload": payload})
+
+
+def _emit_room_typing(room_id: str, frame: Dict[str, Any]) -> None:
+    # Every node aggregates the full typer set, so frames go to local sockets only
+    _deliver_room_local(room_id, frame, coalesce_key="typing")
+
 
+def _emit_dm_typing(receiver_id: str, sender_id: str, is_typing: bool) -> None:
+    _send_to_user(receiver_id, {
+        "type": "dm_typing",
+        "sender_id": sender_id,
+        "is_typing": is_typing,
+        "timestamp": datetime.utcnow().isoformat(),
+    }, coalesce_key=f"dm_typing:{sender_id}")
 
-# Simple token store (in-memory; replace with JWT/Redis in production)
-tokens: Dict[str, str] = {}  # token -> user_id
+
+# Debounces typing_start/typing_stop and emits one batched "typing" frame per room per interval
+typing_aggregator = TypingAggregator(_emit_room_typing, _emit_dm_typing)
+
+
+def _set_room_typing(room_id: str, user_id: str, username: str, is_typing: bool) -> None:
+    if typing_aggregator.update(room_id, user_id, username, is_typing):
+        _publish_room_typing(room_id, user_id, username, is_typing)
+
+
+def _publish_room_typing(room_id: str, user_id: str, username: str, is_typing: bool) -> None:
+    event_bus.publish({
+        "kind": "typing",
+        "room_id": room_id,
+        "user_id": user_id,
+        "username": username,
+        "is_typing": is_typing,
+    })
+
+
+async def _on_bus_event(event: Dict[str, Any]) -> None:
+    """Deliver an event published by another node to this node's sockets."""
+    kind = event.get("kind")
+    payload = event.get("payload")
+    if kind == "room":
+        if event.get("history"):
+            await _insert_remote_message(event["room_id"], dict(payload))
+        _deliver_room_local(event["room_id"], payload, event.get("exclude"), event.get("coalesce_key"))
+    elif kind == "user":
+        deliver(user_connections.get(event["user_id"], ()), payload, event.get("coalesce_key"))
+    elif kind == "room_user":
+        target_conn = room_connections.get(event["room_id"], {}).get(event["user_id"])
+        if target_conn is not None:
+            target_conn.send_json(payload)
+    elif kind == "typing":
+        typing_aggregator.update(event["room_id"], event["user_id"], event.get("username") or "Anonymous", bool(event.get("is_typing")))
+    elif kind == "user_cache":
+        kinds = event.get("kinds") or ("user", "theme", "gallery")
+        if hasattr(user_store, "invalidate"):
+            user_store.invalidate(event["user_id"], kinds)
+        _user_changed(event["user_id"], *kinds)
+
+
+def _publish_user_invalidation(user_id: str, kinds: Tuple[str, ...]) -> None:
+    """Tell other nodes to drop their cached copies of a user's profile/theme/gallery."""
+    event_bus.publish({"kind": "user_cache", "user_id": user_id, "kinds": list(kinds)})
+
+
+def _user_changed(user_id: str, *kinds: str) -> None:
+    """Retire the ETags of a user's profile/theme/gallery after a write."""
+    for kind in kinds:
+        user_versions.bump(kind, user_id)
+
+
+async def _flush_mailbox(conn: Connection) -> None:
+    """Send DMs that arrived while the user was offline as a single dm_batch frame."""
+    if dm_store is None:
+        return
+    try:
+        pending = await dm_store.drain(conn.user_id)
+    except Exception as e:
+        print(f"⚠️ DM mailbox drain failed for {conn.user_id}: {e}")
+        return
+    if not pending:
+        return
+    if conn.send_json({"type": "dm_batch", "messages": pending}):
+        logger.info(f"📬 Delivered {len(pending)} queued DMs to {conn.user_id}")
+    else:
+        await dm_store.requeue(conn.user_id, pending)
 
 router = APIRouter()
 
 
+def _hasher_busy_error() -> HTTPException:
+    """503 for when the password-hashing queue is full; clients should retry."""
+    return HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+
+
+# Polled JSON reads may be kept by the client but are revalidated with If-None-Match before each use
+REVALIDATE = "private, no-cache"
+conditional_stats = {"not_modified": 0, "full": 0}
+
+
+def _conditional(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Stamp `response` with `etag`, or return a 304 when the client already holds that version.
+
+    Take the ETag before loading the entity: a write landing in between
+    then costs one extra full response instead of a stale 304.
+    """
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        conditional_stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    conditional_stats["full"] += 1
+    response.headers.update(headers)
+    return None
+
+
+def _rate_limited(ptype: Optional[str], room_id: str, user_id: str, payload: Dict[str, Any]) -> Optional[float]:
+    """Charge an inbound WebSocket frame to its token bucket.
+
+    Returns None when the frame may proceed, otherwise seconds to wait.
+    """
+    if ptype == "typing_stop" or (ptype == "dm_typing" and not payload.get("is_typing")):
+        # Stops only ever shrink typing state; dropping one leaves the user "typing" until the TTL
+        return None
+    if ptype in ("typing_start", "dm_typing"):
+        limiter, key = typing_limiter, user_id
+    elif ptype in ("profile_updated", "avatar_updated"):
+        limiter, key = profile_limiter, user_id
+    elif ptype == "webrtc-signal":
+        limiter, key = webrtc_limiter, (room_id, user_id)
+    elif ptype in ("dm_message", "dm_read"):
+        limiter, key = dm_limiter, user_id
+    elif ptype in ("keep_alive", "broadcast-started", "broadcast-stopped") or not payload.get("content"):
+        return None
+    else:
+        return None if allow_chat(room_id, user_id) else chat_retry_after(room_id, user_id)
+    return None if limiter.allow(key) else limiter.retry_after(key)
+
+
 @router.get("/")
 async def root():
     return {"status": "ok", "time": datetime.utcnow().isoformat()}
 
 
+@router.get("/stats/queues")
+async def queue_stats():
+    """Outbound queue depth and eviction counters for all live sockets."""
+    return queue_snapshot(room_connections)
+
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text exposition of hot-path counters and histograms."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@metrics.collected("chat_connections", "Live WebSocket connections per room")
+def _collect_connections():
+    return [({"room": room_id}, len(conns)) for room_id, conns in list(room_connections.items()) if conns]
+
+
+@metrics.collected("chat_history_seq_collisions_total", "Messages offered under a seq another message already holds", "counter")
+def _collect_seq_collisions():
+    return [({}, history_stats["seq_collisions"])]
+
+
+@metrics.collected("chat_socket_events_total", "Outbound queue events (enqueued, dropped, coalesced, evictions, send_failures)", "counter")
+def _collect_queue_events():
+    return [({"event": name}, value) for name, value in outbound_queue_stats.items()]
+
+
+@metrics.collected("chat_password_hash_pending", "Password hash/verify calls running or queued")
+def _collect_hash_pending():
+    return [({}, password_hasher.pending)]
+
+
+@metrics.collected("chat_password_hash_rejected_total", "Hash/verify calls rejected because the queue was full", "counter")
+def _collect_hash_rejected():
+    return [({}, password_hasher.rejected)]
+
+
+@metrics.collected("chat_ratelimit_rejected_total", "Inbound frames rejected by rate limiting", "counter")
+def _collect_ratelimit_rejected():
+    return [({"category": limiter.name}, limiter.rejected) for limiter in LIMITERS]
+
+
+@metrics.collected("chat_event_bus_total", "Event bus counters (published, received, dropped, send_failures)", "counter")
+def _collect_bus():
+    return [({"event": name}, value) for name, value in event_bus.stats.items()]
+
+
+@metrics.collected("chat_token_cache_lookups_total", "Auth token cache lookups", "counter")
+def _collect_token_cache():
+    return [({"result": "hit"}, token_store.hits), ({"result": "miss"}, token_store.misses)]
+
+
+@metrics.collected("chat_blob_uploads_total", "Media upload counters (uploads, deduplicated, bytes, rejected)", "counter")
+def _collect_blobs():
+    return [({"event": name}, value) for name, value in blob_store.stats.items()]
+
+
+@metrics.collected("chat_image_jobs_total", "Image derivation jobs (jobs, shared, cached, failed, rejected)", "counter")
+def _collect_image_jobs():
+    return [({"event": name}, value) for name, value in image_pipeline.stats.items()]
+
+
+@metrics.collected("chat_image_jobs_pending", "Image derivation jobs running or queued")
+def _collect_image_pending():
+    return [({}, image_pipeline.pending)]
+
+
+@metrics.collected("chat_http_conditional_total", "ETag-validated reads answered (not_modified, full)", "counter")
+def _collect_conditional():
+    return [({"result": name}, value) for name, value in conditional_stats.items()]
+
+
+@metrics.collected("chat_http_compression_total", "Compressed HTTP responses and their bytes before/after (responses, bytes_in, bytes_out)", "counter")
+def _collect_compression():
+    return [({"event": name}, value) for name, value in compression.stats.items()]
+
+
+@metrics.collected("chat_user_cache_total", "User profile cache counters (hits, misses, invalidations, evictions)", "counter")
+def _collect_user_cache():
+    stats = getattr(user_store, "stats", None)
+    return [({"event": name}, value) for name, value in stats.items()] if stats else []
+
+
+@router.get("/stats/ratelimit")
+async def ratelimit_stats():
+    """Token-bucket budgets plus allowed/rejected counters per frame category."""
+    return rate_limit_snapshot()
+
+
+@router.get("/stats/bus")
+async def bus_stats():
+    """This node's id, event bus counters and cluster-wide presence count."""
+    return {
+        "node": event_bus.node_id,
+        "bus": type(event_bus).__name__,
+        **event_bus.stats,
+        "local_users": len(user_connections),
+        "online_users": len(event_bus.online_users()),
+    }
+
+
 # ─── Auth Endpoints ───────────────────────────────────────────────────
 
 @router.post("/auth/signup")
@@ -96,17 +599,27 @@ async def auth_signup(payload: SignupRequest):
     if len(payload.password) < 6:
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
 
-    # Check if username already taken
+    # Check if username already taken, then reserve it before the slow hash
+    # so two concurrent signups for the same name cannot both succeed
+    if await _find_user_by_username(username) is not None:
+        raise HTTPException(status_code=409, detail="Username already registered")
+    user_id = str(uuid.uuid4())
     async with users_lock:
-        for uid, u in users.items():
-            if u.get("username", "").lower() == username.lower():
-                raise HTTPException(status_code=409, detail="Username already registered")
+        if username.lower() in usernames:
+            raise HTTPException(status_code=409, detail="Username already registered")
+        _index_username(user_id, username)
 
-    user_id = str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
 
     # Hash password
-    hashed = await asyncio.to_thread(_hash_password, payload.password)
+    try:
+        hashed = await password_hasher.hash(payload.password)
+    except HasherBusy:
+        await _release_username(username, user_id)
+        raise _hasher_busy_error()
+    except Exception:
+        await _release_username(username, user_id)
+        raise
 
     user_data = {
         "id": user_id,
@@ -120,11 +633,22 @@ async def auth_signup(payload: SignupRequest):
         "created_at": now,
     }
 
+    # Persist so other workers (and restarts) can find the account
+    if user_store is not None:
+        try:
+            await user_store.upsert_profile(user_id, user_data)
+            await user_store.set_password_hash(user_id, hashed)
+        except UsernameTakenError:
+            await _release_username(username, user_id)
+            raise HTTPException(status_code=409, detail="Username already registered")
+        except Exception as e:
+            print(f"⚠️ DB signup write failed, account kept in memory only: {e}")
+
     async with users_lock:
         users[user_id] = user_data
+    _user_changed(user_id, "user")
 
-    token = str(uuid.uuid4())
-    tokens[token] = user_id
+    token = await token_store.issue(user_id)
 
     # Return user without password_hash
     safe_user = {k: v for k, v in user_data.items() if k != "password_hash"}
@@ -138,50 +662,54 @@ async def auth_login(payload: LoginRequest):
     if not username:
         raise HTTPException(status_code=400, detail="Username is required")
 
-    matched_user: Optional[Dict[str, Any]] = None
-    async with users_lock:
-        for uid, u in users.items():
-            if u.get("username", "").lower() == username.lower():
-                matched_user = u
-                break
-
+    matched_user = await _find_user_by_username(username)
     if not matched_user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
     # Verify password
     stored_hash = matched_user.get("password_hash", "")
-    ok = await asyncio.to_thread(_verify_password, payload.password, stored_hash)
+    try:
+        ok = await password_hasher.verify(payload.password, stored_hash)
+    except HasherBusy:
+        raise _hasher_busy_error()
     if not ok:
         raise HTTPException(status_code=401, detail="Invalid username or password")
 
-    token = str(uuid.uuid4())
-    tokens[token] = matched_user["id"]
+    token = await token_store.issue(matched_user["id"])
 
     safe_user = {k: v for k, v in matched_user.items() if k != "password_hash"}
     return {"user": safe_user, "token": token}
 
 
 @router.post("/auth/logout")
-async def auth_logout():
-    """Logout (no-op for token-based auth; client discards token)."""
+async def auth_logout(authorization: Optional[str] = Header(None)):
+    """Logout: revoke the Bearer token if one is sent."""
+    if authorization:
+        token = authorization.replace("Bearer ", "").strip()
+        await token_store.revoke(token)
     return {"success": True}
 
 
 @router.get("/auth/me")
-async def auth_me(authorization: Optional[str] = None):
+async def auth_me(authorization: Optional[str] = Header(None)):
     """Return the currently authenticated user from Bearer token."""
-    from fastapi import Request as _Req
-    # We'll get the header from a dependency; for simplicity parse it here
     if not authorization:
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = authorization.replace("Bearer ", "").strip()
-    user_id = tokens.get(token)
+    user_id = await token_store.resolve(token)
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     async with users_lock:
         user_data = users.get(user_id)
+    if not user_data and user_store is not None:
+        # Token issued by another worker or before a restart
+        try:
+            user_data = await user_store.get_user(user_id)
+        except Exception as e:
+            print(f"⚠️ DB get_user failed: {e}")
     if not user_data:
         raise HTTPException(status_code=404, detail="User not found")
+    user_data = {**user_data, "id": user_data.get("id", user_id)}
     safe_user = {k: v for k, v in user_data.items() if k != "password_hash"}
     return safe_user
 
@@ -196,11 +724,10 @@ async def create_user(payload: CreateUserRequest):
         raise HTTPException(status_code=400, detail="Username is required")
 
     # Check if already exists
-    async with users_lock:
-        for uid, u in users.items():
-            if u.get("username", "").lower() == username.lower():
-                # Return existing user
-                return {k: v for k, v in u.items() if k != "password_hash"}
+    existing = await _find_user_by_username(username)
+    if existing is not None:
+        # Return existing user
+        return {k: v for k, v in existing.items() if k != "password_hash"}
 
     user_id = str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
@@ -215,24 +742,39 @@ async def create_user(payload: CreateUserRequest):
         "created_at": now,
     }
     async with users_lock:
+        # Lost a race with a concurrent create for the same name
+        if username.lower() in usernames and usernames[username.lower()] in users:
+            existing = users[usernames[username.lower()]]
+            return {k: v for k, v in existing.items() if k != "password_hash"}
         users[user_id] = user_data
+        _index_username(user_id, username)
+
+    if user_store is not None:
+        try:
+            await user_store.upsert_profile(user_id, user_data)
+        except Exception as e:
+            print(f"⚠️ DB create_user write failed, user kept in memory only: {e}")
+    _user_changed(user_id, "user")
 
     return user_data
 
 
 @router.get("/rooms")
-async def list_rooms():
+async def list_rooms(request: Request, response: Response):
     """Return all active rooms."""
+    not_modified = _conditional(request, response, room_versions.etag("rooms"))
+    if not_modified is not None:
+        return not_modified
     result = []
-    async with rooms_lock:
-        for room_id, room_data in rooms.items():
-            result.append({
-                "id": room_id,
-                "name": room_data.get("name", room_id),
-                "created_at": room_data.get("created_at", datetime.utcnow().isoformat()),
-                "member_count": len(room_data.get("users", {})),
-                "thumbnail_url": room_data.get("thumbnail_url"),
-            })
+    # Snapshot without locking: nothing below awaits, so no room can change mid-loop
+    for room_id, room_data in list(rooms.items()):
+        result.append({
+            "id": room_id,
+            "name": room_data.get("name", room_id),
+            "created_at": room_data.get("created_at", datetime.utcnow().isoformat()),
+            "member_count": len(room_data.get("users", {})),
+            "thumbnail_url": room_data.get("thumbnail_url"),
+        })
     return result
 
 
@@ -245,22 +787,24 @@ async def create_room(payload: Dict[str, Any]):
 
     room_id = str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
-    room_data = {
-        "name": name,
-        "users": {},
-        "messages": [],
-        "created_at": now,
-        "thumbnail_url": payload.get("thumbnail_url"),
-    }
-    async with rooms_lock:
+    room_data = _new_room(
+        name=name,
+        created_at=now,
+        thumbnail_url=payload.get("thumbnail_url"),
+    )
+    async with rooms_registry_lock:
         rooms[room_id] = room_data
+    room_versions.bump("rooms")
 
     return {"id": room_id, "name": name, "created_at": now, "thumbnail_url": room_data.get("thumbnail_url")}
 
 
 @router.get("/users/{user_id}")
-async def get_user(user_id: str):
+async def get_user(user_id: str, request: Request, response: Response):
     """Return user profile data from storage for verification."""
+    not_modified = _conditional(request, response, user_versions.etag("user", user_id))
+    if not_modified is not None:
+        return not_modified
     try:
         if user_store is not None:
             profile = await user_store.get_user(user_id)
@@ -289,17 +833,36 @@ async def update_profile(user_id: str, payload: Dict[str, Any]):
         if payload.get("display_name") and not payload.get("username"):
             payload["username"] = payload["display_name"]
 
+        new_username = (payload.get("username") or "").strip() or None
+        if new_username:
+            payload["username"] = new_username
+            async with users_lock:
+                owner = usernames.get(new_username.lower())
+            if owner is not None and owner != user_id:
+                raise HTTPException(status_code=409, detail="Username already taken")
+
         # Persist via storage (DB when configured)
         profile: Dict[str, Any]
         if user_store is not None:
-            profile = await user_store.upsert_profile(user_id, payload)
-        else:
-            async with users_lock:
-                profile = users.get(user_id, {})
+            try:
+                profile = await user_store.upsert_profile(user_id, payload)
+            except UsernameTakenError:
+                raise HTTPException(status_code=409, detail="Username already taken")
+        async with users_lock:
+            cached = users.get(user_id)
+            old_username = cached.get("username") if cached else None
+            if user_store is None or cached is not None:
+                # Keep the local directory (used by login and /auth/me) in step
+                local = cached if cached is not None else {}
                 for key in ("display_name", "username", "bio", "email", "avatar_url", "avatar_urls"):
                     if key in payload and payload[key] is not None:
-                        profile[key] = payload[key]
-                users[user_id] = profile
+                        local[key] = payload[key]
+                users[user_id] = local
+                if user_store is None:
+                    profile = local
+            if new_username:
+                _index_username(user_id, new_username, old_username)
+        _user_changed(user_id, "user")
 
         # Broadcast to room subscribers for instant sync
         broadcast_payload = {
@@ -311,22 +874,12 @@ async def update_profile(user_id: str, payload: Dict[str, Any]):
             "avatar_url": profile.get("avatar_url"),
             "timestamp": datetime.utcnow().isoformat(),
         }
-        for room_id, room in rooms.items():
-            if user_id in room.get("users", {}):
-                for ws in list(room_connections.get(room_id, {}).values()):
-                    try:
-                        await ws.send_json(broadcast_payload)
-                    except Exception:
-                        # remove broken connections
-                        try:
-                            for uid, w in list(room_connections.get(room_id, {}).items()):
-                                if w is ws:
-                                    del room_connections[room_id][uid]
-                                    break
-                        except Exception:
-                            pass
+        member_rooms = [rid for rid, room in list(rooms.items()) if user_id in room.get("users", {})]
+        await asyncio.gather(*(_broadcast_room(rid, broadcast_payload) for rid in member_rooms))
 
         return {"success": True, "user": profile}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -340,7 +893,10 @@ async def update_password(user_id: str, payload: Dict[str, Any]):
             raise HTTPException(status_code=400, detail="Password must be at least 8 characters")
 
         # Hash password off the event loop
-        hashed: str = await asyncio.to_thread(_hash_password, new_password)
+        try:
+            hashed: str = await password_hasher.hash(new_password)
+        except HasherBusy:
+            raise _hasher_busy_error()
 
         if user_store is not None:
             await user_store.set_password_hash(user_id, hashed)
@@ -349,6 +905,7 @@ async def update_password(user_id: str, payload: Dict[str, Any]):
                 profile = users.get(user_id, {})
                 profile["password_hash"] = hashed
                 users[user_id] = profile
+        _user_changed(user_id, "user")
 
         return {"success": True}
     except HTTPException:
@@ -364,8 +921,11 @@ user_themes: Dict[str, Dict[str, Any]] = {}
 
 
 @router.get("/users/{user_id}/theme")
-async def get_theme(user_id: str):
+async def get_theme(user_id: str, request: Request, response: Response):
     """Return the saved theme config for a user from DB (or memory fallback)."""
+    not_modified = _conditional(request, response, user_versions.etag("theme", user_id))
+    if not_modified is not None:
+        return not_modified
     theme_config = None
     if user_store is not None:
         try:
@@ -373,6 +933,8 @@ async def get_theme(user_id: str):
         except Exception as e:
             print(f"⚠️ DB get_theme failed, falling back to memory: {e}")
             theme_config = user_themes.get(user_id, {}).get("theme_config")
+            del response.headers["ETag"]
+            response.headers["Cache-Control"] = "no-store"
     else:
         stored = user_themes.get(user_id)
         theme_config = stored.get("theme_config") if stored else None
@@ -394,51 +956,157 @@ async def update_theme(user_id: str, payload: Dict[str, Any]):
             user_themes[user_id] = {"theme_config": theme_config}
     else:
         user_themes[user_id] = {"theme_config": theme_config}
+    # get_user returns the theme too
+    _user_changed(user_id, "user", "theme")
     return {"success": True, "theme_config": theme_config}
 
 
 # ─── Gallery / Media Endpoints ────────────────────────────────────────
 
-# In-memory fallback (used only when user_store is None)
-user_galleries: Dict[str, list] = {}
+# Largest page a gallery listing returns
+GALLERY_PAGE_MAX = 200
+
+# In-memory fallback (used only when user_store is None or a DB call fails)
+user_galleries = InMemoryUserStore() if InMemoryUserStore is not None else None
+
+
+async def _gallery_op(op: str, user_id: str, *args: Any) -> Any:
+    """Run a per-item gallery operation on user_store, falling back to memory."""
+    result = await _gallery_store_op(op, user_id, *args)
+    if op != "get_gallery":
+        _user_changed(user_id, "gallery")
+    return result
 
 
-async def _load_gallery(user_id: str) -> list:
-    """Load gallery from DB or memory."""
+async def _gallery_store_op(op: str, user_id: str, *args: Any) -> Any:
     if user_store is not None:
         try:
-            return await user_store.get_gallery(user_id)
+            return await getattr(user_store, op)(user_id, *args)
         except Exception as e:
-            print(f"⚠️ DB get_gallery failed: {e}")
-    return user_galleries.get(user_id, [])
+            print(f"⚠️ DB {op} failed, falling back to memory: {e}")
+    if user_galleries is None:
+        raise HTTPException(status_code=503, detail="Gallery storage unavailable")
+    return await getattr(user_galleries, op)(user_id, *args)
 
 
-async def _save_gallery(user_id: str, items: list) -> None:
-    """Persist gallery to DB or memory."""
-    if user_store is not None:
-        try:
-            await user_store.set_gallery(user_id, items)
+async def _upload_chunks(upload: UploadFile) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(BLOB_CHUNK_SIZE)
+        if not chunk:
             return
-        except Exception as e:
-            print(f"⚠️ DB set_gallery failed, falling back to memory: {e}")
-    user_galleries[user_id] = items
+        yield chunk
+
+
+async def _store_blob(chunks: AsyncIterator[bytes], content_type: str) -> Dict[str, Any]:
+    try:
+        return await blob_store.put_stream(chunks, content_type)
+    except BlobTooLarge:
+        raise HTTPException(status_code=413, detail=f"File larger than {blob_store.max_bytes} bytes")
+    except UnsupportedMediaType as e:
+        raise HTTPException(status_code=415, detail=f"Unsupported media type: {e}")
+
+
+def _blob_item(request: Request, user_id: str, blob: Dict[str, Any], caption: str, filename: Optional[str], now: str) -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "url": blob_store.url(blob["key"], str(request.base_url)),
+        "caption": caption,
+        "created_at": now,
+        "blob_key": blob["key"],
+        "content_type": blob["content_type"],
+        "size": blob["size"],
+        "filename": filename,
+    }
+
+
+# Background derivation tasks, referenced until they finish
+_derive_tasks: Set[asyncio.Task] = set()
+
+
+def _derive_later(coro: Any) -> None:
+    task = asyncio.create_task(coro)
+    _derive_tasks.add(task)
+    task.add_done_callback(_derive_tasks.discard)
+
+
+async def _derive(source_key: str, profile: str, base_url: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """URLs of an image's resized variants ({size: {"webp": url, "jpeg": url}}), or None."""
+    try:
+        keys = await image_pipeline.derive(blob_store, source_key, profile)
+    except PipelineBusy:
+        print(f"⚠️ Image pipeline busy, {source_key} keeps its original size only")
+        return None
+    except Exception as e:
+        print(f"⚠️ Image derivation failed for {source_key}: {e}")
+        return None
+    return {
+        size: {fmt: blob_store.url(key, base_url) for fmt, key in by_format.items()}
+        for size, by_format in keys.items()
+    }
+
+
+async def _attach_gallery_variants(user_id: str, item_id: str, source_key: str, base_url: str) -> None:
+    variants = await _derive(source_key, "gallery", base_url)
+    if variants is None:
+        return
+    try:
+        await _gallery_op("update_gallery_item", user_id, item_id, {
+            "variants": variants,
+            "thumbnail_url": variants["thumbnail"]["webp"],
+        })
+    except Exception as e:
+        print(f"⚠️ Could not attach variants to gallery item {item_id}: {e}")
+
+
+def _schedule_gallery_variants(request: Request, user_id: str, items: list) -> None:
+    if not image_pipeline.enabled:
+        return
+    for item in items:
+        if item.get("blob_key") and item["content_type"].startswith("image/"):
+            _derive_later(_attach_gallery_variants(user_id, item["id"], item["blob_key"], str(request.base_url)))
 
 
 @router.get("/users/{user_id}/media")
-async def list_gallery(user_id: str):
-    """List all gallery items for a user."""
-    items = await _load_gallery(user_id)
-    return {"user_id": user_id, "items": items}
+async def list_gallery(
+    user_id: str,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = None,
+    after: Optional[int] = None,
+):
+    """List a user's gallery items in display order.
+
+    With `limit`, returns one page; pass the returned `next_cursor` as
+    `after` to fetch the next one.
+    """
+    if limit is not None:
+        if limit < 1:
+            raise HTTPException(status_code=400, detail="limit must be positive")
+        limit = min(limit, GALLERY_PAGE_MAX)
+    not_modified = _conditional(request, response, user_versions.etag("gallery", user_id))
+    if not_modified is not None:
+        return not_modified
+    items = await _gallery_op("get_gallery", user_id, after, limit)
+    next_cursor = items[-1]["position"] if limit is not None and len(items) == limit else None
+    return {"user_id": user_id, "items": items, "next_cursor": next_cursor}
 
 
 # Also support /gallery alias
 @router.get("/users/{user_id}/gallery")
-async def list_gallery_alias(user_id: str):
-    return await list_gallery(user_id)
+async def list_gallery_alias(
+    user_id: str,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = None,
+    after: Optional[int] = None,
+):
+    return await list_gallery(user_id, request, response, limit, after)
 
 
 @router.post("/users/{user_id}/media")
 async def add_gallery_item(
+    request: Request,
     user_id: str,
     files: list[UploadFile] = File(default=[]),
     caption: str = Form(default=""),
@@ -452,19 +1120,11 @@ async def add_gallery_item(
     new_items = []
     now = datetime.utcnow().isoformat()
 
-    # Handle uploaded files (store to disk/CDN — placeholder stores nothing yet)
+    # Uploaded files are streamed (from Starlette's spooled temp file) into the blob store
     for f in files:
-        item_id = str(uuid.uuid4())
-        # TODO: Replace with actual CDN upload (Bunny.net, S3, etc.)
-        # For now just record the filename — the real URL would come from CDN
-        item = {
-            "id": item_id,
-            "user_id": user_id,
-            "url": url or f"https://placeholder.cdn/{user_id}/{item_id}/{f.filename}",
-            "caption": caption,
-            "created_at": now,
-        }
-        new_items.append(item)
+        content_type = f.content_type or mimetypes.guess_type(f.filename or "")[0] or ""
+        blob = await _store_blob(_upload_chunks(f), content_type)
+        new_items.append(_blob_item(request, user_id, blob, caption, f.filename, now))
 
     # Handle bare URL (JSON-style creation)
     if not files and url:
@@ -478,30 +1138,84 @@ async def add_gallery_item(
         }
         new_items.append(item)
 
-    all_items = await _load_gallery(user_id)
-    all_items.extend(new_items)
-    await _save_gallery(user_id, all_items)
+    if new_items:
+        await _gallery_op("add_gallery_items", user_id, new_items)
+        _schedule_gallery_variants(request, user_id, new_items)
+    all_items = await _gallery_op("get_gallery", user_id, None, None)
     return {"user_id": user_id, "items": all_items}
 
 
 # Also support /gallery alias
 @router.post("/users/{user_id}/gallery")
 async def add_gallery_item_alias(
+    request: Request,
     user_id: str,
     files: list[UploadFile] = File(default=[]),
     caption: str = Form(default=""),
     username: str = Form(default=""),
     url: str = Form(default=""),
 ):
-    return await add_gallery_item(user_id, files, caption, username, url)
+    return await add_gallery_item(request, user_id, files, caption, username, url)
+
+
+@router.post("/users/{user_id}/media/upload")
+async def upload_gallery_item(request: Request, user_id: str, caption: str = "", filename: Optional[str] = None):
+    """Add one gallery item from a raw (non-multipart) request body.
+
+    The body goes straight from the socket to blob storage chunk by chunk,
+    skipping the multipart parser's temp-file copy. Content-Type must be
+    the file's media type.
+    """
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > blob_store.max_bytes:
+        raise HTTPException(status_code=413, detail=f"File larger than {blob_store.max_bytes} bytes")
+    blob = await _store_blob(request.stream(), request.headers.get("content-type", ""))
+    item = _blob_item(request, user_id, blob, caption, filename, datetime.utcnow().isoformat())
+    await _gallery_op("add_gallery_items", user_id, [item])
+    _schedule_gallery_variants(request, user_id, [item])
+    all_items = await _gallery_op("get_gallery", user_id, None, None)
+    return {"user_id": user_id, "items": all_items}
+
+
+@router.api_route("/media/{key}", methods=["GET", "HEAD"])
+async def get_media(key: str, request: Request):
+    """Serve an uploaded blob with Range support and its content hash as a strong ETag."""
+    if not valid_key(key):
+        raise HTTPException(status_code=404, detail="Not found")
+    path = blob_store.path(key)
+    if path is None:
+        # Remote backends serve their own bytes (and ranges) from the bucket/CDN
+        return RedirectResponse(blob_store.url(key), status_code=307)
+    etag = f'"{key.split(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "X-Content-Type-Options": "nosniff"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(path, media_type=mimetypes.guess_type(key)[0] or "application/octet-stream", headers=headers)
+
+
+# Registered before /{item_id} so "order" is not taken for an item id
+@router.put("/users/{user_id}/media/order")
+async def update_gallery_order(user_id: str, payload: Dict[str, Any]):
+    """Reorder gallery items by ID list."""
+    ids = payload.get("ids", [])
+    if not isinstance(ids, list):
+        raise HTTPException(status_code=400, detail="ids must be an array")
+    # Listed items first, then any items not in the list in their current order
+    ordered = await _gallery_op("reorder_gallery", user_id, ids)
+    return {"user_id": user_id, "items": ordered}
+
+
+@router.put("/users/{user_id}/gallery/order")
+async def update_gallery_order_alias(user_id: str, payload: Dict[str, Any]):
+    return await update_gallery_order(user_id, payload)
 
 
 @router.delete("/users/{user_id}/media/{item_id}")
 async def delete_gallery_item(user_id: str, item_id: str):
     """Delete a gallery item."""
-    items = await _load_gallery(user_id)
-    items = [i for i in items if i.get("id") != item_id]
-    await _save_gallery(user_id, items)
+    await _gallery_op("delete_gallery_item", user_id, item_id)
     return {"success": True, "ok": True}
 
 
@@ -513,18 +1227,16 @@ async def delete_gallery_item_alias(user_id: str, item_id: str):
 @router.put("/users/{user_id}/media/{item_id}")
 async def update_gallery_item(user_id: str, item_id: str, payload: Dict[str, Any]):
     """Update a gallery item (caption, etc.)."""
-    items = await _load_gallery(user_id)
-    for item in items:
-        if item.get("id") == item_id:
-            # Accept both 'caption' and 'title' for backwards compat
-            if "caption" in payload:
-                item["caption"] = payload["caption"]
-            if "title" in payload:
-                item["caption"] = payload["title"]
-            item.update({k: v for k, v in payload.items() if k not in ("id", "user_id", "caption", "title")})
-            await _save_gallery(user_id, items)
-            return item
-    raise HTTPException(status_code=404, detail="Gallery item not found")
+    updates = {k: v for k, v in payload.items() if k not in ("id", "user_id", "caption", "title", "position", "created_at")}
+    # Accept both 'caption' and 'title' for backwards compat
+    if "caption" in payload:
+        updates["caption"] = payload["caption"]
+    if "title" in payload:
+        updates["caption"] = payload["title"]
+    item = await _gallery_op("update_gallery_item", user_id, item_id, updates)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Gallery item not found")
+    return item
 
 
 @router.put("/users/{user_id}/gallery/{item_id}")
@@ -532,62 +1244,94 @@ async def update_gallery_item_alias(user_id: str, item_id: str, payload: Dict[st
     return await update_gallery_item(user_id, item_id, payload)
 
 
-@router.put("/users/{user_id}/media/order")
-async def update_gallery_order(user_id: str, payload: Dict[str, Any]):
-    """Reorder gallery items by ID list."""
-    ids = payload.get("ids", [])
-    if not isinstance(ids, list):
-        raise HTTPException(status_code=400, detail="ids must be an array")
-    items = await _load_gallery(user_id)
-    id_map = {item["id"]: item for item in items}
-    ordered = [id_map[i] for i in ids if i in id_map]
-    # Append any items not in the list at the end
-    remaining = [item for item in items if item["id"] not in set(ids)]
-    ordered.extend(remaining)
-    await _save_gallery(user_id, ordered)
-    return {"user_id": user_id, "items": ordered}
+# ─── Avatar Upload ────────────────────────────────────────────────────
 
-
-@router.put("/users/{user_id}/gallery/order")
-async def update_gallery_order_alias(user_id: str, payload: Dict[str, Any]):
-    return await update_gallery_order(user_id, payload)
+# Multipart fields read by the avatar upload, largest first; the frontend
+# sends its own resized copies as thumbnail/small/medium/large
+AVATAR_FIELDS = ("file", "avatar", "large", "medium", "small", "thumbnail")
 
 
-def _hash_password(password: str) -> str:
-    """Synchronous helper used with asyncio.to_thread for hashing."""
+async def _apply_avatar_variants(user_id: str, source_key: str, base_url: str) -> None:
+    """Swap avatar_urls to the pipeline's WebP (and `<size>_jpeg`) variants once derived."""
+    variants = await _derive(source_key, "avatar", base_url)
+    if variants is None:
+        return
     try:
-        from passlib.context import CryptContext
-        ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
-        return ctx.hash(password)
-    except Exception:
-        # Fallback: DO NOT USE IN PRODUCTION
-        import hashlib
-        return hashlib.sha256(password.encode("utf-8")).hexdigest()
+        if user_store is not None:
+            profile = await user_store.get_user(user_id)
+        else:
+            async with users_lock:
+                profile = dict(users.get(user_id) or {})
+        if (profile.get("avatar_urls") or {}).get("source_key") != source_key:
+            return  # replaced by a newer avatar while this one was being resized
+        avatar_urls: Dict[str, Any] = {"source_key": source_key}
+        for size, by_format in variants.items():
+            avatar_urls[size] = by_format["webp"]
+            avatar_urls[f"{size}_jpeg"] = by_format["jpeg"]
+        await update_profile(user_id, {"avatar_url": avatar_urls["medium"], "avatar_urls": avatar_urls})
+    except Exception as e:
+        print(f"⚠️ Could not apply avatar variants for {user_id}: {e}")
 
 
-def _verify_password(plain: str, hashed: str) -> bool:
-    """Synchronous helper used with asyncio.to_thread for verification."""
-    try:
-        from passlib.context import CryptContext
-        ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
-        return ctx.verify(plain, hashed)
-    except Exception:
-        import hashlib
-        return hashlib.sha256(plain.encode("utf-8")).hexdigest() == hashed
+@router.api_route("/users/{user_id}/avatar", methods=["PUT", "POST"])
+async def upload_avatar(request: Request, user_id: str):
+    """Store an uploaded avatar and return its avatar_urls.
+
+    Sizes the client did not send point at the largest image it did send
+    until the image pipeline has derived WebP/JPEG variants; those then
+    replace avatar_urls and go out as a profile_updated broadcast.
+    """
+    form = await request.form()
+    uploads = [(name, form[name]) for name in AVATAR_FIELDS if name in form and not isinstance(form[name], str)]
+    if not uploads:
+        raise HTTPException(status_code=400, detail=f"Expected an image in one of: {', '.join(AVATAR_FIELDS)}")
+    stored: Dict[str, Dict[str, Any]] = {}
+    for name, upload in uploads:
+        content_type = upload.content_type or mimetypes.guess_type(upload.filename or "")[0] or ""
+        if not content_type.startswith("image/"):
+            raise HTTPException(status_code=415, detail=f"Avatar must be an image, got {content_type or 'unknown'}")
+        stored[name] = await _store_blob(_upload_chunks(upload), content_type)
+
+    base_url = str(request.base_url)
+    source = stored[uploads[0][0]]
+    avatar_urls: Dict[str, Any] = {
+        size: blob_store.url(stored.get(size, source)["key"], base_url) for size in AVATAR_SIZES
+    }
+    avatar_urls["source_key"] = source["key"]
+    await update_profile(user_id, {"avatar_url": avatar_urls["medium"], "avatar_urls": avatar_urls})
+    if image_pipeline.enabled:
+        _derive_later(_apply_avatar_variants(user_id, source["key"], base_url))
+
+    total = sum(blob["size"] for blob in stored.values())
+    return {
+        "success": True,
+        "avatar_urls": avatar_urls,
+        "avatar_url": avatar_urls["medium"],
+        "total_size_mb": round(total / (1024 * 1024), 3),
+        "filename": source["key"],
+        "size_mb": round(source["size"] / (1024 * 1024), 3),
+        "message": "Avatar uploaded",
+    }
+
+
+@router.post("/avatars/upload/{user_id}")
+async def upload_avatar_alias(request: Request, user_id: str):
+    return await upload_avatar(request, user_id)
 
 
 @router.post("/rooms/{room_id}/join")
 async def join_room(room_id: str, request: JoinRoomRequest):
     """Register a user in a room before WebSocket connection."""
     try:
-        async with rooms_lock:
-            if room_id not in rooms:
-                rooms[room_id] = {"users": {}, "messages": []}
-            rooms[room_id]["users"][request.user_id] = {
+        room = await _ensure_room(room_id)
+        async with room["lock"]:
+            room["users"][request.user_id] = {
                 "username": request.username or "Anonymous",
                 "avatar_url": request.avatar_url,
                 "joined_at": datetime.utcnow(),
             }
+            room_versions.bump("rooms")
+            room_versions.bump("messages", room_id)
         return {"status": "success", "room_id": room_id, "user_id": request.user_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -596,16 +1340,18 @@ async def join_room(room_id: str, request: JoinRoomRequest):
 @router.post("/rooms/{room_id}/messages")
 async def send_message(room_id: str, message: MessageCreate):
     """Store message with avatar URL and broadcast to WebSocket clients."""
-    async with rooms_lock:
-        if room_id not in rooms:
-            rooms[room_id] = {"users": {}, "messages": []}
-
+    if not allow_chat(room_id, message.user_id):
+        retry = chat_retry_after(room_id, message.user_id)
+        raise HTTPException(status_code=429, detail="Too many messages", headers={"Retry-After": str(max(1, round(retry)))})
+    room = await _ensure_room(room_id)
+    seq = await _next_seq(room_id, room["messages"].last_seq)
+    async with room["lock"]:
         avatar_url = None
-        if message.user_id in rooms[room_id]["users"]:
-            avatar_url = rooms[room_id]["users"][message.user_id].get("avatar_url")
+        if message.user_id in room["users"]:
+            avatar_url = room["users"][message.user_id].get("avatar_url")
 
         username = message.username or (
-            rooms[room_id]["users"].get(message.user_id, {}).get("username") or "Anonymous"
+            room["users"].get(message.user_id, {}).get("username") or "Anonymous"
         )
 
         new_message = {
@@ -617,41 +1363,116 @@ async def send_message(room_id: str, message: MessageCreate):
             "avatar": avatar_url,
             "timestamp": datetime.utcnow().isoformat(),
             "type": message.type or "message",
+            "seq": seq,
         }
 
-        rooms[room_id]["messages"].append(new_message)
+        room["messages"].append(new_message)
+        room_versions.bump("messages", room_id)
+
+    await _persist_message(new_message)
 
     # Broadcast to connected clients (non-blocking best-effort)
-    for ws in list(room_connections.get(room_id, {}).values()):
-        try:
-            await ws.send_json({"type": "message", **new_message})
-        except Exception:
-            # Drop broken connections
-            try:
-                for uid, w in list(room_connections.get(room_id, {}).items()):
-                    if w is ws:
-                        del room_connections[room_id][uid]
-                        break
-            except Exception:
-                pass
+    await _broadcast_room(room_id, {"type": "message", **new_message}, history=True)
 
     return new_message
 
 
 @router.get("/rooms/{room_id}/messages")
-async def get_messages(room_id: str):
-    """Return messages with avatars."""
-    async with rooms_lock:
-        if room_id not in rooms:
+async def get_messages(
+    room_id: str,
+    request: Request,
+    response: Response,
+    before: Optional[int] = Query(None, ge=1, description="Only messages with seq < before"),
+    after: Optional[int] = Query(None, ge=0, description="Only messages with seq > after"),
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_LIMIT),
+):
+    """Return messages with avatars, oldest first.
+
+    Each message carries a monotonic `seq`; pass `after=<last seen seq>` to
+    resume, or `before=<oldest seq>` to page back through history.
+    """
+    not_modified = _conditional(request, response, room_versions.etag("messages", room_id))
+    if not_modified is not None:
+        return not_modified
+    room = rooms.get(room_id)
+    if room is None:
+        if message_store is None:
             return []
-        messages = rooms[room_id]["messages"]
-        # Ensure avatars are present when possible
-        for msg in messages:
-            if not msg.get("avatar"):
-                uid = msg.get("user_id")
-                if uid and uid in rooms[room_id]["users"]:
-                    msg["avatar"] = rooms[room_id]["users"][uid].get("avatar_url")
+        # Not warmed since the restart; its history is still in the message store
+        room = await _ensure_room(room_id)
+    async with room["lock"]:
+        history = room["messages"]
+        messages = history.page(before=before, after=after, limit=limit)
+        past_tail = before is not None and after is None and before <= history.first_seq
+    # Only paging back past the in-memory tail reaches the message store
+    if past_tail and message_store is not None:
+        try:
+            messages = await message_store.fetch_before(room_id, before, limit or HISTORY_LIMIT)
+        except Exception as e:
+            print(f"⚠️ DB fetch_before failed: {e}")
+            # This partial page must not be revalidated as if it were the real one
+            del response.headers["ETag"]
+            response.headers["Cache-Control"] = "no-store"
+    members = room["users"]
+    avatars = {
+        msg["user_id"]: members[msg["user_id"]].get("avatar_url")
+        for msg in messages
+        if not msg.get("avatar") and msg.get("user_id") in members
+    }
+    # Fill missing avatars on copies so stored messages stay untouched
+    if not avatars:
         return messages
+    return [
+        {**msg, "avatar": avatars[msg["user_id"]]} if msg.get("user_id") in avatars else msg
+        for msg in messages
+    ]
+
+
+async def _bearer_user(authorization: Optional[str]) -> str:
+    """Resolve an `Authorization: Bearer` header to its user id, or raise 401."""
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    user_id = await token_store.resolve(authorization.replace("Bearer ", "").strip())
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return user_id
+
+
+def _in_conversation(conversation_id: str, user_id: str) -> bool:
+    """Whether `user_id` is one of the two users `conversation_id` was built from."""
+    if conversation_id.startswith(f"{user_id}-"):
+        other = conversation_id[len(user_id) + 1:]
+    elif conversation_id.endswith(f"-{user_id}"):
+        other = conversation_id[: -len(user_id) - 1]
+    else:
+        return False
+    return conversation_key(user_id, other) == conversation_id
+
+
+@router.get("/conversations/{conversation_id}/messages")
+async def get_direct_messages(
+    conversation_id: str,
+    before: Optional[int] = Query(None, ge=1, description="Only messages with seq < before"),
+    limit: int = Query(50, ge=1, le=200),
+    authorization: Optional[str] = Header(None),
+):
+    """Return a page of DM history, oldest first.
+
+    `conversation_id` is the two user ids sorted and joined with "-". Pass
+    `next_before` from the previous page as `before` to load older messages.
+    Only the two participants may read it (Bearer token required).
+    """
+    user_id = await _bearer_user(authorization)
+    if not _in_conversation(conversation_id, user_id):
+        raise HTTPException(status_code=403, detail="Not a participant in this conversation")
+    if dm_store is None:
+        return {"conversation_id": conversation_id, "messages": [], "next_before": None}
+    try:
+        messages = await dm_store.history(conversation_id, before=before, limit=limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    next_before = messages[0]["seq"] if len(messages) == limit else None
+    return {"conversation_id": conversation_id, "messages": messages, "next_before": next_before}
 
 
 class LiveStreamCreate(BaseModel):
@@ -704,7 +1525,7 @@ async def create_video_upload(room_id: str, payload: VideoUploadCreate):
     }
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=encoding.FastJSONResponse)
 
 # CORS setup
 if USE_DYNAMIC_CORS:
@@ -731,6 +1552,13 @@ else:
         allow_headers=["*"]
     )
 
+# gzip/brotli for JSON and text bodies of at least COMPRESS_MIN_BYTES (history pages, galleries)
+app.add_middleware(compression.CompressionMiddleware)
+
+# Sampled request tracing (TRACE_SAMPLE_RATE); not installed at all when off
+if tracing.enabled():
+    app.add_middleware(tracing.TracingMiddleware)
+
 app.include_router(router)
 
 
@@ -743,50 +1571,42 @@ async def websocket_endpoint(
     avatar_url: Optional[str] = Query(None),
 ):
     # Auto-register user if not present
-    async with rooms_lock:
-        if room_id not in rooms:
-            rooms[room_id] = {"users": {}, "messages": []}
-        if user_id not in rooms[room_id]["users"]:
-            rooms[room_id]["users"][user_id] = {
+    room = await _ensure_room(room_id)
+    async with room["lock"]:
+        if user_id not in room["users"]:
+            room["users"][user_id] = {
                 "username": username or "Anonymous",
                 "avatar_url": avatar_url,
                 "joined_at": datetime.utcnow(),
             }
+            room_versions.bump("rooms")
+            room_versions.bump("messages", room_id)
 
     await websocket.accept()
 
-    # Track DM connection for direct message delivery
-    if room_id == "dm":
-        async with dm_connections_lock:
-            dm_connections[user_id] = websocket
-            logger.info(f"📱 DM connection registered for user {user_id}")
+    # Every outbound frame goes through this connection's queue and writer task
+    conn = Connection(websocket, user_id, on_close=lambda c: _forget_connection(room_id, c))
+    conn.start()
 
-    # Track connection mapped to user
-    room_connections.setdefault(room_id, {})[user_id] = websocket
+    # Track connection in its room and in the per-user index (used for DM delivery)
+    _register_connection(room_id, conn)
+    if room_id == "dm":
+        logger.info(f"📱 DM connection registered for user {user_id}")
 
     # Notify join
     try:
-        for uid, ws in list(room_connections.get(room_id, {}).items()):
-            if uid == user_id:
-                continue
-            try:
-                await ws.send_json({
-                    "type": "user_joined",
-                    "room_id": room_id,
-                    "user_id": user_id,
-                    "username": username or "Anonymous",
-                    "avatar_url": avatar_url,
-                    "timestamp": datetime.utcnow().isoformat(),
-                })
-            except Exception:
-                try:
-                    del room_connections[room_id][uid]
-                except Exception:
-                    pass
+        await _broadcast_room(room_id, {
+            "type": "user_joined",
+            "room_id": room_id,
+            "user_id": user_id,
+            "username": username or "Anonymous",
+            "avatar_url": avatar_url,
+            "timestamp": datetime.utcnow().isoformat(),
+        }, exclude=user_id)
 
         # Send current room users to the newly joined client (seed present users)
         try:
-            await websocket.send_json({
+            conn.send_json({
                 "type": "room_state",
                 "room_id": room_id,
                 "users": [
@@ -795,7 +1615,7 @@ async def websocket_endpoint(
                         "username": info.get("username"),
                         "avatar_url": info.get("avatar_url"),
                     }
-                    for uid, info in rooms[room_id]["users"].items()
+                    for uid, info in room["users"].items()
                 ],
                 "timestamp": datetime.utcnow().isoformat(),
             })
@@ -806,7 +1626,7 @@ async def websocket_endpoint(
         room_broadcasters = active_broadcasters.get(room_id, {})
         if room_broadcasters:
             try:
-                await websocket.send_json({
+                conn.send_json({
                     "type": "active-broadcasts",
                     "room_id": room_id,
                     "broadcasters": [
@@ -822,37 +1642,56 @@ async def websocket_endpoint(
             except Exception:
                 pass
 
+        # Store-and-forward: DMs that arrived while this user was offline are handed
+        # over once the socket proves it belongs to that user (see the "auth" frame)
+        mailbox_flushed = False
+
         # Receive loop
         while True:
             data = await websocket.receive_text()
+            # Sampled frames record per-stage spans; None (and free) otherwise
+            trace = tracing.start("ws.frame")
             # Expect JSON payloads
             try:
                 # Minimal parsing; accept keep_alive, typing events, messages, and WebRTC signaling
-                import json
-                payload = json.loads(data)
+                payload = encoding.loads(data)
                 ptype = payload.get("type")
+                if trace is not None:
+                    tracing.lap("parse")
+                    trace.attrs.update(room_id=room_id, user_id=user_id, type=ptype, bytes=len(data))
 
                 if ptype == "keep_alive":
                     # Optionally reply ping
-                    await websocket.send_json({"type": "ping", "timestamp": datetime.utcnow().isoformat()})
+                    conn.send_json({"type": "ping", "timestamp": datetime.utcnow().isoformat()})
+                    continue
+
+                if ptype == "auth":
+                    # The token comes in a frame rather than the URL, which access logs record
+                    token = payload.get("token")
+                    if room_id == "dm" and not mailbox_flushed and token and await token_store.resolve(token) == user_id:
+                        mailbox_flushed = True
+                        await _flush_mailbox(conn)
                     continue
+
+                # Token buckets per user/room keep one flooding client from
+                # multiplying into N sends per frame for everyone else
+                retry_after = _rate_limited(ptype, room_id, user_id, payload)
+                tracing.lap("ratelimit")
+                if retry_after is not None:
+                    if trace is not None:
+                        trace.attrs["rate_limited"] = True
+                    if ptype not in ("typing_start", "typing_stop", "dm_typing"):
+                        conn.send_json({
+                            "type": "error",
+                            "code": "rate_limited",
+                            "message": "Too many messages, slow down",
+                            "retry_after": round(retry_after, 2),
+                        }, coalesce_key="rate_limited")
+                    continue
+
                 if ptype in ("typing_start", "typing_stop"):
-                    for uid, ws in list(room_connections.get(room_id, {}).items()):
-                        if uid == user_id:
-                            continue
-                        try:
-                            await ws.send_json({
-                                "type": ptype,
-                                "room_id": room_id,
-                                "user_id": user_id,
-                                "username": username or "Anonymous",
-                                "timestamp": datetime.utcnow().isoformat(),
-                            })
-                        except Exception:
-                            try:
-                                del room_connections[room_id][uid]
-                            except Exception:
-                                pass
+                    # Batched into one "typing" frame per room by typing_aggregator
+                    _set_room_typing(room_id, user_id, username or "Anonymous", ptype == "typing_start")
                     continue
 
                 # Handle profile/avatar updates for real-time cross-device sync
@@ -860,17 +1699,19 @@ async def websocket_endpoint(
                     # Update in-memory user directory
                     new_username = payload.get("username") or username
                     new_avatar = payload.get("avatar") or payload.get("avatar_url") or avatar_url
-                    async with rooms_lock:
+                    async with room["lock"]:
                         try:
-                            rooms[room_id]["users"].setdefault(user_id, {})
+                            room["users"].setdefault(user_id, {})
                             if new_username:
-                                rooms[room_id]["users"][user_id]["username"] = new_username
+                                room["users"][user_id]["username"] = new_username
                                 username = new_username
                             if new_avatar:
-                                rooms[room_id]["users"][user_id]["avatar_url"] = new_avatar
+                                room["users"][user_id]["avatar_url"] = new_avatar
                                 avatar_url = new_avatar
                         except Exception:
                             pass
+                        room_versions.bump("rooms")
+                        room_versions.bump("messages", room_id)
 
                     # Broadcast update to all clients in this room
                     broadcast_payload = {
@@ -886,28 +1727,16 @@ async def websocket_endpoint(
                         "bio": payload.get("bio"),
                         "timestamp": datetime.utcnow().isoformat(),
                     }
-                    for ws in list(room_connections.get(room_id, {}).values()):
-                        try:
-                            await ws.send_json(broadcast_payload)
-                        except Exception:
-                            # remove broken
-                            try:
-                                for uid, w in list(room_connections.get(room_id, {}).items()):
-                                    if w is ws:
-                                        del room_connections[room_id][uid]
-                                        break
-                            except Exception:
-                                pass
+                    await _broadcast_room(room_id, broadcast_payload)
                     continue
 
                 # WebRTC signaling: relay targeted signals
                 if ptype == "webrtc-signal":
                     target_user_id = payload.get("target_user_id")
-                    target_ws = room_connections.get(room_id, {}).get(target_user_id)
-                    if target_ws is not None:
+                    if target_user_id:
                         try:
                             sender_username = payload.get("from_username") or username or "Anonymous"
-                            await target_ws.send_json({
+                            _send_in_room(room_id, target_user_id, {
                                 "type": "webrtc-signal",
                                 "room_id": room_id,
                                 "target_user_id": target_user_id,
@@ -927,18 +1756,12 @@ async def websocket_endpoint(
                         "username": broadcaster_name,
                         "started_at": datetime.utcnow().isoformat(),
                     }
-                    for uid, ws in list(room_connections.get(room_id, {}).items()):
-                        if uid == user_id:
-                            continue
-                        try:
-                            await ws.send_json({
-                                "type": "broadcast-started",
-                                "user_id": user_id,
-                                "username": broadcaster_name,
-                                "timestamp": datetime.utcnow().isoformat(),
-                            })
-                        except Exception:
-                            pass
+                    await _broadcast_room(room_id, {
+                        "type": "broadcast-started",
+                        "user_id": user_id,
+                        "username": broadcaster_name,
+                        "timestamp": datetime.utcnow().isoformat(),
+                    }, exclude=user_id)
                     continue
 
                 if ptype == "broadcast-stopped":
@@ -949,16 +1772,12 @@ async def websocket_endpoint(
                             del active_broadcasters[room_id][user_id]
                     except Exception:
                         pass
-                    for ws in list(room_connections.get(room_id, {}).values()):
-                        try:
-                            await ws.send_json({
-                                "type": "broadcast-stopped",
-                                "user_id": user_id,
-                                "username": broadcaster_name,
-                                "timestamp": datetime.utcnow().isoformat(),
-                            })
-                        except Exception:
-                            pass
+                    await _broadcast_room(room_id, {
+                        "type": "broadcast-stopped",
+                        "user_id": user_id,
+                        "username": broadcaster_name,
+                        "timestamp": datetime.utcnow().isoformat(),
+                    })
                     continue
 
                 # ─── DM Message Types ───────────────────────────────────
@@ -966,7 +1785,9 @@ async def websocket_endpoint(
                 # Handle direct messages - relay to target user
                 if ptype == "dm_message":
                     receiver_id = payload.get("receiver_id")
-                    sender_id = payload.get("sender_id") or user_id
+                    # Always the socket's own user: a client-supplied sender_id would let it write
+                    # into any pair's stored history under someone else's name
+                    sender_id = user_id
                     dm_content = payload.get("content", "")
                     
                     logger.info(f"📥 DM received - sender_id: {sender_id}, receiver_id: {receiver_id}")
@@ -991,89 +1812,52 @@ async def websocket_endpoint(
                             "sender_username": msg_sender_username,
                             "sender_avatar": msg_sender_avatar,
                             "receiver_id": receiver_id,
+                            "conversation_id": conversation_key(sender_id, receiver_id),
                             "content": dm_content,
                             "timestamp": payload.get("timestamp") or datetime.utcnow().isoformat(),
                         }
                     }
                     
-                    # Find receiver's WebSocket - check DM connections first
-                    receiver_ws = None
-                    async with dm_connections_lock:
-                        receiver_ws = dm_connections.get(receiver_id)
-                    
-                    # Also check all room connections if not in DM connections
-                    if not receiver_ws:
-                        for rid, conns in room_connections.items():
-                            if receiver_id in conns:
-                                receiver_ws = conns[receiver_id]
-                                break
-                    
-                    if receiver_ws:
-                        try:
-                            await receiver_ws.send_json(dm_payload)
-                            logger.info(f"📨 DM delivered from {sender_id} to {receiver_id}")
-                        except Exception as e:
-                            logger.warning(f"Failed to deliver DM to {receiver_id}: {e}")
+                    # Deliver to every live socket of the receiver (all tabs/rooms/nodes)
+                    delivered = _send_to_user(receiver_id, dm_payload)
+                    if delivered:
+                        logger.info(f"📨 DM delivered from {sender_id} to {receiver_id}")
                     else:
                         logger.info(f"📭 DM queued - {receiver_id} is offline")
+                    # Record history; undelivered DMs wait in the receiver's mailbox
+                    if dm_store is not None:
+                        try:
+                            await dm_store.save(dm_payload["message"], delivered=delivered)
+                        except Exception as e:
+                            logger.warning(f"Failed to store DM for {receiver_id}: {e}")
                     
                     continue
                 
                 # Handle read receipts
                 if ptype == "dm_read":
-                    reader_id = payload.get("reader_id") or user_id
+                    reader_id = user_id
                     dm_sender_id = payload.get("sender_id")
                     
                     # If sender_id provided, notify that user their messages were read
                     if dm_sender_id:
-                        sender_ws = None
-                        async with dm_connections_lock:
-                            sender_ws = dm_connections.get(dm_sender_id)
-                        if not sender_ws:
-                            for rid, conns in room_connections.items():
-                                if dm_sender_id in conns:
-                                    sender_ws = conns[dm_sender_id]
-                                    break
-                        
-                        if sender_ws:
-                            try:
-                                await sender_ws.send_json({
-                                    "type": "dm_read",
-                                    "reader_id": reader_id,
-                                    "sender_id": dm_sender_id,
-                                    "timestamp": datetime.utcnow().isoformat(),
-                                })
-                                logger.info(f"✓ Read receipt sent to {dm_sender_id}")
-                            except Exception:
-                                pass
+                        if _send_to_user(dm_sender_id, {
+                            "type": "dm_read",
+                            "reader_id": reader_id,
+                            "sender_id": dm_sender_id,
+                            "timestamp": datetime.utcnow().isoformat(),
+                        }):
+                            logger.info(f"✓ Read receipt sent to {dm_sender_id}")
                     continue
                 
                 # Handle typing indicators
                 if ptype == "dm_typing":
-                    typing_sender_id = payload.get("sender_id") or user_id
+                    typing_sender_id = user_id
                     typing_receiver_id = payload.get("receiver_id")
                     is_typing = payload.get("is_typing", False)
                     
-                    if typing_receiver_id:
-                        receiver_ws = None
-                        async with dm_connections_lock:
-                            receiver_ws = dm_connections.get(typing_receiver_id)
-                        if not receiver_ws:
-                            for rid, conns in room_connections.items():
-                                if typing_receiver_id in conns:
-                                    receiver_ws = conns[typing_receiver_id]
-                                    break
-                        
-                        if receiver_ws:
-                            try:
-                                await receiver_ws.send_json({
-                                    "type": "dm_typing",
-                                    "sender_id": typing_sender_id,
-                                    "is_typing": is_typing,
-                                    "timestamp": datetime.utcnow().isoformat(),
-                                })
-                            except Exception:
-                                pass
+                    # Only state changes are forwarded; repeats within the TTL are dropped
+                    if typing_receiver_id and typing_aggregator.update_dm(typing_sender_id, typing_receiver_id, bool(is_typing)):
+                        _emit_dm_typing(typing_receiver_id, typing_sender_id, bool(is_typing))
                     continue
 
                 # Treat as message - skip if no content
@@ -1092,44 +1876,35 @@ async def websocket_endpoint(
                     "avatar": msg_avatar,
                     "timestamp": datetime.utcnow().isoformat(),
                     "type": "message",
+                    "seq": await _next_seq(room_id, room["messages"].last_seq),
                 }
 
                 # Persist in memory
-                async with rooms_lock:
-                    rooms[room_id]["messages"].append(new_message)
+                async with room["lock"]:
+                    room["messages"].append(new_message)
+                    room_versions.bump("messages", room_id)
+                tracing.lap("append")
+                await _persist_message(new_message)
+                tracing.lap("persist")
 
                 # Broadcast
-                for ws in list(room_connections.get(room_id, {}).values()):
-                    try:
-                        await ws.send_json({"type": "message", **new_message})
-                    except Exception:
-                        try:
-                            for uid, w in list(room_connections.get(room_id, {}).items()):
-                                if w is ws:
-                                    del room_connections[room_id][uid]
-                                    break
-                        except Exception:
-                            pass
+                await _broadcast_room(room_id, {"type": "message", **new_message}, history=True)
 
             except Exception:
                 # If parsing fails, ignore
-                await websocket.send_json({"type": "error", "message": "Invalid message format"})
+                conn.send_json({"type": "error", "message": "Invalid message format"})
+            finally:
+                tracing.finish(trace)
 
     except WebSocketDisconnect:
-        # Cleanup DM connection
+        # Stop the writer; its on_close hook unregisters the room and DM entries
+        await conn.close()
         if room_id == "dm":
-            async with dm_connections_lock:
-                if user_id in dm_connections:
-                    del dm_connections[user_id]
-                    logger.info(f"📴 DM connection removed for user {user_id}")
-        
-        # Cleanup on disconnect
-        try:
-            conns = room_connections.get(room_id, {})
-            if user_id in conns:
-                del conns[user_id]
-        except Exception:
-            pass
+            logger.info(f"📴 DM connection removed for user {user_id}")
+        # Clear this socket's typing at once rather than after the TTL; DM typing only
+        # once the user has no socket left
+        if typing_aggregator.forget_user(room_id, user_id, dms=user_id not in user_connections):
+            _publish_room_typing(room_id, user_id, username or "Anonymous", False)
         # Clean up broadcaster if this user was broadcasting
         was_broadcasting = False
         try:
@@ -1140,44 +1915,80 @@ async def websocket_endpoint(
             pass
         # Notify broadcast stopped if they were broadcasting
         if was_broadcasting:
-            for ws in list(room_connections.get(room_id, {}).values()):
-                try:
-                    await ws.send_json({
-                        "type": "broadcast-stopped",
-                        "user_id": user_id,
-                        "username": username or "Anonymous",
-                        "timestamp": datetime.utcnow().isoformat(),
-                    })
-                except Exception:
-                    pass
+            await _broadcast_room(room_id, {
+                "type": "broadcast-stopped",
+                "user_id": user_id,
+                "username": username or "Anonymous",
+                "timestamp": datetime.utcnow().isoformat(),
+            })
         # Notify leave
-        for ws in list(room_connections.get(room_id, {}).values()):
-            try:
-                await ws.send_json({
-                    "type": "user_left",
-                    "room_id": room_id,
-                    "user_id": user_id,
-                    "timestamp": datetime.utcnow().isoformat(),
-                })
-            except Exception:
-                try:
-                    for uid, w in list(room_connections.get(room_id, {}).items()):
-                        if w is ws:
-                            del room_connections[room_id][uid]
-                            break
-                except Exception:
-                    pass
+        await _broadcast_room(room_id, {
+            "type": "user_left",
+            "room_id": room_id,
+            "user_id": user_id,
+            "timestamp": datetime.utcnow().isoformat(),
+        })
 
 
 # Initialize storage on startup (Postgres when DATABASE_URL is set)
 @app.on_event("startup")
 async def _init_storage():
-    global user_store
+    global user_store, message_store, token_store, dm_store, event_bus, blob_store
     try:
         if create_user_store is not None:
-            user_store = await create_user_store()
+            # Time the real store calls; cache hits never reach it
+            user_store = cached_user_store(timed_store(await create_user_store()), _publish_user_invalidation)
         else:
             user_store = None
     except Exception:
         # Fallback to in-memory on any init error
         user_store = None
+    try:
+        if create_message_store is not None:
+            message_store = await create_message_store()
+    except Exception as e:
+        # Messages stay in the in-memory ring buffers only
+        print(f"⚠️ Message store init failed, history will not be persisted: {e}")
+        message_store = None
+    try:
+        if create_token_backend is not None:
+            token_store = TokenStore(await create_token_backend())
+    except Exception as e:
+        # Keep the in-memory token store; tokens will not survive restarts
+        print(f"⚠️ Token backend init failed, using in-memory tokens: {e}")
+    token_store.start()
+    typing_aggregator.start()
+    try:
+        if create_dm_store is not None:
+            dm_store = await create_dm_store()
+    except Exception as e:
+        # Offline DMs are dropped and history is unavailable without a store
+        print(f"⚠️ DM store init failed: {e}")
+        dm_store = None
+    try:
+        blob_store = await create_blob_store()
+    except Exception as e:
+        # Uploads still work, kept on this machine's disk under BLOB_DIR
+        print(f"⚠️ Blob store init failed, storing uploads locally: {e}")
+        blob_store = LocalBlobStore()
+    try:
+        bus = await create_event_bus()
+        await bus.start(_on_bus_event)
+        event_bus = bus
+    except Exception as e:
+        # Single-node operation: events reach only this process's sockets
+        print(f"⚠️ Event bus init failed, running single-node: {e}")
+        event_bus = InProcessBus()
+        await event_bus.start(_on_bus_event)
+
+
+@app.on_event("shutdown")
+async def _close_storage():
+    # Flush buffered messages before the process exits
+    if message_store is not None:
+        await message_store.close()
+    await token_store.close()
+    await typing_aggregator.close()
+    await event_bus.close()
+    password_hasher.shutdown()
+    image_pipeline.shutdown()
@@ -1,6 +1,10 @@
 import os
+import pickle
+import time
 import asyncio
-from typing import Dict, Any, Optional
+import hashlib
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Any, Iterable, Optional, Set, Tuple
 
 try:
     import asyncpg  # type: ignore
@@ -8,18 +12,59 @@ except Exception:
     asyncpg = None  # Optional; only required when using Postgres
 
 
+class UsernameTakenError(Exception):
+    """Raised when a profile update would duplicate another user's username."""
+
+
+def _is_unique_violation(exc: Exception) -> bool:
+    return getattr(exc, "sqlstate", None) == "23505"
+
+
+# Item fields with their own gallery_items column; any other keys are kept in `extra`
+GALLERY_COLUMNS = ("id", "user_id", "url", "caption", "created_at", "position")
+
+
+def _page(items: Iterable[Dict[str, Any]], after: Optional[int], limit: Optional[int]) -> list:
+    """Items after the `after` position cursor, at most `limit` of them."""
+    page = [dict(i) for i in items if after is None or i["position"] > after]
+    return page if limit is None else page[:limit]
+
+
 class InMemoryUserStore:
     def __init__(self):
         self._users: Dict[str, Dict[str, Any]] = {}
+        # lower(username) -> user_id, mirrors the unique index in Postgres
+        self._usernames: Dict[str, str] = {}
+        # user_id -> item id -> item, in position order (mirrors gallery_items)
+        self._galleries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # Like the gallery_items position sequence: appends always sort last
+        self._gallery_seq = 0
         self._lock = asyncio.Lock()
 
     async def get_user(self, user_id: str) -> Dict[str, Any]:
         async with self._lock:
             return dict(self._users.get(user_id, {}))
 
+    async def get_user_by_username(self, username: str) -> Dict[str, Any]:
+        async with self._lock:
+            user_id = self._usernames.get(username.strip().lower())
+            if user_id is None:
+                return {}
+            return {**self._users.get(user_id, {}), "id": user_id}
+
     async def upsert_profile(self, user_id: str, profile_updates: Dict[str, Any]) -> Dict[str, Any]:
         async with self._lock:
             profile = self._users.get(user_id, {})
+            new_username = profile_updates.get("username")
+            if new_username:
+                key = new_username.strip().lower()
+                owner = self._usernames.get(key)
+                if owner is not None and owner != user_id:
+                    raise UsernameTakenError(new_username)
+                old_username = profile.get("username")
+                if old_username and self._usernames.get(old_username.lower()) == user_id:
+                    del self._usernames[old_username.lower()]
+                self._usernames[key] = user_id
             for key in ("display_name", "username", "bio", "email", "avatar_url", "avatar_urls"):
                 if key in profile_updates and profile_updates[key] is not None:
                     profile[key] = profile_updates[key]
@@ -43,16 +88,52 @@ class InMemoryUserStore:
             profile["theme_config"] = theme_config
             self._users[user_id] = profile
 
-    async def get_gallery(self, user_id: str) -> list:
+    async def get_gallery(self, user_id: str, after: Optional[int] = None, limit: Optional[int] = None) -> list:
         async with self._lock:
-            profile = self._users.get(user_id, {})
-            return profile.get("gallery", [])
+            return _page(self._galleries.get(user_id, {}).values(), after, limit)
 
     async def set_gallery(self, user_id: str, items: list) -> None:
         async with self._lock:
-            profile = self._users.get(user_id, {})
-            profile["gallery"] = items
-            self._users[user_id] = profile
+            self._galleries.pop(user_id, None)
+            self._append_gallery(user_id, items)
+
+    async def add_gallery_items(self, user_id: str, items: list) -> list:
+        async with self._lock:
+            return self._append_gallery(user_id, items)
+
+    def _append_gallery(self, user_id: str, items: list) -> list:
+        gallery = self._galleries.setdefault(user_id, {})
+        added = []
+        for item in items:
+            self._gallery_seq += 1
+            stored = {**item, "user_id": user_id, "position": self._gallery_seq}
+            gallery[stored["id"]] = stored
+            added.append(dict(stored))
+        return added
+
+    async def update_gallery_item(self, user_id: str, item_id: str, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        async with self._lock:
+            item = self._galleries.get(user_id, {}).get(item_id)
+            if item is None:
+                return None
+            item.update({k: v for k, v in updates.items() if k not in ("id", "user_id", "position")})
+            return dict(item)
+
+    async def delete_gallery_item(self, user_id: str, item_id: str) -> bool:
+        async with self._lock:
+            return self._galleries.get(user_id, {}).pop(item_id, None) is not None
+
+    async def reorder_gallery(self, user_id: str, ids: list) -> list:
+        """Put `ids` first in the given order; unlisted items follow in their current order."""
+        async with self._lock:
+            gallery = self._galleries.get(user_id, {})
+            listed = [gallery[i] for i in dict.fromkeys(ids) if i in gallery]
+            seen = {item["id"] for item in listed}
+            ordered = listed + [item for item in gallery.values() if item["id"] not in seen]
+            for position, item in enumerate(ordered, 1):
+                item["position"] = position
+            self._galleries[user_id] = {item["id"]: item for item in ordered}
+            return [dict(item) for item in ordered]
 
 
 class PostgresUserStore:
@@ -97,6 +178,57 @@ class PostgresUserStore:
                     )
                 except Exception:
                     pass  # column already exists
+            # Case-insensitive unique usernames; also serves login lookups
+            try:
+                await conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS users_username_lower_key ON users (lower(username));"
+                )
+            except Exception as e:
+                print(f"⚠️ Could not create unique username index (duplicate usernames?): {e}")
+            # One row per gallery item so edits touch a single row instead of
+            # rewriting users.gallery. Appends take the next sequence value and
+            # so always sort last; reorders renumber a user's items 1..n.
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS gallery_items (
+                    user_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    position BIGSERIAL NOT NULL,
+                    url TEXT,
+                    caption TEXT,
+                    created_at TEXT,
+                    extra JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    PRIMARY KEY (user_id, id)
+                );
+                CREATE INDEX IF NOT EXISTS gallery_items_user_position_idx
+                    ON gallery_items (user_id, position);
+                """
+            )
+            await self._migrate_gallery_jsonb(conn)
+
+    async def _migrate_gallery_jsonb(self, conn: Any) -> None:
+        """Move galleries stored in the legacy users.gallery array into gallery_items."""
+        async with conn.transaction():
+            moved = await conn.execute(
+                """
+                INSERT INTO gallery_items (user_id, id, url, caption, created_at, extra)
+                SELECT u.id,
+                       COALESCE(e.item->>'id', md5(u.id || e.ord::text)),
+                       e.item->>'url', e.item->>'caption', e.item->>'created_at',
+                       e.item - 'id' - 'user_id' - 'url' - 'caption' - 'created_at' - 'position'
+                FROM users u,
+                     jsonb_array_elements(u.gallery) WITH ORDINALITY AS e(item, ord)
+                WHERE jsonb_typeof(u.gallery) = 'array' AND jsonb_array_length(u.gallery) > 0
+                ORDER BY u.id, e.ord
+                ON CONFLICT (user_id, id) DO NOTHING;
+                """
+            )
+            await conn.execute(
+                "UPDATE users SET gallery = '[]'::jsonb WHERE jsonb_typeof(gallery) = 'array' AND jsonb_array_length(gallery) > 0"
+            )
+        count = int(moved.split()[-1]) if moved else 0
+        if count:
+            print(f"📦 Migrated {count} gallery items from users.gallery to gallery_items")
 
     async def get_user(self, user_id: str) -> Dict[str, Any]:
         assert self._pool is not None
@@ -115,6 +247,16 @@ class PostgresUserStore:
                         pass
             return result
 
+    async def get_user_by_username(self, username: str) -> Dict[str, Any]:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT * FROM users WHERE lower(username) = lower($1)", username.strip()
+            )
+        if not row:
+            return {}
+        return await self.get_user(row["id"])
+
     async def upsert_profile(self, user_id: str, profile_updates: Dict[str, Any]) -> Dict[str, Any]:
         assert self._pool is not None
         import json
@@ -128,21 +270,26 @@ class PostgresUserStore:
         avatar_urls_json = json.dumps(avatar_urls_raw) if avatar_urls_raw else None
 
         async with self._pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO users (id, username, display_name, bio, email, avatar_url, avatar_urls)
-                VALUES ($1, $2, $3, $4, $5, $6, $7::jsonb)
-                ON CONFLICT (id) DO UPDATE SET
-                    username = COALESCE(EXCLUDED.username, users.username),
-                    display_name = COALESCE(EXCLUDED.display_name, users.display_name),
-                    bio = COALESCE(EXCLUDED.bio, users.bio),
-                    email = COALESCE(EXCLUDED.email, users.email),
-                    avatar_url = COALESCE(EXCLUDED.avatar_url, users.avatar_url),
-                    avatar_urls = COALESCE(EXCLUDED.avatar_urls, users.avatar_urls),
-                    updated_at = NOW();
-                """,
-                user_id, username, display_name, bio, email, avatar_url, avatar_urls_json,
-            )
+            try:
+                await conn.execute(
+                    """
+                    INSERT INTO users (id, username, display_name, bio, email, avatar_url, avatar_urls)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7::jsonb)
+                    ON CONFLICT (id) DO UPDATE SET
+                        username = COALESCE(EXCLUDED.username, users.username),
+                        display_name = COALESCE(EXCLUDED.display_name, users.display_name),
+                        bio = COALESCE(EXCLUDED.bio, users.bio),
+                        email = COALESCE(EXCLUDED.email, users.email),
+                        avatar_url = COALESCE(EXCLUDED.avatar_url, users.avatar_url),
+                        avatar_urls = COALESCE(EXCLUDED.avatar_urls, users.avatar_urls),
+                        updated_at = NOW();
+                    """,
+                    user_id, username, display_name, bio, email, avatar_url, avatar_urls_json,
+                )
+            except Exception as e:
+                if _is_unique_violation(e):
+                    raise UsernameTakenError(username) from e
+                raise
             row = await conn.fetchrow("SELECT * FROM users WHERE id = $1", user_id)
             if row:
                 result = dict(row)
@@ -197,33 +344,117 @@ class PostgresUserStore:
                 user_id, tc_json,
             )
 
-    async def get_gallery(self, user_id: str) -> list:
+    @staticmethod
+    def _gallery_item(row: Any) -> Dict[str, Any]:
+        import json
+        extra = row["extra"]
+        item = json.loads(extra) if isinstance(extra, str) else dict(extra or {})
+        item.update((col, row[col]) for col in GALLERY_COLUMNS)
+        return item
+
+    async def get_gallery(self, user_id: str, after: Optional[int] = None, limit: Optional[int] = None) -> list:
         assert self._pool is not None
         async with self._pool.acquire() as conn:
-            row = await conn.fetchval(
-                "SELECT gallery FROM users WHERE id = $1", user_id
+            rows = await conn.fetch(
+                f"""
+                SELECT {", ".join(GALLERY_COLUMNS)}, extra FROM gallery_items
+                WHERE user_id = $1 AND ($2::bigint IS NULL OR position > $2)
+                ORDER BY position LIMIT $3;
+                """,
+                user_id, after, limit,
             )
-            if row is None:
-                return []
-            import json
-            items = json.loads(row) if isinstance(row, str) else row
-            return items if isinstance(items, list) else []
+        return [self._gallery_item(r) for r in rows]
+
+    async def _insert_gallery(self, conn: Any, user_id: str, items: list) -> list:
+        import json
+        if not items:
+            return []
+        extras = [
+            json.dumps({k: v for k, v in item.items() if k not in GALLERY_COLUMNS})
+            for item in items
+        ]
+        rows = await conn.fetch(
+            f"""
+            INSERT INTO gallery_items (user_id, id, url, caption, created_at, extra)
+            SELECT $1, t.id, t.url, t.caption, t.created_at, t.extra::jsonb
+            FROM unnest($2::text[], $3::text[], $4::text[], $5::text[], $6::text[])
+                 WITH ORDINALITY AS t(id, url, caption, created_at, extra, ord)
+            ORDER BY t.ord
+            RETURNING {", ".join(GALLERY_COLUMNS)}, extra;
+            """,
+            user_id,
+            [item["id"] for item in items],
+            [item.get("url") for item in items],
+            [item.get("caption") for item in items],
+            [item.get("created_at") for item in items],
+            extras,
+        )
+        return sorted((self._gallery_item(r) for r in rows), key=lambda i: i["position"])
 
     async def set_gallery(self, user_id: str, items: list) -> None:
+        """Replace a user's whole gallery; prefer the per-item operations."""
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM gallery_items WHERE user_id = $1", user_id)
+                await self._insert_gallery(conn, user_id, items)
+
+    async def add_gallery_items(self, user_id: str, items: list) -> list:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            return await self._insert_gallery(conn, user_id, items)
+
+    async def update_gallery_item(self, user_id: str, item_id: str, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         assert self._pool is not None
         import json
-        gallery_json = json.dumps(items)
+        extra = {k: v for k, v in updates.items() if k not in GALLERY_COLUMNS}
         async with self._pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO users (id, gallery)
-                VALUES ($1, $2::jsonb)
-                ON CONFLICT (id) DO UPDATE SET
-                    gallery = EXCLUDED.gallery,
-                    updated_at = NOW();
+            row = await conn.fetchrow(
+                f"""
+                UPDATE gallery_items SET
+                    url = CASE WHEN $3::boolean THEN $4::text ELSE url END,
+                    caption = CASE WHEN $5::boolean THEN $6::text ELSE caption END,
+                    extra = extra || $7::jsonb
+                WHERE user_id = $1 AND id = $2
+                RETURNING {", ".join(GALLERY_COLUMNS)}, extra;
                 """,
-                user_id, gallery_json,
+                user_id, item_id,
+                "url" in updates, updates.get("url"),
+                "caption" in updates, updates.get("caption"),
+                json.dumps(extra),
+            )
+        return self._gallery_item(row) if row else None
+
+    async def delete_gallery_item(self, user_id: str, item_id: str) -> bool:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            status = await conn.execute(
+                "DELETE FROM gallery_items WHERE user_id = $1 AND id = $2", user_id, item_id
             )
+        return status.split()[-1] != "0"
+
+    async def reorder_gallery(self, user_id: str, ids: list) -> list:
+        """Put `ids` first in the given order; unlisted items follow in their current order."""
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                current = [r["id"] for r in await conn.fetch(
+                    "SELECT id FROM gallery_items WHERE user_id = $1 ORDER BY position FOR UPDATE",
+                    user_id,
+                )]
+                present = set(current)
+                listed = [i for i in dict.fromkeys(ids) if i in present]
+                seen = set(listed)
+                ordered = listed + [i for i in current if i not in seen]
+                await conn.execute(
+                    """
+                    UPDATE gallery_items g SET position = t.ord
+                    FROM unnest($2::text[]) WITH ORDINALITY AS t(id, ord)
+                    WHERE g.user_id = $1 AND g.id = t.id AND g.position <> t.ord;
+                    """,
+                    user_id, ordered,
+                )
+        return await self.get_gallery(user_id)
 
 
 async def create_user_store() -> Any:
@@ -233,3 +464,647 @@ async def create_user_store() -> Any:
         await store.init()
         return store
     return InMemoryUserStore()
+
+
+# ─── Read-through user cache ─────────────────────────────────────────
+
+# Profile/theme/gallery entries kept per worker by CachedUserStore; 0 disables the cache
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# Seconds a cached entry is served before the store is asked again; bounds
+# staleness if a cross-worker invalidation is lost
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+# Cached reads each write makes stale (get_user returns the theme too)
+_INVALIDATES = {
+    "upsert_profile": ("user",),
+    "set_password_hash": ("user",),
+    "set_theme": ("user", "theme"),
+    "set_gallery": ("gallery",),
+    "add_gallery_items": ("gallery",),
+    "update_gallery_item": ("gallery",),
+    "delete_gallery_item": ("gallery",),
+    "reorder_gallery": ("gallery",),
+}
+
+
+class CachedUserStore:
+    """Bounded TTL/LRU read-through cache in front of any user store.
+
+    get_user, get_theme and get_gallery are answered locally while fresh;
+    every write drops the user's affected entries here and calls
+    `on_invalidate(user_id, kinds)` so other workers can drop theirs (see
+    `invalidate`). Entries are kept as pickled snapshots and unpickled per
+    hit: callers mutate what they read (e.g. appending to a gallery before
+    saving it), and unpickling is several times cheaper than deepcopy while
+    keeping asyncpg's datetimes intact.
+    """
+
+    def __init__(
+        self,
+        store: Any,
+        size: int = USER_CACHE_SIZE,
+        ttl: float = USER_CACHE_TTL,
+        on_invalidate: Optional[Callable[[str, Tuple[str, ...]], None]] = None,
+    ):
+        self._store = store
+        self.size = max(1, size)
+        self.ttl = ttl
+        self.on_invalidate = on_invalidate
+        # (kind, user_id) -> (pickled value, cached_until)
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[bytes, float]]" = OrderedDict()
+        # Bumped on every invalidation; a read that raced a write must not cache its result
+        self._epoch = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def __getattr__(self, name: str) -> Any:
+        # init(), get_user_by_username() and anything else pass straight through
+        return getattr(self._store, name)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    async def _read(self, kind: str, user_id: str, load: Callable[[str], Any]) -> Any:
+        key = (kind, user_id)
+        cached = self._cache.get(key)
+        if cached is not None:
+            snapshot, cached_until = cached
+            if time.monotonic() < cached_until:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return pickle.loads(snapshot)
+            del self._cache[key]
+        self.stats["misses"] += 1
+        epoch = self._epoch
+        value = await load(user_id)
+        if epoch == self._epoch:
+            self._cache[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.monotonic() + self.ttl)
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+                self.stats["evictions"] += 1
+        return value
+
+    def invalidate(self, user_id: str, kinds: Iterable[str] = ("user", "theme", "gallery")) -> None:
+        """Drop cached entries for a user; called locally on writes and for bus events."""
+        self._epoch += 1
+        self.stats["invalidations"] += 1
+        for kind in kinds:
+            self._cache.pop((kind, user_id), None)
+
+    def _written(self, op: str, user_id: str) -> None:
+        kinds = _INVALIDATES[op]
+        self.invalidate(user_id, kinds)
+        if self.on_invalidate is not None:
+            try:
+                self.on_invalidate(user_id, kinds)
+            except Exception as e:
+                print(f"⚠️ User cache invalidation publish failed: {e}")
+
+    async def get_user(self, user_id: str) -> Dict[str, Any]:
+        return await self._read("user", user_id, self._store.get_user)
+
+    async def get_theme(self, user_id: str) -> Optional[Dict[str, Any]]:
+        return await self._read("theme", user_id, self._store.get_theme)
+
+    async def get_gallery(self, user_id: str, after: Optional[int] = None, limit: Optional[int] = None) -> list:
+        # Only the whole gallery is cached; pages go straight to the store
+        if after is not None or limit is not None:
+            return await self._store.get_gallery(user_id, after=after, limit=limit)
+        return await self._read("gallery", user_id, self._store.get_gallery)
+
+    async def upsert_profile(self, user_id: str, profile_updates: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return await self._store.upsert_profile(user_id, profile_updates)
+        finally:
+            self._written("upsert_profile", user_id)
+
+    async def set_password_hash(self, user_id: str, password_hash: str) -> None:
+        try:
+            await self._store.set_password_hash(user_id, password_hash)
+        finally:
+            self._written("set_password_hash", user_id)
+
+    async def set_theme(self, user_id: str, theme_config: Dict[str, Any]) -> None:
+        try:
+            await self._store.set_theme(user_id, theme_config)
+        finally:
+            self._written("set_theme", user_id)
+
+    async def set_gallery(self, user_id: str, items: list) -> None:
+        try:
+            await self._store.set_gallery(user_id, items)
+        finally:
+            self._written("set_gallery", user_id)
+
+    async def add_gallery_items(self, user_id: str, items: list) -> list:
+        try:
+            return await self._store.add_gallery_items(user_id, items)
+        finally:
+            self._written("add_gallery_items", user_id)
+
+    async def update_gallery_item(self, user_id: str, item_id: str, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            return await self._store.update_gallery_item(user_id, item_id, updates)
+        finally:
+            self._written("update_gallery_item", user_id)
+
+    async def delete_gallery_item(self, user_id: str, item_id: str) -> bool:
+        try:
+            return await self._store.delete_gallery_item(user_id, item_id)
+        finally:
+            self._written("delete_gallery_item", user_id)
+
+    async def reorder_gallery(self, user_id: str, ids: list) -> list:
+        try:
+            return await self._store.reorder_gallery(user_id, ids)
+        finally:
+            self._written("reorder_gallery", user_id)
+
+
+def cached_user_store(
+    store: Optional[Any],
+    on_invalidate: Optional[Callable[[str, Tuple[str, ...]], None]] = None,
+) -> Optional[Any]:
+    """Wrap a user store in CachedUserStore unless caching is off or pointless.
+
+    InMemoryUserStore already lives in process memory, so it is returned as is.
+    """
+    if store is None or USER_CACHE_SIZE <= 0 or isinstance(getattr(store, "_store", store), InMemoryUserStore):
+        return store
+    return CachedUserStore(store, on_invalidate=on_invalidate)
+
+
+# ─── Room message persistence ────────────────────────────────────────
+
+# Buffered messages that trigger an immediate flush
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", "100"))
+# Seconds between background flushes of a partially filled buffer
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.5"))
+# Unwritten messages kept while storage is unavailable; oldest are dropped beyond this
+MESSAGE_BUFFER_LIMIT = int(os.getenv("MESSAGE_BUFFER_LIMIT", "10000"))
+# Messages per room kept by InMemoryMessageStore
+MESSAGE_ARCHIVE_LIMIT = int(os.getenv("MESSAGE_ARCHIVE_LIMIT", "10000"))
+
+MESSAGE_COLUMNS = ("room_id", "seq", "id", "user_id", "username", "content", "avatar", "type", "timestamp")
+
+
+class _BufferedMessageStore:
+    """Write-behind buffer shared by the message stores.
+
+    `append` only queues the message; a background task writes batches when
+    MESSAGE_FLUSH_SIZE messages are pending or every MESSAGE_FLUSH_INTERVAL
+    seconds, so the chat hot path never waits on storage. Reads of recent
+    history are served by each room's in-memory RoomHistory; the store is
+    only consulted to warm a cold room or page past the in-memory tail.
+    `shared` stores are seen by every node; the others are per process.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._buffer: list = []
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        # Size-triggered flushes; referenced until done so they are not garbage-collected mid-write
+        self._flushes: Set[asyncio.Task] = set()
+        self._closed = False
+
+    def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def append(self, message: Dict[str, Any]) -> None:
+        self._buffer.append(message)
+        if len(self._buffer) > MESSAGE_BUFFER_LIMIT:
+            del self._buffer[: len(self._buffer) - MESSAGE_BUFFER_LIMIT]
+        if len(self._buffer) >= MESSAGE_FLUSH_SIZE and not self._flush_lock.locked() and not self._flushes:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:MESSAGE_FLUSH_SIZE]
+                del self._buffer[: len(batch)]
+                try:
+                    await self._write_batch(batch)
+                except Exception as e:
+                    # Put the batch back and retry on the next tick
+                    print(f"⚠️ Message batch write failed ({len(batch)} messages): {e}")
+                    self._buffer[:0] = batch
+                    return
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except (asyncio.CancelledError, Exception):
+                pass
+        # Let in-flight flushes finish, then write whatever they left behind
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while not self._closed:
+            await asyncio.sleep(MESSAGE_FLUSH_INTERVAL)
+            if self._buffer:
+                await self.flush()
+
+    async def next_seq(self, room_id: str, floor: int = 0) -> Optional[int]:
+        """Next message seq above `floor` from storage shared by every node, or None to number locally."""
+        return None
+
+    async def _write_batch(self, batch: list) -> None:
+        raise NotImplementedError
+
+
+class InMemoryMessageStore(_BufferedMessageStore):
+    def __init__(self):
+        super().__init__()
+        self._rooms: Dict[str, deque] = {}
+
+    async def _write_batch(self, batch: list) -> None:
+        for message in batch:
+            room = self._rooms.setdefault(message["room_id"], deque(maxlen=MESSAGE_ARCHIVE_LIMIT))
+            room.append(dict(message))
+
+    async def load_recent(self, room_id: str, limit: int) -> list:
+        room = self._rooms.get(room_id)
+        if not room:
+            return []
+        return [dict(m) for m in list(room)[-limit:]]
+
+    async def fetch_before(self, room_id: str, before_seq: int, limit: int) -> list:
+        room = self._rooms.get(room_id)
+        if not room:
+            return []
+        older = [m for m in room if m["seq"] < before_seq]
+        return [dict(m) for m in older[-limit:]]
+
+
+class PostgresMessageStore(_BufferedMessageStore):
+    shared = True
+
+    def __init__(self, dsn: str):
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is not installed; cannot use PostgresMessageStore")
+        super().__init__()
+        self._dsn = dsn
+        self._pool: Optional[asyncpg.pool.Pool] = None
+
+    async def init(self) -> None:
+        self._pool = await asyncpg.create_pool(self._dsn, max_size=4)
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS room_messages (
+                    room_id TEXT NOT NULL,
+                    seq BIGINT NOT NULL,
+                    id TEXT NOT NULL,
+                    user_id TEXT,
+                    username TEXT,
+                    content TEXT,
+                    avatar TEXT,
+                    type TEXT,
+                    timestamp TEXT,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (room_id, seq)
+                );
+                CREATE TABLE IF NOT EXISTS room_seq (
+                    room_id TEXT PRIMARY KEY,
+                    seq BIGINT NOT NULL
+                );
+                """
+            )
+
+    async def next_seq(self, room_id: str, floor: int = 0) -> Optional[int]:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            return await self._allocate_seq(conn, room_id, floor)
+
+    @staticmethod
+    async def _allocate_seq(conn: Any, room_id: str, floor: int) -> int:
+        # One counter row per room, bumped atomically so every node draws from the same sequence.
+        # The floor keeps it ahead of seqs a node handed out on its own while it had no peers.
+        return await conn.fetchval(
+            """
+            INSERT INTO room_seq (room_id, seq) VALUES ($1, $2 + 1)
+            ON CONFLICT (room_id) DO UPDATE SET seq = GREATEST(room_seq.seq, $2) + 1
+            RETURNING seq;
+            """,
+            room_id, floor,
+        )
+
+    async def _write_batch(self, batch: list) -> None:
+        assert self._pool is not None
+        records = [tuple(m.get(col) for col in MESSAGE_COLUMNS) for m in batch]
+        async with self._pool.acquire() as conn:
+            try:
+                await conn.copy_records_to_table("room_messages", records=records, columns=MESSAGE_COLUMNS)
+            except asyncpg.UniqueViolationError:
+                # COPY is all-or-nothing; retry row-wise. A seq already holding this message was
+                # written by an earlier attempt; one holding a different message means ours was
+                # numbered locally, so it is renumbered from the shared counter instead of dropped.
+                for i, message in enumerate(batch):
+                    while True:
+                        stored_id = await conn.fetchval(
+                            f"""
+                            INSERT INTO room_messages ({", ".join(MESSAGE_COLUMNS)})
+                            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                            ON CONFLICT (room_id, seq) DO UPDATE SET id = room_messages.id
+                            RETURNING id;
+                            """,
+                            *(message.get(col) for col in MESSAGE_COLUMNS),
+                        )
+                        if stored_id == message["id"]:
+                            break
+                        seq = await self._allocate_seq(conn, message["room_id"], message["seq"])
+                        print(f"⚠️ Message {message['id']} collided at seq {message['seq']} in room {message['room_id']}; stored as seq {seq}")
+                        # A copy, since the buffered dict is shared with the room's history; kept in
+                        # the batch so a retry after a failure reuses the new seq
+                        message = batch[i] = {**message, "seq": seq}
+
+    async def load_recent(self, room_id: str, limit: int) -> list:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM room_messages "
+                "WHERE room_id = $1 ORDER BY seq DESC LIMIT $2",
+                room_id, limit,
+            )
+        return [dict(r) for r in reversed(rows)]
+
+    async def fetch_before(self, room_id: str, before_seq: int, limit: int) -> list:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM room_messages "
+                "WHERE room_id = $1 AND seq < $2 ORDER BY seq DESC LIMIT $3",
+                room_id, before_seq, limit,
+            )
+        return [dict(r) for r in reversed(rows)]
+
+    async def close(self) -> None:
+        await super().close()
+        if self._pool is not None:
+            await self._pool.close()
+
+
+async def create_message_store() -> Any:
+    dsn = os.getenv("DATABASE_URL")
+    if dsn:
+        store = PostgresMessageStore(dsn)
+        await store.init()
+    else:
+        store = InMemoryMessageStore()
+    store.start()
+    return store
+
+
+# ─── Auth token persistence ──────────────────────────────────────────
+
+def _token_key(token: str) -> str:
+    # Only a digest of the bearer token is stored, so a leaked table cannot be replayed
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class InMemoryTokenBackend:
+    def __init__(self):
+        self._tokens: Dict[str, Tuple[str, float]] = {}
+
+    async def put(self, token: str, user_id: str, expires_at: float) -> None:
+        self._tokens[_token_key(token)] = (user_id, expires_at)
+
+    async def get(self, token: str) -> Optional[Tuple[str, float]]:
+        return self._tokens.get(_token_key(token))
+
+    async def delete(self, token: str) -> None:
+        self._tokens.pop(_token_key(token), None)
+
+    async def delete_expired(self, now: float) -> int:
+        expired = [k for k, (_, exp) in list(self._tokens.items()) if exp <= now]
+        for k in expired:
+            self._tokens.pop(k, None)
+        return len(expired)
+
+
+class PostgresTokenBackend:
+    def __init__(self, dsn: str):
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is not installed; cannot use PostgresTokenBackend")
+        self._dsn = dsn
+        self._pool: Optional[asyncpg.pool.Pool] = None
+
+    async def init(self) -> None:
+        self._pool = await asyncpg.create_pool(self._dsn, max_size=4)
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS auth_tokens (
+                    token_hash TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    expires_at DOUBLE PRECISION NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS auth_tokens_expires_at_idx ON auth_tokens (expires_at);
+                """
+            )
+
+    async def put(self, token: str, user_id: str, expires_at: float) -> None:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO auth_tokens (token_hash, user_id, expires_at)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (token_hash) DO UPDATE SET
+                    user_id = EXCLUDED.user_id,
+                    expires_at = EXCLUDED.expires_at;
+                """,
+                _token_key(token), user_id, expires_at,
+            )
+
+    async def get(self, token: str) -> Optional[Tuple[str, float]]:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT user_id, expires_at FROM auth_tokens WHERE token_hash = $1", _token_key(token)
+            )
+        return (row["user_id"], row["expires_at"]) if row else None
+
+    async def delete(self, token: str) -> None:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            await conn.execute("DELETE FROM auth_tokens WHERE token_hash = $1", _token_key(token))
+
+    async def delete_expired(self, now: float) -> int:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            status = await conn.execute("DELETE FROM auth_tokens WHERE expires_at <= $1", now)
+        try:
+            return int(status.split()[-1])
+        except Exception:
+            return 0
+
+
+async def create_token_backend() -> Any:
+    dsn = os.getenv("DATABASE_URL")
+    if dsn:
+        backend = PostgresTokenBackend(dsn)
+        await backend.init()
+        return backend
+    return InMemoryTokenBackend()
+
+
+# ─── Direct message history and offline mailbox ──────────────────────
+
+# Undelivered DMs held per offline user (oldest dropped beyond this) by InMemoryDMStore
+DM_MAILBOX_LIMIT = int(os.getenv("DM_MAILBOX_LIMIT", "500"))
+# DMs kept per conversation by InMemoryDMStore
+DM_HISTORY_LIMIT = int(os.getenv("DM_HISTORY_LIMIT", "1000"))
+
+DM_COLUMNS = (
+    "id", "conversation_id", "sender_id", "receiver_id",
+    "sender_username", "sender_avatar", "content", "timestamp",
+)
+
+
+def conversation_key(user_a: str, user_b: str) -> str:
+    """Stable id for a 1:1 conversation; matches the frontend's getConversationKey."""
+    return "-".join(sorted((user_a, user_b)))
+
+
+class InMemoryDMStore:
+    def __init__(self):
+        self._seq = 0
+        self._conversations: Dict[str, deque] = {}
+        self._mailboxes: Dict[str, deque] = {}
+        self._lock = asyncio.Lock()
+
+    async def save(self, message: Dict[str, Any], delivered: bool) -> Dict[str, Any]:
+        async with self._lock:
+            self._seq += 1
+            stored = {**message, "seq": self._seq}
+            history = self._conversations.setdefault(
+                stored["conversation_id"], deque(maxlen=DM_HISTORY_LIMIT)
+            )
+            history.append(stored)
+            if not delivered:
+                mailbox = self._mailboxes.setdefault(stored["receiver_id"], deque(maxlen=DM_MAILBOX_LIMIT))
+                mailbox.append(stored)
+            return stored
+
+    async def drain(self, user_id: str) -> list:
+        """Remove and return a user's undelivered DMs, oldest first."""
+        async with self._lock:
+            mailbox = self._mailboxes.pop(user_id, None)
+            return list(mailbox) if mailbox else []
+
+    async def requeue(self, user_id: str, messages: list) -> None:
+        """Put drained DMs back when the batch could not be handed to the socket."""
+        async with self._lock:
+            mailbox = self._mailboxes.setdefault(user_id, deque(maxlen=DM_MAILBOX_LIMIT))
+            mailbox.extendleft(reversed(messages))
+
+    async def history(self, conversation_id: str, before: Optional[int] = None, limit: int = 50) -> list:
+        async with self._lock:
+            history = self._conversations.get(conversation_id)
+            if not history:
+                return []
+            older = [m for m in history if before is None or m["seq"] < before]
+            return older[-limit:]
+
+
+class PostgresDMStore:
+    def __init__(self, dsn: str):
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is not installed; cannot use PostgresDMStore")
+        self._dsn = dsn
+        self._pool: Optional[asyncpg.pool.Pool] = None
+
+    async def init(self) -> None:
+        self._pool = await asyncpg.create_pool(self._dsn, max_size=4)
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS direct_messages (
+                    seq BIGSERIAL PRIMARY KEY,
+                    id TEXT NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    sender_id TEXT NOT NULL,
+                    receiver_id TEXT NOT NULL,
+                    sender_username TEXT,
+                    sender_avatar TEXT,
+                    content TEXT,
+                    timestamp TEXT,
+                    delivered BOOLEAN NOT NULL DEFAULT FALSE,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS direct_messages_conversation_idx
+                    ON direct_messages (conversation_id, seq);
+                CREATE INDEX IF NOT EXISTS direct_messages_undelivered_idx
+                    ON direct_messages (receiver_id, seq) WHERE NOT delivered;
+                """
+            )
+
+    async def save(self, message: Dict[str, Any], delivered: bool) -> Dict[str, Any]:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            seq = await conn.fetchval(
+                f"""
+                INSERT INTO direct_messages ({", ".join(DM_COLUMNS)}, delivered)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                RETURNING seq;
+                """,
+                *(message.get(col) for col in DM_COLUMNS), delivered,
+            )
+        return {**message, "seq": seq}
+
+    async def drain(self, user_id: str) -> list:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"""
+                UPDATE direct_messages SET delivered = TRUE
+                WHERE seq IN (
+                    SELECT seq FROM direct_messages
+                    WHERE receiver_id = $1 AND NOT delivered
+                    ORDER BY seq LIMIT $2
+                )
+                RETURNING seq, {", ".join(DM_COLUMNS)};
+                """,
+                user_id, DM_MAILBOX_LIMIT,
+            )
+        return sorted((dict(r) for r in rows), key=lambda m: m["seq"])
+
+    async def requeue(self, user_id: str, messages: list) -> None:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE direct_messages SET delivered = FALSE WHERE receiver_id = $1 AND seq = ANY($2::bigint[])",
+                user_id, [m["seq"] for m in messages],
+            )
+
+    async def history(self, conversation_id: str, before: Optional[int] = None, limit: int = 50) -> list:
+        assert self._pool is not None
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"""
+                SELECT seq, {", ".join(DM_COLUMNS)} FROM direct_messages
+                WHERE conversation_id = $1 AND ($2::bigint IS NULL OR seq < $2)
+                ORDER BY seq DESC LIMIT $3;
+                """,
+                conversation_id, before, limit,
+            )
+        return [dict(r) for r in reversed(rows)]
+
+
+async def create_dm_store() -> Any:
+    dsn = os.getenv("DATABASE_URL")
+    if dsn:
+        store = PostgresDMStore(dsn)
+        await store.init()
+        return store
+    return InMemoryDMStore()
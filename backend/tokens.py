@@ -0,0 +1,120 @@
+import os
+import time
+import uuid
+import asyncio
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+# Seconds a bearer token stays valid after login/signup
+TOKEN_TTL = float(os.getenv("AUTH_TOKEN_TTL", str(30 * 24 * 3600)))
+# Tokens kept in the in-process LRU front cache
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+# Seconds a cached token is trusted before the backend is asked again;
+# bounds how long a logout on another worker can go unnoticed
+TOKEN_CACHE_TTL = float(os.getenv("AUTH_TOKEN_CACHE_TTL", "60"))
+# Seconds between sweeps of expired tokens
+TOKEN_SWEEP_INTERVAL = float(os.getenv("AUTH_TOKEN_SWEEP_INTERVAL", "300"))
+
+
+class TokenStore:
+    """Bearer tokens with expiry, a bounded LRU cache and a pluggable backend.
+
+    The backend (see create_token_backend in backend/storage.py) is the
+    source of truth, so any worker sharing it can validate any token. Hot
+    tokens are answered from the local cache without a backend round trip.
+    """
+
+    def __init__(
+        self,
+        backend: Any = None,
+        ttl: float = TOKEN_TTL,
+        cache_size: int = TOKEN_CACHE_SIZE,
+        cache_ttl: float = TOKEN_CACHE_TTL,
+    ):
+        if backend is None:
+            from backend.storage import InMemoryTokenBackend
+            backend = InMemoryTokenBackend()
+        self.backend = backend
+        self.ttl = ttl
+        self.cache_size = max(1, cache_size)
+        self.cache_ttl = cache_ttl
+        # token -> (user_id, expires_at, cached_until)
+        self._cache: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        self._sweeper: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _remember(self, token: str, user_id: str, expires_at: float, now: float) -> None:
+        self._cache[token] = (user_id, expires_at, min(expires_at, now + self.cache_ttl))
+        self._cache.move_to_end(token)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def issue(self, user_id: str) -> str:
+        token = str(uuid.uuid4())
+        now = time.time()
+        expires_at = now + self.ttl
+        await self.backend.put(token, user_id, expires_at)
+        self._remember(token, user_id, expires_at, now)
+        return token
+
+    async def resolve(self, token: str) -> Optional[str]:
+        """Return the user_id for a live token, or None if unknown/expired."""
+        if not token:
+            return None
+        now = time.time()
+        cached = self._cache.get(token)
+        if cached is not None:
+            user_id, expires_at, cached_until = cached
+            if now < cached_until:
+                self._cache.move_to_end(token)
+                self.hits += 1
+                return user_id
+            del self._cache[token]
+        self.misses += 1
+        found = await self.backend.get(token)
+        if found is None:
+            return None
+        user_id, expires_at = found
+        if expires_at <= now:
+            await self.backend.delete(token)
+            return None
+        self._remember(token, user_id, expires_at, now)
+        return user_id
+
+    async def revoke(self, token: str) -> None:
+        self._cache.pop(token, None)
+        await self.backend.delete(token)
+
+    async def sweep(self) -> int:
+        now = time.time()
+        for token, (_, expires_at, _) in list(self._cache.items()):
+            if expires_at <= now:
+                self._cache.pop(token, None)
+        return await self.backend.delete_expired(now)
+
+    def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._sweeper = None
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(TOKEN_SWEEP_INTERVAL)
+            try:
+                removed = await self.sweep()
+                if removed:
+                    print(f"🧹 Swept {removed} expired auth tokens")
+            except Exception as e:
+                print(f"⚠️ Token sweep failed: {e}")
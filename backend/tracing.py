@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+import urllib.request
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+# Fraction of WebSocket frames / HTTP requests to trace; 0 disables tracing
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# file (JSON lines) | otlp (OTLP/HTTP JSON)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "chat-backend")
+# Finished traces buffered for export before new ones are dropped
+TRACE_QUEUE_LIMIT = int(os.getenv("TRACE_QUEUE_LIMIT", "10000"))
+
+# (name, start_ns, end_ns, attributes)
+SpanRecord = Tuple[str, int, int, Optional[Dict[str, Any]]]
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("chat_trace", default=None)
+_sample_rate = TRACE_SAMPLE_RATE
+
+
+class Trace:
+    """One sampled WebSocket frame or HTTP request and its stage spans."""
+
+    __slots__ = ("trace_id", "name", "attrs", "start_ns", "end_ns", "last_ns", "spans", "_token")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.trace_id = "%032x" % random.getrandbits(128)
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = self.last_ns = time.time_ns()
+        self.end_ns = 0
+        self.spans: List[SpanRecord] = []
+        self._token: Any = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "attrs": self.attrs,
+            "start_ns": self.start_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "spans": [
+                {"name": name, "offset_ms": (start - self.start_ns) / 1e6, "duration_ms": (end - start) / 1e6, **({"attrs": attrs} if attrs else {})}
+                for name, start, end, attrs in self.spans
+            ],
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "start_ns")
+
+    def __init__(self, trace: Trace, name: str, attrs: Optional[Dict[str, Any]]):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> "_Span":
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if not self.trace.end_ns:
+            self.trace.spans.append((self.name, self.start_ns, time.time_ns(), self.attrs))
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def enabled() -> bool:
+    return _sample_rate > 0
+
+
+def start(name: str, **attrs: Any) -> Optional[Trace]:
+    """Begin a trace for this unit of work if it is sampled; None otherwise."""
+    if _sample_rate <= 0 or random.random() >= _sample_rate:
+        return None
+    trace = Trace(name, attrs)
+    trace._token = _current.set(trace)
+    return trace
+
+
+def finish(trace: Optional[Trace]) -> None:
+    if trace is None:
+        return
+    trace.end_ns = time.time_ns()
+    try:
+        _current.reset(trace._token)
+    except ValueError:
+        _current.set(None)  # finished from a different context
+    _exporter.submit(trace)
+
+
+def _active() -> Optional[Trace]:
+    # Tasks spawned during a sampled frame inherit its context and may outlive the
+    # trace; once it is finished (and handed to the exporter) it takes no more spans
+    trace = _current.get()
+    if trace is None or trace.end_ns:
+        return None
+    return trace
+
+
+def span(name: str, **attrs: Any) -> Any:
+    """Context manager timing one stage of the current trace (no-op if unsampled)."""
+    trace = _active()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, attrs or None)
+
+
+def lap(name: str) -> None:
+    """Close a sequential stage: a span from the previous lap (or trace start) to now.
+
+    Cheaper than `span` on per-frame paths: when the frame is not sampled
+    this is a single context-variable read.
+    """
+    trace = _active()
+    if trace is not None:
+        now = time.time_ns()
+        trace.spans.append((name, trace.last_ns, now, None))
+        trace.last_ns = now
+
+
+def record(name: str, seconds: float) -> None:
+    """Attach an already-measured stage (e.g. a lock wait) ending now."""
+    trace = _active()
+    if trace is not None:
+        end = time.time_ns()
+        trace.spans.append((name, end - int(seconds * 1e9), end, None))
+
+
+def annotate(**attrs: Any) -> None:
+    trace = _active()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def configure(sample_rate: Optional[float] = None, exporter: Optional[str] = None, path: Optional[str] = None, endpoint: Optional[str] = None) -> None:
+    """Change tracing settings at runtime (tests, load runs)."""
+    global _sample_rate
+    if sample_rate is not None:
+        _sample_rate = sample_rate
+    if exporter is not None:
+        _exporter.kind = exporter
+    if path is not None:
+        _exporter.path = path
+    if endpoint is not None:
+        _exporter.endpoint = endpoint
+
+
+# ─── Export ───────────────────────────────────────────────────────
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attrs(attrs: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in (attrs or {}).items() if v is not None]
+
+
+def to_otlp(traces: List[Trace]) -> Dict[str, Any]:
+    """Encode finished traces as an OTLP/HTTP JSON ExportTraceServiceRequest."""
+    spans = []
+    for trace in traces:
+        root_id = "%016x" % random.getrandbits(64)
+        spans.append({
+            "traceId": trace.trace_id,
+            "spanId": root_id,
+            "name": trace.name,
+            "kind": 2,  # SERVER
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(trace.end_ns),
+            "attributes": _otlp_attrs(trace.attrs),
+        })
+        for name, start_ns, end_ns, attrs in trace.spans:
+            spans.append({
+                "traceId": trace.trace_id,
+                "spanId": "%016x" % random.getrandbits(64),
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 1,  # INTERNAL
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(end_ns),
+                "attributes": _otlp_attrs(attrs),
+            })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attrs({"service.name": TRACE_SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": "backend.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class _Exporter:
+    """Ships finished traces from a daemon thread so exporting never blocks the event loop."""
+
+    def __init__(self):
+        self.kind = TRACE_EXPORTER
+        self.path = TRACE_FILE
+        self.endpoint = TRACE_OTLP_ENDPOINT
+        self.exported = 0
+        self.dropped = 0
+        self._queue: "queue.Queue[Trace]" = queue.Queue(maxsize=TRACE_QUEUE_LIMIT)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace: Trace) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Wait until queued traces have been written (used by tests and load runs)."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.kind == "otlp":
+                    self._post(batch)
+                else:
+                    self._append(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"⚠️ Trace export failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _append(self, batch: List[Trace]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for trace in batch:
+                f.write(json.dumps(trace.to_dict()) + "\n")
+
+    def _post(self, batch: List[Trace]) -> None:
+        body = json.dumps(to_otlp(batch)).encode("utf-8")
+        req = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            resp.read()
+
+
+_exporter = _Exporter()
+flush = _exporter.flush
+
+
+class TracingMiddleware:
+    """ASGI middleware tracing a sample of HTTP requests.
+
+    Only installed when TRACE_SAMPLE_RATE > 0, so untraced deployments pay
+    nothing per request.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = start(f"{scope['method']} {scope['path']}", method=scope["method"], path=scope["path"])
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                trace.attrs["status"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish(trace)
@@ -0,0 +1,167 @@
+import os
+import time
+import asyncio
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+# Seconds between batched "who is typing" frames per room
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", "0.5"))
+# Seconds a typer stays listed without a fresh typing_start
+TYPING_TTL = float(os.getenv("TYPING_TTL", "6"))
+
+RoomEmitter = Callable[[str, Dict[str, Any]], None]
+DMEmitter = Callable[[str, str, bool], None]
+
+
+class TypingAggregator:
+    """Debounces typing indicators and batches them per room.
+
+    Clients send typing_start on nearly every keystroke. Instead of
+    rebroadcasting each one, the aggregator keeps the set of typers per room
+    and emits at most one `{"type": "typing", "users": [...]}` frame per room
+    per interval, and only when the set changed. Typers that stop refreshing
+    are dropped after `ttl` seconds, so a closed tab cannot leave "X is
+    typing" stuck on screen.
+
+    DM typing is debounced the same way per (sender, receiver) pair: only
+    state changes are forwarded, and a stale "typing" is cleared on expiry.
+
+    `update`/`update_dm` return True when other nodes should be told (state
+    changed, or the entry is due a refresh before their copy expires).
+    """
+
+    def __init__(
+        self,
+        emit_room: RoomEmitter,
+        emit_dm: DMEmitter,
+        interval: float = TYPING_INTERVAL,
+        ttl: float = TYPING_TTL,
+    ):
+        self.emit_room = emit_room
+        self.emit_dm = emit_dm
+        self.interval = interval
+        self.ttl = ttl
+        # room_id -> user_id -> (username, expires_at, announced_at)
+        self._rooms: Dict[str, Dict[str, Tuple[str, float, float]]] = {}
+        self._dirty: Set[str] = set()
+        # (sender_id, receiver_id) -> (expires_at, announced_at)
+        self._dm: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"received": 0, "suppressed": 0, "frames": 0, "expired": 0}
+
+    def update(self, room_id: str, user_id: str, username: str, is_typing: bool) -> bool:
+        self.stats["received"] += 1
+        now = time.monotonic()
+        typers = self._rooms.setdefault(room_id, {})
+        current = typers.get(user_id)
+        if not is_typing:
+            if current is None:
+                self.stats["suppressed"] += 1
+                return False
+            del typers[user_id]
+            if not typers:
+                self._rooms.pop(room_id, None)
+            self._dirty.add(room_id)
+            return True
+        if current is None or current[0] != username:
+            typers[user_id] = (username, now + self.ttl, now)
+            self._dirty.add(room_id)
+            return True
+        refresh = now - current[2] >= self.ttl / 2
+        typers[user_id] = (username, now + self.ttl, now if refresh else current[2])
+        if not refresh:
+            self.stats["suppressed"] += 1
+        return refresh
+
+    def update_dm(self, sender_id: str, receiver_id: str, is_typing: bool) -> bool:
+        self.stats["received"] += 1
+        now = time.monotonic()
+        key = (sender_id, receiver_id)
+        current = self._dm.get(key)
+        if not is_typing:
+            if current is None:
+                self.stats["suppressed"] += 1
+                return False
+            del self._dm[key]
+            return True
+        if current is None:
+            self._dm[key] = (now + self.ttl, now)
+            return True
+        refresh = now - current[1] >= self.ttl / 2
+        self._dm[key] = (now + self.ttl, now if refresh else current[1])
+        if not refresh:
+            self.stats["suppressed"] += 1
+        return refresh
+
+    def forget_user(self, room_id: str, user_id: str, dms: bool = False) -> bool:
+        """Drop a user's typing state in a room on disconnect, and with `dms` their DM typing too.
+
+        DM receivers are told right away that the user stopped. Returns True
+        when the room's typers changed, so other nodes should be told.
+        """
+        if dms:
+            for key in [key for key in self._dm if key[0] == user_id]:
+                del self._dm[key]
+                self.emit_dm(key[1], user_id, False)
+        typers = self._rooms.get(room_id)
+        if not typers or typers.pop(user_id, None) is None:
+            return False
+        self._dirty.add(room_id)
+        if not typers:
+            self._rooms.pop(room_id, None)
+        return True
+
+    def typers(self, room_id: str) -> List[Dict[str, str]]:
+        return [
+            {"user_id": uid, "username": name}
+            for uid, (name, _, _) in self._rooms.get(room_id, {}).items()
+        ]
+
+    def flush(self) -> None:
+        """Expire stale typers and emit one frame per changed room."""
+        now = time.monotonic()
+        for room_id, typers in list(self._rooms.items()):
+            stale = [uid for uid, (_, expires_at, _) in typers.items() if expires_at <= now]
+            for uid in stale:
+                del typers[uid]
+            if stale:
+                self.stats["expired"] += len(stale)
+                self._dirty.add(room_id)
+                if not typers:
+                    del self._rooms[room_id]
+        for key, (expires_at, _) in list(self._dm.items()):
+            if expires_at <= now:
+                del self._dm[key]
+                self.stats["expired"] += 1
+                self.emit_dm(key[1], key[0], False)
+        dirty, self._dirty = self._dirty, set()
+        timestamp = datetime.utcnow().isoformat()
+        for room_id in dirty:
+            self.stats["frames"] += 1
+            self.emit_room(room_id, {
+                "type": "typing",
+                "room_id": room_id,
+                "users": self.typers(room_id),
+                "timestamp": timestamp,
+            })
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Typing flush failed: {e}")
@@ -94,6 +94,14 @@ export function useChat({ roomId, user }: UseChatProps) {
       socketManager.onConnect(setIsConnected);
       socketManager.onMessage(handleMessage);
       socketManager.onTyping((data) => {
+        if (data.type === 'typing') {
+          setTypingUsers(
+            (data.users || [])
+              .filter((u) => u.user_id !== user.id)
+              .map((u) => u.username || u.user_id)
+          );
+          return;
+        }
         const name = data.username || data.user_id;
         setTypingUsers((prev) => {
           if (!name) return prev;
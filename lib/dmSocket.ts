@@ -8,8 +8,9 @@
 import { DMMessage } from '@/components/dm/DMSection';
 
 export interface DMSocketMessage {
-  type: 'dm_message' | 'dm_read' | 'dm_typing' | 'dm_connect' | 'dm_error';
+  type: 'dm_message' | 'dm_batch' | 'dm_read' | 'dm_typing' | 'dm_connect' | 'dm_error';
   message?: DMMessage;
+  messages?: DMMessage[];
   sender_id?: string;
   receiver_id?: string;
   conversation_id?: string;
@@ -72,6 +73,12 @@ class DMSocketManager {
         console.log('[DM Socket] ✅ Connected');
         this.isConnecting = false;
         this.reconnectAttempts = 0;
+        // Proves the socket belongs to userId, so the server hands over DMs queued while offline.
+        // Sent as a frame, not in the URL, so the token stays out of access logs
+        const token = localStorage.getItem('auth-token');
+        if (token) {
+          this.socket?.send(JSON.stringify({ type: 'auth', token }));
+        }
         this.startKeepAlive();
         this.callbacks.get('connect')?.(true);
       };
@@ -132,6 +139,13 @@ class DMSocketManager {
             return;
           }
 
+          // DMs that arrived while we were offline, flushed once on connect
+          if (data.type === 'dm_batch' && Array.isArray(data.messages)) {
+            console.log(`[DM Socket] 📬 Processing ${data.messages.length} queued DMs`);
+            data.messages.forEach((messageData: DMMessage) => this.callbacks.get('message')?.(messageData));
+            return;
+          }
+
           if (data.type === 'dm_typing') {
             this.callbacks.get('typing')?.(data);
             return;
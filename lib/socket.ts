@@ -128,8 +128,8 @@ class SocketManager {
             return;
           }
           
-          // Handle typing indicators
-          if (data.type === 'typing_start' || data.type === 'typing_stop') {
+          // Handle typing indicators (batched 'typing' snapshots, legacy start/stop)
+          if (data.type === 'typing' || data.type === 'typing_start' || data.type === 'typing_stop') {
             this.callbacks.get('typing')?.(data);
             return;
           }
@@ -309,7 +309,7 @@ class SocketManager {
     this.callbacks.set('error', callback);
   }
 
-  onTyping(callback: (data: { type: string; user_id: string; username?: string }) => void): void {
+  onTyping(callback: (data: { type: string; user_id?: string; username?: string; users?: Array<{ user_id: string; username: string }> }) => void): void {
     this.callbacks.set('typing', callback);
   }
 
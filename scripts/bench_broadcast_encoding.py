@@ -0,0 +1,95 @@
+"""Microbenchmark: per-recipient send_json vs. serialize-once room broadcasts.
+
+Usage (from the repo root):
+
+    python scripts/bench_broadcast_encoding.py
+    python scripts/bench_broadcast_encoding.py --recipients 10 100 1000 --rounds 200
+
+The fake socket mimics Starlette's WebSocket.send_json (json.dumps per call)
+so the numbers isolate encoding cost from network I/O.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend import encoding  # noqa: E402
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = 0
+
+    async def send_text(self, text: str) -> None:
+        self.frames += 1
+
+    async def send_json(self, data) -> None:
+        # Starlette re-serializes for every recipient
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+
+def sample_message():
+    return {
+        "type": "message",
+        "id": str(uuid.uuid4()),
+        "room_id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "username": "Benchmark User ✨",
+        "content": "Hello everyone, this is a representative chat line with a bit of text. " * 2,
+        "avatar": "https://cdn.example.com/avatars/" + uuid.uuid4().hex + "/medium.webp",
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+
+async def per_recipient(sockets, payload):
+    for ws in sockets:
+        await ws.send_json(payload)
+
+
+async def serialize_once(sockets, payload):
+    text = encoding.encode_frame(payload)
+    for ws in sockets:
+        await ws.send_text(text)
+
+
+async def measure(fn, sockets, rounds):
+    payload = sample_message()
+    await fn(sockets, payload)  # warm-up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await fn(sockets, payload)
+    return (time.perf_counter() - start) / rounds
+
+
+async def main(recipients, rounds):
+    codecs = ["stdlib"] + (["orjson"] if encoding.orjson is not None else [])
+    header = f"{'recipients':>10}  {'per-recipient':>14}" + "".join(f"  {'once/' + c:>14}" for c in codecs) + "  speedup"
+    print(header)
+    print("-" * len(header))
+    for n in recipients:
+        sockets = [FakeWebSocket() for _ in range(n)]
+        baseline = await measure(per_recipient, sockets, rounds)
+        row = f"{n:>10}  {baseline * 1e6:>12.1f}us"
+        best = baseline
+        for codec in codecs:
+            encoding.set_encoder(codec)
+            t = await measure(serialize_once, sockets, rounds)
+            best = min(best, t)
+            row += f"  {t * 1e6:>12.1f}us"
+        print(f"{row}  {baseline / best:>6.1f}x")
+    if encoding.orjson is None:
+        print("\n(orjson not installed; only the stdlib codec was measured)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.recipients, args.rounds))
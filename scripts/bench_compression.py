@@ -0,0 +1,221 @@
+"""Benchmark: CPU cost vs bytes saved for HTTP and WebSocket compression of chat payloads.
+
+Usage (from the repo root):
+
+    python scripts/bench_compression.py
+    python scripts/bench_compression.py --repeat 200 --frames 5000
+    python scripts/bench_compression.py --json > compression.json
+
+HTTP: encodes representative response bodies (a full and a 50-message
+history page from get_messages, a 200-item gallery listing, the room
+list, one profile) with gzip levels 1/5/6/9 and, when the brotli module
+is installed, brotli qualities 1/4/6/11. Prints compressed size, ratio
+and median microseconds per body for each setting, so COMPRESS_MIN_BYTES,
+GZIP_LEVEL and BROTLI_QUALITY can be chosen against real payloads.
+
+WebSocket: replays a stream of chat, typing and presence frames through
+one permessage-deflate context (raw deflate, sync flush per message,
+context takeover) for each window size and level, reporting bytes and
+microseconds per frame plus the zlib memory each socket holds. Every
+socket compresses separately, so a room broadcast costs the per-frame
+time once per recipient.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import uuid
+import random
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend import encoding  # noqa: E402
+from backend.compression import brotli, compress  # noqa: E402
+
+GZIP_LEVELS = (1, 5, 6, 9)
+BROTLI_QUALITIES = (1, 4, 6, 11)
+WINDOW_BITS = (9, 12, 15)
+DEFLATE_LEVELS = (1, 6, 9)
+
+WORDS = (
+    "hey anyone up for the stream tonight lol yes no maybe brb gg that was wild "
+    "check the link did you see the new clip thanks see you later ok sure sounds good"
+).split()
+
+
+def sentence(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 16)))
+
+
+def messages(rng: random.Random, count: int, members: int = 25) -> List[Dict[str, Any]]:
+    start = datetime(2024, 5, 1, 18, 0, 0)
+    out = []
+    for seq in range(1, count + 1):
+        user = rng.randrange(members)
+        out.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "room_id": "lobby",
+            "user_id": f"user-{user}",
+            "username": f"Member{user}",
+            "content": sentence(rng),
+            "avatar": f"https://cdn.example.com/media/{hashlib.sha256(str(user).encode()).hexdigest()}.webp",
+            "timestamp": (start + timedelta(seconds=seq * 7)).isoformat(),
+            "type": "message",
+            "seq": seq,
+        })
+    return out
+
+
+def gallery(rng: random.Random, count: int) -> Dict[str, Any]:
+    items = []
+    for position in range(1, count + 1):
+        key = hashlib.sha256(f"g{position}".encode()).hexdigest()
+        variants = {
+            size: {fmt: f"https://cdn.example.com/media/{hashlib.sha256(f'{key}{size}{fmt}'.encode()).hexdigest()}.{fmt}"
+                   for fmt in ("webp", "jpeg")}
+            for size in ("thumbnail", "medium")
+        }
+        items.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "user_id": "user-1",
+            "position": position,
+            "url": f"https://cdn.example.com/media/{key}.jpg",
+            "caption": sentence(rng),
+            "created_at": datetime(2024, 5, 1).isoformat(),
+            "blob_key": f"{key}.jpg",
+            "content_type": "image/jpeg",
+            "size": rng.randint(200_000, 4_000_000),
+            "filename": f"IMG_{rng.randint(1000, 9999)}.jpg",
+            "variants": variants,
+            "thumbnail_url": variants["thumbnail"]["webp"],
+        })
+    return {"user_id": "user-1", "items": items, "next_cursor": None}
+
+
+def http_payloads(rng: random.Random) -> Dict[str, bytes]:
+    history = messages(rng, 1000)
+    rooms = [
+        {"id": str(uuid.UUID(int=rng.getrandbits(128))), "name": f"Room {i}", "created_at": datetime(2024, 5, 1).isoformat(),
+         "member_count": rng.randint(0, 300), "thumbnail_url": None}
+        for i in range(20)
+    ]
+    profile = {
+        "id": "user-1", "username": "member1", "display_name": "Member One", "email": "member1@example.com",
+        "bio": sentence(rng), "avatar_url": "https://cdn.example.com/media/a.webp",
+        "avatar_urls": {size: f"https://cdn.example.com/media/{size}.webp" for size in ("thumbnail", "small", "medium", "large")},
+    }
+    return {
+        "history_1000": encoding.dumps_bytes(history),
+        "history_50": encoding.dumps_bytes(history[-50:]),
+        "gallery_200": encoding.dumps_bytes(gallery(rng, 200)),
+        "rooms_20": encoding.dumps_bytes(rooms),
+        "profile": encoding.dumps_bytes(profile),
+    }
+
+
+def ws_frames(rng: random.Random, count: int) -> List[bytes]:
+    chat = messages(rng, count)
+    frames = []
+    for message in chat:
+        roll = rng.random()
+        if roll < 0.6:
+            frame: Dict[str, Any] = {"type": "message", **message}
+        elif roll < 0.95:
+            frame = {"type": "typing", "room_id": "lobby", "typers": [
+                {"user_id": message["user_id"], "username": message["username"]}]}
+        else:
+            frame = {"type": "user_joined", "room_id": "lobby", "user_id": message["user_id"],
+                     "username": message["username"], "avatar_url": message["avatar"], "timestamp": message["timestamp"]}
+        frames.append(encoding.dumps_bytes(frame))
+    return frames
+
+
+def median_us(fn: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1e6
+
+
+def bench_http(args: argparse.Namespace, payloads: Dict[str, bytes]) -> List[Dict[str, Any]]:
+    settings = [("gzip", level) for level in GZIP_LEVELS]
+    if brotli is not None:
+        settings += [("br", quality) for quality in BROTLI_QUALITIES]
+    rows = []
+    for name, body in payloads.items():
+        for coding, level in settings:
+            if coding == "br":
+                out = compress(body, "br", brotli_quality=level)
+                us = median_us(lambda: compress(body, "br", brotli_quality=level), args.repeat)
+            else:
+                out = compress(body, "gzip", gzip_level=level)
+                us = median_us(lambda: compress(body, "gzip", gzip_level=level), args.repeat)
+            row = {
+                "kind": "http", "payload": name, "codec": f"{coding}-{level}", "bytes_in": len(body),
+                "bytes_out": len(out), "ratio": len(body) / len(out), "us": us,
+                "mb_per_sec": len(body) / us if us else 0.0,
+            }
+            rows.append(row)
+            if not args.json:
+                print(f"{name:>13}  {row['codec']:>6}  {len(body):>9}  {len(out):>9}  {row['ratio']:>6.1f}x  {us:>9.1f}  {row['mb_per_sec']:>7.1f}")
+    return rows
+
+
+def bench_ws(args: argparse.Namespace, frames: List[bytes]) -> List[Dict[str, Any]]:
+    raw = sum(len(frame) for frame in frames)
+    rows = []
+    for bits in WINDOW_BITS:
+        for level in DEFLATE_LEVELS:
+            encoder = zlib.compressobj(level, zlib.DEFLATED, -bits, args.mem_level)
+            size = 0
+            start = time.perf_counter()
+            for frame in frames:
+                # What permessage-deflate sends: sync-flushed raw deflate minus the 00 00 ff ff tail
+                size += len(encoder.compress(frame) + encoder.flush(zlib.Z_SYNC_FLUSH)) - 4
+            elapsed = time.perf_counter() - start
+            row = {
+                "kind": "ws", "window_bits": bits, "level": level, "mem_level": args.mem_level,
+                "bytes_per_frame": size / len(frames), "raw_bytes_per_frame": raw / len(frames),
+                "ratio": raw / size, "us_per_frame": elapsed / len(frames) * 1e6,
+                "socket_kib": ((1 << (bits + 2)) + (1 << (args.mem_level + 9)) + (1 << bits)) / 1024,
+            }
+            rows.append(row)
+            if not args.json:
+                print(
+                    f"{bits:>6}  {level:>5}  {row['raw_bytes_per_frame']:>9.1f}  {row['bytes_per_frame']:>9.1f}  "
+                    f"{row['ratio']:>6.2f}x  {row['us_per_frame']:>8.2f}  {row['socket_kib']:>10.0f}"
+                )
+    return rows
+
+
+def main(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    rows: List[Dict[str, Any]] = []
+    if not args.json:
+        print(f"HTTP bodies, median of {args.repeat} runs{'' if brotli is not None else ' (brotli not installed)'}\n")
+        print(f"{'payload':>13}  {'codec':>6}  {'bytes':>9}  {'encoded':>9}  {'ratio':>7}  {'us/body':>9}  {'MB/s':>7}")
+    rows += bench_http(args, http_payloads(rng))
+    if not args.json:
+        print(f"\nWebSocket permessage-deflate, {args.frames} frames through one context, memLevel {args.mem_level}\n")
+        print(f"{'window':>6}  {'level':>5}  {'raw B/f':>9}  {'sent B/f':>9}  {'ratio':>7}  {'us/frame':>8}  {'KiB/socket':>10}")
+    rows += bench_ws(args, ws_frames(rng, args.frames))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per (payload, codec) cell")
+    parser.add_argument("--frames", type=int, default=2000, help="WebSocket frames replayed per (window, level) cell")
+    parser.add_argument("--mem-level", type=int, default=5, help="zlib memLevel for the WebSocket runs (WS_DEFLATE_MEM_LEVEL)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,58 @@
+"""Benchmark: logins/second through PasswordHasher at different pool sizes.
+
+Usage (from the repo root):
+
+    python scripts/bench_password_hashing.py
+    python scripts/bench_password_hashing.py --workers 1 2 4 8 --logins 200 --rounds 10
+
+Each "login" is one bcrypt verify submitted concurrently, the way a burst
+of POST /auth/login requests would hit the server. Requests rejected by
+the queue-depth cap (which the API turns into 503s) are counted separately.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend.passwords import HASH_QUEUE_LIMIT, HasherBusy, PasswordHasher  # noqa: E402
+
+
+async def run(workers: int, logins: int, rounds: int, queue_limit: int):
+    hasher = PasswordHasher(workers=workers, queue_limit=queue_limit, rounds=rounds)
+    stored = hasher.hash_sync("correct horse battery staple")
+
+    async def login():
+        try:
+            return await hasher.verify("correct horse battery staple", stored)
+        except HasherBusy:
+            return None
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    hasher.shutdown()
+    ok = sum(1 for r in results if r)
+    rejected = sum(1 for r in results if r is None)
+    return ok / elapsed, rejected, elapsed
+
+
+async def main(worker_counts, logins, rounds, queue_limit):
+    backend = "bcrypt" if PasswordHasher(rounds=rounds).context is not None else "sha256 fallback"
+    print(f"{logins} concurrent logins, cost={rounds}, queue_limit={queue_limit}, backend={backend}\n")
+    print(f"{'workers':>7}  {'logins/s':>9}  {'rejected':>8}  {'wall':>7}")
+    for workers in worker_counts:
+        rate, rejected, elapsed = await run(workers, logins, rounds, queue_limit)
+        print(f"{workers:>7}  {rate:>9.1f}  {rejected:>8}  {elapsed:>6.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=int(os.getenv("BCRYPT_ROUNDS", "12")))
+    parser.add_argument("--queue-limit", type=int, default=HASH_QUEUE_LIMIT)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.logins, args.rounds, args.queue_limit))
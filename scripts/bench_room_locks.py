@@ -0,0 +1,87 @@
+"""Benchmark: message throughput across many rooms, global lock vs. per-room locks.
+
+Usage (from the repo root):
+
+    python scripts/bench_room_locks.py
+    python scripts/bench_room_locks.py --rooms 1 10 100 --messages 20000 --hold-ms 0.2
+
+Drives the real POST /rooms/{room_id}/messages handler concurrently across
+rooms. "global" makes every room share one lock (the old rooms_lock);
+"sharded" uses each room's own lock. --hold-ms simulates I/O inside the
+critical section (e.g. a cold room warming its history from Postgres),
+which is where a single lock serializes unrelated rooms.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# Measure lock contention, not the inbound rate limiter
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+from backend import server  # noqa: E402
+from backend.server import MessageCreate  # noqa: E402
+
+
+class SlowLock:
+    """Wraps a lock so every critical section also awaits `hold` seconds."""
+
+    def __init__(self, lock: asyncio.Lock, hold: float):
+        self._lock = lock
+        self._hold = hold
+
+    async def __aenter__(self):
+        await self._lock.acquire()
+        if self._hold:
+            await asyncio.sleep(self._hold)
+
+    async def __aexit__(self, *exc: Any):
+        self._lock.release()
+
+
+async def run(mode: str, room_count: int, messages: int, hold: float, concurrency: int) -> float:
+    server.rooms.clear()
+    server.room_connections.clear()
+    shared = asyncio.Lock()
+    room_ids = [f"bench-{mode}-{i}" for i in range(room_count)]
+    for room_id in room_ids:
+        room: Dict[str, Any] = await server._ensure_room(room_id)
+        room["lock"] = SlowLock(shared if mode == "global" else asyncio.Lock(), hold)
+
+    # Every sender has at least one message, and the remainder is spread so exactly `messages` are sent
+    concurrency = max(1, min(concurrency, messages))
+    per_worker, extra = divmod(messages, concurrency)
+    payloads = [MessageCreate(user_id=f"user-{i}", content="hello") for i in range(concurrency)]
+
+    async def worker(n: int):
+        room_id = room_ids[n % room_count]
+        for _ in range(per_worker + (n < extra)):
+            await server.send_message(room_id, payloads[n])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    return messages / (time.perf_counter() - start)
+
+
+async def main(room_counts, messages, hold_ms, concurrency):
+    hold = hold_ms / 1000.0
+    print(f"{messages} messages, {max(1, min(concurrency, messages))} concurrent senders, {hold_ms}ms held per critical section\n")
+    print(f"{'rooms':>6}  {'global msg/s':>13}  {'sharded msg/s':>14}  {'speedup':>7}")
+    for room_count in room_counts:
+        global_rate = await run("global", room_count, messages, hold, concurrency)
+        sharded_rate = await run("sharded", room_count, messages, hold, concurrency)
+        speedup = f"{sharded_rate / global_rate:>6.1f}x" if global_rate else f"{'n/a':>7}"
+        print(f"{room_count:>6}  {global_rate:>13.0f}  {sharded_rate:>14.0f}  {speedup}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--hold-ms", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rooms, args.messages, args.hold_ms, args.concurrency))
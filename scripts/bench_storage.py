@@ -0,0 +1,238 @@
+"""Benchmark: user store operations, in-memory vs Postgres, across concurrency levels.
+
+Usage (from the repo root):
+
+    python scripts/bench_storage.py
+    python scripts/bench_storage.py --concurrency 1 8 64 --ops get_user set_theme --count 5000
+    python scripts/bench_storage.py --dsn postgresql://localhost/postgres --cached
+    python scripts/bench_storage.py --json > storage.json
+
+Runs each operation of the user store interface (get_user,
+get_user_by_username, upsert_profile, set_password_hash, get/set_theme,
+get/set_gallery, a single-item caption edit and a 90/10 read/write "mixed" workload) --count times
+split across C concurrent workers, for every C in --concurrency, and
+prints ops/second plus p50/p99/max latency per call.
+
+Postgres is benchmarked when asyncpg is installed and one is reachable:
+--dsn / BENCH_DATABASE_URL, or else a throwaway cluster started with
+initdb/pg_ctl if they are on PATH. Tables are created in a temporary
+schema that is dropped afterwards, so pointing --dsn at a shared
+database does not touch its data. --cached repeats each store behind
+CachedUserStore to show what the read-through profile cache saves.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend.storage import CachedUserStore, InMemoryUserStore, PostgresUserStore, asyncpg  # noqa: E402
+
+OPS = (
+    "get_user",
+    "get_user_by_username",
+    "upsert_profile",
+    "set_password_hash",
+    "get_theme",
+    "set_theme",
+    "get_gallery",
+    "set_gallery",
+    "update_gallery_item",
+    "mixed",
+)
+
+THEME = {"preset": "midnight", "accent": "#7c3aed", "background": {"type": "gradient", "stops": ["#000", "#222"]}}
+
+
+def gallery(n: int) -> list:
+    return [{"id": str(i), "url": f"https://cdn.example.com/g/{i}.webp", "caption": "x" * 40} for i in range(n)]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))]
+
+
+def make_op(name: str, store: Any, user_ids: List[str], gallery_items: list) -> Callable[[random.Random], Awaitable[Any]]:
+    def uid(rng: random.Random) -> str:
+        return rng.choice(user_ids)
+
+    simple = {
+        "get_user": lambda rng: store.get_user(uid(rng)),
+        "get_user_by_username": lambda rng: store.get_user_by_username(f"bench_{uid(rng)}"),
+        "upsert_profile": lambda rng: store.upsert_profile(uid(rng), {"bio": f"bio {rng.random()}"}),
+        "set_password_hash": lambda rng: store.set_password_hash(uid(rng), "x" * 60),
+        "get_theme": lambda rng: store.get_theme(uid(rng)),
+        "set_theme": lambda rng: store.set_theme(uid(rng), THEME),
+        "get_gallery": lambda rng: store.get_gallery(uid(rng)),
+        "set_gallery": lambda rng: store.set_gallery(uid(rng), gallery_items),
+        "update_gallery_item": lambda rng: store.update_gallery_item(
+            uid(rng), rng.choice(gallery_items)["id"], {"caption": f"caption {rng.random()}"}),
+    }
+    if name != "mixed":
+        return simple[name]
+    reads = [simple["get_user"], simple["get_theme"], simple["get_gallery"]]
+    writes = [simple["upsert_profile"], simple["set_theme"]]
+
+    def mixed(rng: random.Random) -> Awaitable[Any]:
+        return rng.choice(writes if rng.random() < 0.1 else reads)(rng)
+
+    return mixed
+
+
+async def seed(store: Any, users: int, gallery_items: list) -> List[str]:
+    user_ids = [f"u{i}-{uuid.uuid4().hex[:6]}" for i in range(users)]
+    for user_id in user_ids:
+        await store.upsert_profile(user_id, {"username": f"bench_{user_id}", "email": f"{user_id}@example.com"})
+        await store.set_theme(user_id, THEME)
+        await store.set_gallery(user_id, gallery_items)
+    return user_ids
+
+
+async def run_op(op: Callable[[random.Random], Awaitable[Any]], count: int, concurrency: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    per_worker = max(1, count // concurrency)
+
+    async def worker(n: int):
+        rng = random.Random(n)
+        for _ in range(per_worker):
+            start = time.perf_counter()
+            await op(rng)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "ops_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+async def bench_store(label: str, store: Any, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    items = gallery(args.gallery_size)
+    user_ids = await seed(store, args.users, items)
+    rows = []
+    for name in args.ops:
+        op = make_op(name, store, user_ids, items)
+        for concurrency in args.concurrency:
+            result = await run_op(op, args.count, concurrency)
+            rows.append({"store": label, "op": name, "concurrency": concurrency, **result})
+            if not args.json:
+                print(
+                    f"{label:>9}  {name:>21}  {concurrency:>5}  {result['ops_per_sec']:>10.0f}  "
+                    f"{result['p50_ms']:>8.3f}  {result['p99_ms']:>8.3f}  {result['max_ms']:>8.3f}"
+                )
+    return rows
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ThrowawayCluster:
+    """A temporary Postgres cluster from initdb/pg_ctl, removed on exit."""
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="bench-pg-")
+        self.port = free_port()
+
+    def __enter__(self) -> str:
+        data = os.path.join(self.dir, "data")
+        subprocess.run(["initdb", "-D", data, "-U", "postgres", "-A", "trust"], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(
+            ["pg_ctl", "-D", data, "-l", os.path.join(self.dir, "log"), "-w", "-o", f"-p {self.port} -k {self.dir} -c fsync=off", "start"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    def __exit__(self, *exc: Any) -> None:
+        subprocess.run(["pg_ctl", "-D", os.path.join(self.dir, "data"), "-m", "immediate", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+async def bench_postgres(dsn: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    schema = f"bench_{uuid.uuid4().hex[:8]}"
+    admin = await asyncpg.connect(dsn)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    try:
+        # asyncpg passes unknown DSN query parameters through as server settings
+        sep = "&" if "?" in dsn else "?"
+        store = PostgresUserStore(f"{dsn}{sep}search_path={schema}")
+        await store.init()
+        try:
+            rows = await bench_store("postgres", store, args)
+            if args.cached:
+                rows += await bench_store("postgres+c", CachedUserStore(store), args)
+            return rows
+        finally:
+            await store._pool.close()
+    finally:
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+def postgres_source(args: argparse.Namespace) -> Tuple[Optional[str], Optional[ThrowawayCluster], str]:
+    if args.no_postgres:
+        return None, None, "disabled with --no-postgres"
+    if asyncpg is None:
+        return None, None, "asyncpg is not installed"
+    dsn = args.dsn or os.getenv("BENCH_DATABASE_URL")
+    if dsn:
+        return dsn, None, ""
+    if shutil.which("initdb") and shutil.which("pg_ctl"):
+        return None, ThrowawayCluster(), ""
+    return None, None, "no --dsn/BENCH_DATABASE_URL and initdb/pg_ctl not on PATH"
+
+
+async def main(args: argparse.Namespace) -> None:
+    rows: List[Dict[str, Any]] = []
+    if not args.json:
+        print(f"{args.count} calls per cell, {args.users} users, gallery of {args.gallery_size} items\n")
+        print(f"{'store':>9}  {'op':>21}  {'conc':>5}  {'ops/s':>10}  {'p50 ms':>8}  {'p99 ms':>8}  {'max ms':>8}")
+    rows += await bench_store("memory", InMemoryUserStore(), args)
+    if args.cached:
+        rows += await bench_store("memory+c", CachedUserStore(InMemoryUserStore()), args)
+
+    dsn, cluster, reason = postgres_source(args)
+    if cluster is not None:
+        with cluster as cluster_dsn:
+            rows += await bench_postgres(cluster_dsn, args)
+    elif dsn:
+        rows += await bench_postgres(dsn, args)
+    elif not args.json:
+        print(f"\nSkipping Postgres: {reason}")
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ops", nargs="+", choices=OPS, default=list(OPS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--count", type=int, default=2000, help="calls per (op, concurrency) cell")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--gallery-size", type=int, default=20)
+    parser.add_argument("--dsn", help="Postgres DSN (default: BENCH_DATABASE_URL, else a throwaway initdb cluster)")
+    parser.add_argument("--no-postgres", action="store_true")
+    parser.add_argument("--cached", action="store_true", help="also run each store behind CachedUserStore")
+    parser.add_argument("--json", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,177 @@
+"""Multi-process smoke test: events cross worker processes via the local broker.
+
+Usage (from the repo root):
+
+    python scripts/cluster_smoke.py
+    python scripts/cluster_smoke.py --workers 4 --clients 16 --messages 100
+
+Starts `python -m backend.cluster` with SERVER_WORKERS workers on a free
+port, connects clients to one room (the kernel spreads them across
+workers), and checks that:
+
+  * every client receives a room message sent by one of them,
+  * a DM reaches the receiver's dm socket on whichever worker holds it,
+  * messages POSTed to one room through every worker all come back from
+    GET /rooms/{id}/messages on every worker, with distinct seqs,
+  * /stats/bus reports more than one node.
+
+Exits non-zero on failure.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import http.client
+import urllib.request
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get_json(url: str):
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+def request_json(conn: http.client.HTTPConnection, method: str, path: str, body=None):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    if resp.status != 200:
+        raise SystemExit(f"{method} {path} answered {resp.status}: {data[:200]!r}")
+    return json.loads(data)
+
+
+def worker_connections(port: int, workers: int, attempts: int = 50):
+    """Keep-alive connections to distinct workers, keyed by the node id each reports."""
+    conns = {}
+    for _ in range(attempts):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        node = request_json(conn, "GET", "/stats/bus")["node"]
+        if node in conns:
+            conn.close()
+        else:
+            conns[node] = conn
+        if len(conns) == workers:
+            break
+    return conns
+
+
+def check_history(port: int, workers: int, messages: int) -> bool:
+    """POST messages to one room round-robin through each worker, then read them back from each."""
+    conns = worker_connections(port, workers)
+    nodes = list(conns.values())
+    sent = {}
+    for i in range(messages):
+        message = request_json(nodes[i % len(nodes)], "POST", "/rooms/smoke-history/messages", {
+            "user_id": f"poster-{i}",
+            "content": f"history {i}",
+        })
+        sent[message["id"]] = message["seq"]
+    distinct = len(set(sent.values())) == len(sent)
+    print(f"posted {len(sent)} messages through {len(conns)} workers, distinct seqs: {distinct}")
+    # Peers learn of each other's messages over the bus
+    time.sleep(1.0)
+    complete = True
+    for node, conn in conns.items():
+        history = request_json(conn, "GET", f"/rooms/smoke-history/messages?limit={messages}")
+        got = {m["id"]: m["seq"] for m in history}
+        seqs = [m["seq"] for m in history]
+        print(f"worker {node} history: {len(set(got) & set(sent))}/{len(sent)} messages, ordered: {seqs == sorted(seqs)}")
+        complete = complete and got == sent and seqs == sorted(seqs)
+        conn.close()
+    return distinct and complete and len(conns) > 1
+
+
+def wait_until_up(base: str, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            get_json(f"{base}/stats/bus")
+            return
+        except Exception:
+            time.sleep(0.3)
+    raise SystemExit("server did not come up")
+
+
+async def recv_until(ws, predicate, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        frame = json.loads(await asyncio.wait_for(ws.recv(), deadline - time.time()))
+        if predicate(frame):
+            return frame
+    raise asyncio.TimeoutError
+
+
+async def run(port: int, clients: int) -> bool:
+    base = f"ws://127.0.0.1:{port}"
+    nodes = {get_json(f"http://127.0.0.1:{port}/stats/bus")["node"] for _ in range(clients * 2)}
+    print(f"nodes answering HTTP: {len(nodes)}")
+
+    sockets = [await websockets.connect(f"{base}/ws/smoke/user-{i}?username=U{i}") for i in range(clients)]
+    dm_socket = await websockets.connect(f"{base}/ws/dm/dm-receiver")
+    # Let presence and join events settle across workers
+    await asyncio.sleep(1.0)
+
+    await sockets[0].send(json.dumps({"type": "message", "content": "hello cluster"}))
+    received = 0
+    for ws in sockets:
+        try:
+            await recv_until(ws, lambda f: f.get("type") == "message" and f.get("content") == "hello cluster")
+            received += 1
+        except asyncio.TimeoutError:
+            pass
+    print(f"room message reached {received}/{clients} clients")
+
+    await sockets[-1].send(json.dumps({
+        "type": "dm_message",
+        "sender_id": f"user-{clients - 1}",
+        "receiver_id": "dm-receiver",
+        "content": "hello dm",
+    }))
+    try:
+        await recv_until(dm_socket, lambda f: f.get("type") == "dm_message")
+        dm_ok = True
+    except asyncio.TimeoutError:
+        dm_ok = False
+    print(f"dm delivered: {dm_ok}")
+
+    for ws in sockets + [dm_socket]:
+        await ws.close()
+    return received == clients and dm_ok and len(nodes) > 1
+
+
+def main(workers: int, clients: int, messages: int) -> int:
+    port = free_port()
+    env = {**os.environ, "SERVER_WORKERS": str(workers), "PORT": str(port), "HOST": "127.0.0.1"}
+    proc = subprocess.Popen([sys.executable, "-m", "backend.cluster"], cwd=ROOT, env=env)
+    try:
+        wait_until_up(f"http://127.0.0.1:{port}")
+        ok = asyncio.run(run(port, clients))
+        ok = check_history(port, workers, messages) and ok
+    finally:
+        proc.terminate()
+        proc.wait(timeout=15)
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=40, help="messages POSTed for the history check")
+    args = parser.parse_args()
+    sys.exit(main(args.workers, args.clients, args.messages))
@@ -0,0 +1,364 @@
+"""Load test: thousands of WebSocket clients across many rooms, with latency percentiles.
+
+Usage (from the repo root):
+
+    python scripts/loadtest.py
+    python scripts/loadtest.py --clients 2000 --rooms 100 --duration 30 --rate 0.5
+    python scripts/loadtest.py --mode uvicorn --workers 4 --mix chat=60,typing=30,dm=5,webrtc=5
+    python scripts/loadtest.py --url ws://staging.example.com --clients 200
+    python scripts/loadtest.py --save-baseline baseline.json
+    python scripts/loadtest.py --baseline baseline.json --tolerance 0.25 --max-p99-ms 250
+
+Server modes:
+  inprocess  uvicorn serving backend.server:app on this script's event loop (default)
+  uvicorn    a separate server process (backend.cluster when --workers > 1)
+  --url      an already running server
+
+Each client joins one room and, at --rate actions per second, sends a
+chat message, a typing indicator, a DM to a random client or a WebRTC
+signal to a peer in its room, chosen by --mix. Chat, DM and WebRTC
+payloads carry their send time; every delivery records its latency.
+
+Prints p50/p99/max delivery latency per kind plus sent and delivered
+frames per second. Exits 1 when --max-p99-ms / --min-delivered-per-sec /
+--max-error-rate are violated, or when --baseline shows a regression
+beyond --tolerance.
+
+Inbound rate limiting is disabled on servers this script starts (the
+point is to measure fan-out, not the limiter); pass --keep-rate-limits
+to leave it on.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+from typing import Any, Dict, List
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import websockets  # noqa: E402
+
+KINDS = ("chat", "typing", "dm", "webrtc")
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    weights = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in KINDS:
+            raise SystemExit(f"unknown mix kind {name!r}; expected one of {', '.join(KINDS)}")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    return {k: v / total for k, v in weights.items()}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit(clients: int) -> None:
+    try:
+        import resource
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = min(hard, max(soft, clients * 2 + 256))
+        if wanted > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except Exception:
+        pass  # Windows, or not permitted
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Stats:
+    def __init__(self):
+        self.sent = {k: 0 for k in KINDS}
+        self.latencies: Dict[str, List[float]] = {k: [] for k in KINDS}
+        self.frames = 0
+        # Batched "who is typing" frames carry no send time; they are only counted
+        self.typing_frames = 0
+        self.connect_errors = 0
+        self.send_errors = 0
+        self.disconnects = 0
+        self.rate_limited = 0
+
+    def summary(self, elapsed: float, clients: int) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "clients": clients,
+            "elapsed_s": round(elapsed, 2),
+            "sent_per_sec": round(sum(self.sent.values()) / elapsed, 1),
+            "delivered_per_sec": round(sum(len(v) for v in self.latencies.values()) / elapsed, 1),
+            "frames_per_sec": round(self.frames / elapsed, 1),
+            "connect_errors": self.connect_errors,
+            "send_errors": self.send_errors,
+            "disconnects": self.disconnects,
+            "rate_limited": self.rate_limited,
+            "error_rate": round((self.connect_errors + self.disconnects) / max(1, clients), 4),
+            "kinds": {},
+        }
+        for kind in KINDS:
+            if kind == "typing":
+                out["kinds"][kind] = {"sent": self.sent[kind], "delivered": self.typing_frames}
+                continue
+            values = sorted(self.latencies[kind])
+            out["kinds"][kind] = {
+                "sent": self.sent[kind],
+                "delivered": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round((values[-1] if values else 0) * 1000, 2),
+            }
+        return out
+
+
+async def run_client(
+    index: int,
+    base_url: str,
+    room_id: str,
+    room_peers: List[int],
+    total_clients: int,
+    mix: Dict[str, float],
+    rate: float,
+    start_at: float,
+    stop_at: float,
+    stats: Stats,
+    connect_gate: asyncio.Semaphore,
+) -> None:
+    user_id = f"lt-{index}"
+    url = f"{base_url}/ws/{room_id}/{user_id}?username=LT{index}"
+    try:
+        async with connect_gate:
+            ws = await websockets.connect(url, max_size=None, open_timeout=30, ping_interval=None)
+    except Exception:
+        stats.connect_errors += 1
+        return
+
+    async def reader():
+        try:
+            async for raw in ws:
+                stats.frames += 1
+                frame = json.loads(raw)
+                ftype = frame.get("type")
+                if ftype == "message":
+                    content = frame.get("content") or ""
+                    if content.startswith("lt|"):
+                        stats.latencies["chat"].append(time.time() - float(content.split("|", 2)[1]))
+                elif ftype == "dm_message":
+                    content = (frame.get("message") or {}).get("content") or ""
+                    if content.startswith("lt|"):
+                        stats.latencies["dm"].append(time.time() - float(content.split("|", 2)[1]))
+                elif ftype == "webrtc-signal":
+                    sent_at = (frame.get("signal") or {}).get("sent_at")
+                    if sent_at:
+                        stats.latencies["webrtc"].append(time.time() - sent_at)
+                elif ftype == "typing":
+                    stats.typing_frames += 1
+                elif ftype == "error" and frame.get("code") == "rate_limited":
+                    stats.rate_limited += 1
+        except websockets.ConnectionClosed:
+            if time.time() < stop_at:
+                stats.disconnects += 1
+
+    reader_task = asyncio.create_task(reader())
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    peers = [p for p in room_peers if p != index]
+    rng = random.Random(index)
+    await asyncio.sleep(max(0.0, start_at - time.time()) + rng.random() / max(rate, 0.001))
+    try:
+        while time.time() < stop_at:
+            kind = rng.choices(kinds, weights)[0]
+            now = time.time()
+            if kind == "chat":
+                frame = {"type": "message", "content": f"lt|{now}|hello from {user_id}"}
+            elif kind == "typing":
+                frame = {"type": rng.choice(("typing_start", "typing_stop"))}
+            elif kind == "dm":
+                target = rng.randrange(total_clients)
+                frame = {"type": "dm_message", "receiver_id": f"lt-{target}", "content": f"lt|{now}|dm"}
+            elif peers:
+                frame = {
+                    "type": "webrtc-signal",
+                    "target_user_id": f"lt-{rng.choice(peers)}",
+                    "signal": {"type": "candidate", "sent_at": now},
+                }
+            else:
+                frame = None  # alone in the room: nobody to signal
+            if frame is not None:
+                try:
+                    await ws.send(json.dumps(frame))
+                    stats.sent[kind] += 1
+                except websockets.ConnectionClosed:
+                    stats.send_errors += 1
+                    break
+            await asyncio.sleep(rng.expovariate(rate))
+    finally:
+        # Let in-flight deliveries land before closing
+        await asyncio.sleep(max(0.0, stop_at + 1.0 - time.time()))
+        await ws.close()
+        reader_task.cancel()
+
+
+async def drive(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    stats = Stats()
+    mix = parse_mix(args.mix)
+    rooms: Dict[str, List[int]] = {}
+    for i in range(args.clients):
+        rooms.setdefault(f"load-{i % args.rooms}", []).append(i)
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    # Leave time for every client to connect before the measured window opens
+    start_at = time.time() + args.ramp
+    stop_at = start_at + args.duration
+    tasks = [
+        run_client(i, base_url, room_id, members, args.clients, mix, args.rate, start_at, stop_at, stats, gate)
+        for room_id, members in rooms.items()
+        for i in members
+    ]
+    await asyncio.gather(*tasks)
+    return stats.summary(args.duration, args.clients)
+
+
+async def run_inprocess(args: argparse.Namespace) -> Dict[str, Any]:
+    import uvicorn  # type: ignore
+
+    from backend.compression import websocket_protocol
+    from backend.server import app
+
+    port = free_port()
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", backlog=4096, ws=websocket_protocol())
+    server = uvicorn.Server(config)
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        return await drive(f"ws://127.0.0.1:{port}", args)
+    finally:
+        server.should_exit = True
+        await serve_task
+
+
+def run_subprocess(args: argparse.Namespace) -> Dict[str, Any]:
+    port = free_port()
+    env = {**os.environ, "PORT": str(port), "HOST": "127.0.0.1", "SERVER_WORKERS": str(args.workers)}
+    if args.workers > 1:
+        cmd = [sys.executable, "-m", "backend.cluster"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "backend.server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=1):
+                    break
+            except OSError:
+                if time.time() > deadline or proc.poll() is not None:
+                    raise SystemExit("server did not start")
+                time.sleep(0.2)
+        return asyncio.run(drive(f"ws://127.0.0.1:{port}", args))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=15)
+
+
+def check(summary: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    failures = []
+    for kind, row in summary["kinds"].items():
+        if kind == "typing" or not row["delivered"]:
+            continue
+        if args.max_p99_ms is not None and row["p99_ms"] > args.max_p99_ms:
+            failures.append(f"{kind} p99 {row['p99_ms']}ms > {args.max_p99_ms}ms")
+    if args.min_delivered_per_sec is not None and summary["delivered_per_sec"] < args.min_delivered_per_sec:
+        failures.append(f"delivered/s {summary['delivered_per_sec']} < {args.min_delivered_per_sec}")
+    if summary["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {summary['error_rate']} > {args.max_error_rate}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+        tol = args.tolerance
+        if summary["delivered_per_sec"] < base["delivered_per_sec"] * (1 - tol):
+            failures.append(f"delivered/s regressed: {summary['delivered_per_sec']} vs baseline {base['delivered_per_sec']}")
+        for kind, row in summary["kinds"].items():
+            before = base.get("kinds", {}).get(kind, {})
+            if kind != "typing" and before.get("p99_ms") and row["delivered"] and row["p99_ms"] > before["p99_ms"] * (1 + tol):
+                failures.append(f"{kind} p99 regressed: {row['p99_ms']}ms vs baseline {before['p99_ms']}ms")
+    return failures
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    print(
+        f"\n{summary['clients']} clients, {summary['elapsed_s']}s: "
+        f"sent {summary['sent_per_sec']}/s, delivered {summary['delivered_per_sec']}/s, "
+        f"frames {summary['frames_per_sec']}/s"
+    )
+    print(
+        f"connect errors {summary['connect_errors']}, disconnects {summary['disconnects']}, "
+        f"send errors {summary['send_errors']}, rate limited {summary['rate_limited']}\n"
+    )
+    print(f"{'kind':>7}  {'sent':>8}  {'delivered':>9}  {'p50 ms':>8}  {'p99 ms':>8}  {'max ms':>8}")
+    for kind, row in summary["kinds"].items():
+        p50, p99, worst = (row.get(k, "-") for k in ("p50_ms", "p99_ms", "max_ms"))
+        print(f"{kind:>7}  {row['sent']:>8}  {row['delivered']:>9}  {p50:>8}  {p99:>8}  {worst:>8}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--url", help="ws:// base URL of a running server (overrides --mode)")
+    parser.add_argument("--workers", type=int, default=1, help="server processes in --mode uvicorn")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds allowed for connecting before measuring")
+    parser.add_argument("--rate", type=float, default=0.2, help="actions per second per client")
+    parser.add_argument("--mix", default="chat=60,typing=25,dm=10,webrtc=5")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--min-delivered-per-sec", type=float)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--baseline", help="JSON summary from a previous --save-baseline run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression vs --baseline")
+    parser.add_argument("--save-baseline", help="write this run's summary as JSON")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    if not args.keep_rate_limits:
+        os.environ["RATE_LIMIT_ENABLED"] = "0"
+    raise_fd_limit(args.clients)
+
+    if args.url:
+        summary = asyncio.run(drive(args.url.rstrip("/"), args))
+    elif args.mode == "uvicorn":
+        summary = run_subprocess(args)
+    else:
+        summary = asyncio.run(run_inprocess(args))
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    failures = check(summary, args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
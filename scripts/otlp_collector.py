@@ -0,0 +1,77 @@
+"""Minimal OTLP/HTTP (JSON) trace collector for local debugging.
+
+Usage (from the repo root):
+
+    python scripts/otlp_collector.py --port 4318 --out collected_spans.jsonl
+    TRACE_SAMPLE_RATE=0.05 TRACE_EXPORTER=otlp python -m uvicorn backend.server:app
+
+Accepts POST /v1/traces with an ExportTraceServiceRequest in JSON (what
+backend/tracing.py sends), prints a one-line summary per trace and appends
+every span to --out. Stands in for a real collector (Jaeger, Tempo,
+otel-collector) when you only need to see where time goes.
+"""
+import json
+import argparse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def summarize(request: dict) -> list:
+    traces = defaultdict(list)
+    for resource in request.get("resourceSpans", []):
+        for scope in resource.get("scopeSpans", []):
+            for span in scope.get("spans", []):
+                traces[span["traceId"]].append(span)
+    lines = []
+    for spans in traces.values():
+        root = next((s for s in spans if not s.get("parentSpanId")), spans[0])
+        t0 = int(root["startTimeUnixNano"])
+        total = (int(root["endTimeUnixNano"]) - t0) / 1e6
+        stages = ", ".join(
+            f"{s['name']}={(int(s['endTimeUnixNano']) - int(s['startTimeUnixNano'])) / 1e6:.3f}ms"
+            for s in spans if s is not root
+        )
+        lines.append(f"{root['name']} {total:.3f}ms [{stages}]")
+    return lines
+
+
+def make_handler(out_path: str):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/v1/traces":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                request = json.loads(body)
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            for line in summarize(request):
+                print(line)
+            with open(out_path, "a", encoding="utf-8") as f:
+                for resource in request.get("resourceSpans", []):
+                    for scope in resource.get("scopeSpans", []):
+                        for span in scope.get("spans", []):
+                            f.write(json.dumps(span) + "\n")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    parser.add_argument("--out", default="collected_spans.jsonl")
+    args = parser.parse_args()
+    print(f"Collecting OTLP traces on http://{args.host}:{args.port}/v1/traces -> {args.out}")
+    ThreadingHTTPServer((args.host, args.port), make_handler(args.out)).serve_forever()